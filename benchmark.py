@@ -0,0 +1,273 @@
+"""
+Benchmark suite for the hot paths of db.py and utils.py.
+Generates a synthetic clan with realistic battles, stubs the Clash Royale API of data_retrieval.py
+and times every hot path at several database sizes. Results are written as JSON, so runs can be
+compared to track regressions.
+
+The benchmark runs against a fresh embedded SQLite database and never touches the configured MySQL database.
+Usage: python benchmark.py --scales 1000,100000,1000000 --output benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+
+# must be configured before db.py and its dependencies are imported
+WORK_DIR = tempfile.mkdtemp(prefix="clash_royale_benchmark_")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(WORK_DIR, "benchmark.db")
+os.environ["DATA_GENERATION_FILE"] = os.path.join(WORK_DIR, "data_generation.json")
+os.environ.setdefault("CLASH_ROYALE_API_TOKEN", "benchmark") # the API is stubbed
+
+import db
+import data_retrieval as api
+from utils import initialize_cards_data, update_cards_data_stats
+from deck_index import index as deck_index
+from card_pairs import count_card_pairs
+
+SCALES = (1000, 100000, 1000000)
+PLAYER_COUNT = 50 # a full clan
+CARD_COUNT = 110
+BATTLE_LOG_SIZE = 25 # battles per battle log, as returned by the API
+NEW_BATTLES = 250 # new battles per insert_new_battles run
+LOAD_CHUNK_SIZE = 20000 # battles generated and written at once while growing the database
+CARD_STATS_SAMPLE = 10000 # battles passed to extract_battles and update_cards_data_stats
+START_TIME = datetime(2020, 1, 1)
+
+# game modes are not played equally often
+GAME_MODE_WEIGHTS = {"PickMode": 2, "DraftMode": 3, "Draft_Competitive": 1, "ClassicDecks_Friendly": 8, "Duel_1v1_Friendly": 2}
+
+class SyntheticClan:
+    """
+    Generates players and battles that resemble the battle logs of a real clan:
+    card popularity follows a Zipf distribution, players mostly play one of their favorite decks,
+    a few players play much more often than the others and the winner takes 1-3 crowns.
+    """
+    def __init__(self, player_count=PLAYER_COUNT, card_count=CARD_COUNT, seed=0):
+        self.random = random.Random(seed)
+        self.players = [(f"#P{i:07d}", f"Spieler {i}") for i in range(player_count)]
+        self.cards = [f"Card {i:03d}" for i in range(card_count)]
+        self.card_weights = [1 / (rank + 1) for rank in range(card_count)]
+        self.activity = [self.random.paretovariate(1.5) for _ in self.players]
+        self.favorite_decks = [[self.random_deck(8) for _ in range(3)] for _ in self.players]
+        self.game_modes = [game_mode for game_mode in db.ALLOWED_BATTLE_MODES if game_mode in GAME_MODE_WEIGHTS]
+        self.game_mode_weights = [GAME_MODE_WEIGHTS[game_mode] for game_mode in self.game_modes]
+        self.time = START_TIME
+
+    def random_deck(self, size):
+        deck = []
+        while len(deck) < size:
+            card = self.random.choices(self.cards, weights=self.card_weights)[0]
+            if card not in deck:
+                deck.append(card)
+        return deck
+
+    def deck(self, player_index, game_mode):
+        if game_mode == "Duel_1v1_Friendly": # three decks per duel
+            return self.random_deck(24)
+        if self.random.random() < 0.7:
+            return list(self.random.choice(self.favorite_decks[player_index]))
+        return self.random_deck(8)
+
+    def player_data(self, player_index, crowns, opponent_crowns):
+        princess_towers = [self.random.randint(1, 4000) for _ in range(max(0, 2 - opponent_crowns))]
+        return (
+            self.players[player_index][1],
+            crowns,
+            round(self.random.uniform(0, 8), 2),
+            0 if opponent_crowns == 3 else self.random.randint(1, 6000),
+            princess_towers or None
+        )
+
+    def battle(self):
+        """
+        Returns the next battle in the format of data_retrieval.parse_battle_log.
+        """
+        player1, player2 = 0, 0
+        while player1 == player2:
+            player1, player2 = self.random.choices(range(len(self.players)), weights=self.activity, k=2)
+        game_mode = self.random.choices(self.game_modes, weights=self.game_mode_weights)[0]
+        # battle times increase like in the battle logs of the API
+        self.time += timedelta(seconds=self.random.randint(1, 120))
+        winner_crowns = self.random.choices((1, 2, 3), weights=(5, 3, 2))[0]
+        loser_crowns = self.random.randint(0, winner_crowns - 1)
+        if self.random.random() < 0.5:
+            crowns1, crowns2 = winner_crowns, loser_crowns
+        else:
+            crowns1, crowns2 = loser_crowns, winner_crowns
+        return (
+            (str(self.time), db.ALLOWED_BATTLE_TYPE, game_mode),
+            [self.player_data(player1, crowns1, crowns2)],
+            self.deck(player1, game_mode),
+            [self.player_data(player2, crowns2, crowns1)],
+            self.deck(player2, game_mode)
+        )
+
+    def battles(self, count):
+        return [self.battle() for _ in range(count)]
+
+    def battle_logs(self, battles):
+        """
+        Returns the battle logs of all players for the given battles, like data_retrieval.fetch_battle_logs.
+        Every battle appears in the logs of both players, the player of the log is always the first player.
+        """
+        tags_by_name = {name: tag for tag, name in self.players}
+        logs = {tag: [] for tag, _ in self.players}
+        for battle in battles:
+            battle_info, player1_data, player1_deck, player2_data, player2_deck = battle
+            logs[tags_by_name[player1_data[0][0]]].append(battle)
+            logs[tags_by_name[player2_data[0][0]]].append((battle_info, player2_data, player2_deck, player1_data, player1_deck))
+        return [(tag, battles[-BATTLE_LOG_SIZE:]) for tag, battles in logs.items()]
+
+def stub_api(clan):
+    """
+    Replaces the API calls of data_retrieval.py with the synthetic clan.
+    Every insert_new_battles run sees NEW_BATTLES battles that are not in the database yet.
+    """
+    api.fetch_clan_members = lambda clan_tag=None: list(clan.players)
+    api.fetch_battle_logs = lambda player_tags, max_in_flight=None: iter(clan.battle_logs(clan.battles(NEW_BATTLES)))
+
+def grow_database(clan, battle_count):
+    """
+    Writes synthetic battles until the database holds battle_count battles.
+    """
+    current = count_battles()
+    while current < battle_count:
+        chunk = clan.battle_logs(clan.battles(min(LOAD_CHUNK_SIZE, battle_count - current)))
+        # the database only grows, so all battles of the chunk are new
+        current += db.write_battles(db.collect_new_battles(chunk, db.get_player_ids()))
+    db.update_ratings()
+    db.analyze_tables()
+
+def count_battles():
+    with db.create_connection() as cnx:
+        return db.select_with_error_handling(cnx, "SELECT COUNT(*) FROM battles", None, "count_battles")[0][0]
+
+def measure(function, repeat):
+    """
+    Calls function repeat times and returns the timings in milliseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def summarize(scale, name, timings, **extra):
+    return {
+        "scale": scale,
+        "benchmark": name,
+        "repeat": len(timings),
+        "min_ms": round(min(timings), 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "mean_ms": round(statistics.mean(timings), 3),
+        "max_ms": round(max(timings), 3),
+        **extra
+    }
+
+def run_scale(clan, scale, repeat):
+    """
+    Grows the database to scale battles and times every hot path. Returns the result records.
+    """
+    start = time.perf_counter()
+    grow_database(clan, scale)
+    load_seconds = time.perf_counter() - start
+    battle_count = count_battles()
+
+    # the most active player and their most frequent opponent
+    most_active = sorted(range(len(clan.players)), key=lambda i: clan.activity[i], reverse=True)
+    player_tag, enemy_tag = clan.players[most_active[0]][0], clan.players[most_active[1]][0]
+    middle = db.get_battles(page_size=1, before=(str(clan.time - (clan.time - START_TIME) / 2), 2 ** 31))[0]
+
+    query, params = db.build_battles_query(player_tag=player_tag, page_size=CARD_STATS_SAMPLE)
+    with db.create_connection() as cnx:
+        rows = db.select_with_error_handling(cnx, query, params, "get_card_stats_sample")
+    battles_data = db.extract_battles(rows)
+    cards_data = initialize_cards_data([card.replace(" ", "_").lower() + ".webp" for card in clan.cards])
+    # indexes the decks added since the previous scale
+    start = time.perf_counter()
+    deck_index.update()
+    deck_index_seconds = time.perf_counter() - start
+
+    benchmarks = [
+        ("get_battles.first_page", lambda: db.get_battles(), {}),
+        ("get_battles.deep_page", lambda: db.get_battles(before=(str(middle["time"]), middle["id"])), {}),
+        ("get_battles.player", lambda: db.get_battles(player_tag=player_tag), {}),
+        ("get_battles.player_enemy_game_mode", lambda: db.get_battles(game_mode="ClassicDecks_Friendly", player_tag=player_tag, enemy_tag=enemy_tag), {}),
+        ("extract_battles", lambda: db.extract_battles(rows), {"battles": len(rows)}),
+        ("update_cards_data_stats", lambda: update_cards_data_stats(battles_data, cards_data), {"battles": len(battles_data)}),
+        ("similar_decks", lambda: deck_index.similar_decks(battles_data[0]["player1_deck"]), {"decks": battle_count * 2}),
+        ("count_card_pairs", count_card_pairs, {"battles": battle_count}),
+        ("stats_versus.enemy", lambda: db.stats_versus(player_tag, enemy_tag), {}),
+        ("stats_versus.all_enemies", lambda: db.stats_versus(player_tag, None), {}),
+        ("update_player_infos", db.update_player_infos, {}),
+        ("rebuild_card_stats", db.rebuild_card_stats, {"battles": battle_count}),
+        ("insert_new_battles", db.insert_new_battles, {"new_battles": NEW_BATTLES}),
+    ]
+    results = []
+    for name, function, extra in benchmarks:
+        results.append(summarize(battle_count, name, measure(function, repeat), **extra))
+        print(f"{battle_count:>9} battles  {name:<40} {results[-1]['median_ms']:>10.3f} ms", file=sys.stderr)
+    results.append({"scale": battle_count, "benchmark": "load", "seconds": round(load_seconds, 3)})
+    results.append({"scale": battle_count, "benchmark": "deck_index.update", "seconds": round(deck_index_seconds, 3)})
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the hot paths of the clash_royale_app at several database sizes.")
+    parser.add_argument("--scales", default=",".join(map(str, SCALES)), help="comma separated battle counts")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark")
+    parser.add_argument("--players", type=int, default=PLAYER_COUNT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    args = parser.parse_args()
+
+    # logging every query would dominate the timings
+    db.logger.setLevel(logging.WARNING)
+    db.initialize_tables()
+    clan = SyntheticClan(player_count=args.players, seed=args.seed)
+    stub_api(clan)
+    db.insert_members()
+
+    results = []
+    try:
+        for scale in sorted(int(scale) for scale in args.scales.split(",")):
+            results.extend(run_scale(clan, scale, args.repeat))
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": db.storage.backend.name,
+        "players": args.players,
+        "seed": args.seed,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+In-process read cache used by run.py.
+Cached values are tagged with the data generation. The generation is stored in a small file
+that is bumped by db.py whenever an ingest commits, so every gunicorn worker sees the same
+generation without querying the database.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError: # Windows, bumps are only serialized within the process
+    fcntl = None
+
+GENERATION_FILE = os.environ.get("DATA_GENERATION_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_generation.json"))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 1024))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 3600)) # seconds, safety net in case a bump is missed
+
+GENERATION_LOCK_FILE = GENERATION_FILE + ".lock"
+
+_generation_lock = threading.Lock()
+_bump_lock = threading.Lock()
+_generation_state = {"mtime": None, "data": {"generation": 0}}
+
+def load_generation_file():
+    try:
+        with open(GENERATION_FILE) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"generation": 0}
+
+def read_generation_file():
+    """
+    Returns the content of the generation file. The file is only read again when its mtime changed.
+    """
+    try:
+        mtime = os.stat(GENERATION_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return {"generation": 0}
+    with _generation_lock:
+        if mtime != _generation_state["mtime"]:
+            try:
+                _generation_state["data"] = load_generation_file()
+                _generation_state["mtime"] = mtime
+            except (OSError, ValueError):
+                # file is being replaced right now, keep the last known generation
+                pass
+        return _generation_state["data"]
+
+def get_generation():
+    """
+    Returns the current data generation.
+    """
+    return read_generation_file()["generation"]
+
+def bump_generation(**info):
+    """
+    Increments the data generation, which invalidates all cached values in every worker.
+    Additional keyword arguments (e.g. the latest battle) are stored in the generation file as well.
+    The file is replaced atomically, so readers never see a partially written file. Concurrent bumps,
+    e.g. of the scheduler and a manual db.py run, are serialized by a lock on GENERATION_LOCK_FILE,
+    so no increment is lost.
+    """
+    with _bump_lock, open(GENERATION_LOCK_FILE, "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX) # released when the file is closed
+        data = load_generation_file()
+        data.update(info)
+        data["generation"] = data["generation"] + 1
+        data["modified"] = int(time.time())
+        temp_file = f"{GENERATION_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, "w") as file:
+            json.dump(data, file)
+        os.replace(temp_file, GENERATION_FILE)
+    return data["generation"]
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with a time to live. Entries of an older data generation are treated as missing.
+    """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry_generation, expires, value = entry
+            if entry_generation != generation or expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, generation, value):
+        with self.lock:
+            self.entries[key] = (generation, time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+read_cache = LRUCache()
+_compute_state = threading.local()
+
+def mark_failed():
+    """
+    Marks the value computed on the current thread as failed, so get_or_compute does not cache it.
+    Called by db.py when a query fails, because the db.py getters return None or an empty result instead of raising.
+    """
+    _compute_state.failed = True
+
+def get_or_compute(key, compute):
+    """
+    Returns the cached value for key in the current data generation.
+    Calls compute() and caches its result on a miss, unless it is None or a query failed while computing it.
+    """
+    generation = get_generation()
+    entry = read_cache.get(key, generation)
+    if entry is not None:
+        return entry[2]
+    outer_failed = getattr(_compute_state, "failed", False)
+    _compute_state.failed = False
+    try:
+        value = compute()
+    finally:
+        failed = _compute_state.failed
+        _compute_state.failed = outer_failed or failed # a failed nested value fails the outer one as well
+    if value is not None and not failed:
+        read_cache.set(key, generation, value)
+    return value
@@ -0,0 +1,125 @@
+"""
+Card catalog of the web application.
+Maps card names (as returned by the API and stored in the "cards" table) to their id, image url and display name.
+The catalog is built once from the card images in static/images/cards and the "cards" table, so routes and
+templates only do dictionary lookups. It is rebuilt when the image directory changes (if watching is enabled)
+or a card shows up that is not part of it yet.
+"""
+
+import os
+import time
+import threading
+from collections import namedtuple
+
+import db
+
+CARD_IMAGE_DIR = os.environ.get("CARD_IMAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "images", "cards"))
+CARD_IMAGE_URL = "/static/images/cards/"
+CARD_IMAGE_EXTENSION = ".webp"
+WATCH_INTERVAL = float(os.environ.get("CARD_CATALOG_WATCH_INTERVAL", 0)) # seconds between checks of the image directory, 0 disables them
+
+Card = namedtuple("Card", ["id", "name", "display_name", "image", "image_url"])
+
+def image_file_name(card_name):
+    """
+    Returns the file name of the image of a card, e.g. "Hog Rider" -> "hog_rider.webp".
+    """
+    return card_name.lower().replace(" ", "_").replace("'", "") + CARD_IMAGE_EXTENSION
+
+def display_name(image_file):
+    """
+    Returns the name shown for a card of which only the image is known, e.g. "hog_rider.webp" -> "Hog Rider".
+    """
+    return os.path.splitext(image_file)[0].replace("_", " ").title()
+
+def make_card(card_id, card_name, image_file, name=None):
+    return Card(card_id, card_name, name or card_name, image_file, CARD_IMAGE_URL + image_file)
+
+class CardCatalog:
+    """
+    In-process card catalog. The lookup tables are replaced as a whole on reload,
+    so readers never need a lock.
+    """
+    def __init__(self, image_dir=CARD_IMAGE_DIR, watch_interval=WATCH_INTERVAL):
+        self.image_dir = image_dir
+        self.watch_interval = watch_interval
+        self._by_name = None
+        self._unknown = {} # cards that are neither in the "cards" table nor in the image directory
+        self._images = ()
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def image_dir_mtime(self):
+        try:
+            return os.stat(self.image_dir).st_mtime
+        except OSError:
+            return None
+
+    def load(self):
+        """
+        Builds the lookup tables from the image directory and the "cards" table.
+        """
+        with self._lock:
+            mtime = self.image_dir_mtime()
+            image_files = sorted(file_name for file_name in os.listdir(self.image_dir)
+                                 if file_name.endswith(CARD_IMAGE_EXTENSION)) if mtime is not None else []
+            by_image = {image_file: make_card(None, display_name(image_file), image_file) for image_file in image_files}
+            by_id = {}
+            for card_id, card_name in db.get_card_names_by_id().items():
+                by_id[card_id] = by_image[image_file_name(card_name)] = make_card(card_id, card_name, image_file_name(card_name))
+            by_name = {card.name: card for card in by_image.values()}
+            for card_name, card in self._unknown.items():
+                by_name.setdefault(card_name, card)
+            # cards with an image are listed on /cards, without the image directory all known cards are
+            images = [by_image[image_file] for image_file in image_files] if image_files else list(by_id.values())
+            self._images = tuple(sorted(images, key=lambda card: card.display_name))
+            self._by_name = by_name
+            self._mtime = mtime
+            self._checked = time.monotonic()
+
+    def refresh(self):
+        """
+        Loads the catalog on first use and reloads it if the image directory changed.
+        """
+        if self._by_name is None:
+            self.load()
+        elif self.watch_interval and time.monotonic() - self._checked >= self.watch_interval:
+            self._checked = time.monotonic()
+            if self.image_dir_mtime() != self._mtime:
+                self.load()
+
+    def get(self, card_name):
+        """
+        Returns the card with the given name. The catalog is rebuilt for a card it does not know yet,
+        a card that is still unknown afterwards is added with its derived image path.
+        """
+        self.refresh()
+        card = self._by_name.get(card_name)
+        if card is None:
+            self.load()
+            card = self._by_name.get(card_name)
+        if card is None:
+            with self._lock:
+                card = self._unknown[card_name] = make_card(None, card_name, image_file_name(card_name))
+                self._by_name[card_name] = card
+        return card
+
+    def image_urls(self, card_names):
+        return [self.get(card_name).image_url for card_name in card_names]
+
+    def cards(self):
+        """
+        Returns the cards shown on /cards, sorted by their display name.
+        """
+        self.refresh()
+        return self._images
+
+    def cards_data(self):
+        """
+        Returns a new list of card data dictionaries for the /cards statistics.
+        """
+        return [{"image": card.image, "name": card.name, "display_name": card.display_name,
+                 "battle_count": 0, "win_count": 0} for card in self.cards()]
+
+catalog = CardCatalog()
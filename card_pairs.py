@@ -0,0 +1,123 @@
+"""
+Card pair statistics per game mode: how often two cards are played in the same deck and how often such decks win
+(synergies), and how a card fares against a card of the opposing deck (counters).
+The decks are encoded as incidence matrices with one row per deck and one column per card id, so all pair counts
+are matrix products: X.T @ X counts the decks containing both cards, X.T @ Y the battles of a card against a card
+of the opposing deck. Weighting the rows of X with the outcome gives the win counts.
+The matrices are computed over the whole history once per data generation (see cache.get_or_compute).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+import db
+import cache
+
+GAME_MODES = db.ALLOWED_BATTLE_MODES
+MIN_BATTLES = 10 # pairs played less often are left out
+PAIR_LIMIT = 50 # pairs returned by default
+MAX_PAIR_LIMIT = 1000
+
+# card names by card id and (game mode, card id, card id) count matrices
+CardPairs = namedtuple("CardPairs", ["card_names", "pair_battles", "pair_wins", "versus_battles", "versus_wins"])
+
+def incidence_matrix(decks, width):
+    """
+    Returns the (len(decks), width) incidence matrix of comma separated card id strings.
+    Card ids outside of the matrix (cards added after the computation started) are left out.
+    """
+    lengths = [deck.count(",") + 1 if deck else 0 for deck in decks]
+    matrix = np.zeros((len(decks), width), dtype=np.float32)
+    if any(lengths):
+        card_ids = np.fromstring(",".join(deck for deck in decks if deck), dtype=np.int64, sep=",")
+        rows = np.repeat(np.arange(len(decks)), lengths)
+        known = card_ids < width
+        matrix[rows[known], card_ids[known]] = 1
+    return matrix
+
+def count_products(left, right):
+    # float32 sums of 0/1 products are exact below 2 ** 24, far more than a batch has rows
+    return np.rint(left.T @ right).astype(np.int64)
+
+def count_card_pairs():
+    """
+    Counts the battles and wins of all card pairs within a deck and across opposing decks in every game mode.
+    Every battle is counted from the perspective of both players.
+    """
+    card_names = db.get_card_names_by_id()
+    width = max(card_names, default=0) + 1
+    shape = (len(GAME_MODES), width, width)
+    pair_battles, pair_wins, versus_battles, versus_wins = (np.zeros(shape, dtype=np.int64) for _ in range(4))
+    for batch in db.iter_decks():
+        game_modes = np.array([GAME_MODES.index(row[1]) if row[1] in GAME_MODES else -1 for row in batch])
+        won = np.array([row[2] for row in batch], dtype=np.float32)
+        decks = incidence_matrix([row[3] for row in batch], width)
+        opponent_decks = incidence_matrix([row[4] for row in batch], width)
+        for game_mode in np.unique(game_modes[game_modes >= 0]):
+            selected = game_modes == game_mode
+            deck, opponent_deck = decks[selected], opponent_decks[selected]
+            winning_deck = deck * won[selected, None]
+            pair_battles[game_mode] += count_products(deck, deck)
+            pair_wins[game_mode] += count_products(winning_deck, deck)
+            versus_battles[game_mode] += count_products(deck, opponent_deck)
+            versus_wins[game_mode] += count_products(winning_deck, opponent_deck)
+    return CardPairs([card_names.get(card_id) for card_id in range(width)],
+                     pair_battles, pair_wins, versus_battles, versus_wins)
+
+def get_card_pairs():
+    """
+    Returns the CardPairs of the current data generation.
+    """
+    return cache.get_or_compute(("count_card_pairs",), count_card_pairs)
+
+def select_game_mode(counts, game_mode):
+    return counts.sum(axis=0) if game_mode == "ALL" else counts[GAME_MODES.index(game_mode)]
+
+def card_mask(card_names, card_name):
+    return np.array([name == card_name for name in card_names])
+
+def top_pairs(card_names, battles, wins, mask, limit, ascending, columns):
+    """
+    Returns up to limit pairs of the mask as dictionaries, ordered by win rate and battle count.
+    """
+    rows, cols = np.nonzero(mask)
+    battle_counts, win_counts = battles[rows, cols], wins[rows, cols]
+    win_rates = win_counts / battle_counts
+    order = np.lexsort((-battle_counts, win_rates if ascending else -win_rates))[:limit]
+    return [{columns[0]: card_names[rows[i]],
+             columns[1]: card_names[cols[i]],
+             "battle_count": int(battle_counts[i]),
+             "win_count": int(win_counts[i]),
+             "win_rate": round(float(win_rates[i]) * 100, 2)}
+            for i in order]
+
+def get_synergies(game_mode="ALL", card_name=None, min_battles=MIN_BATTLES, limit=PAIR_LIMIT):
+    """
+    Returns the card pairs played together in at least min_battles battles, highest win rate first,
+    as dictionaries with card1, card2, battle_count, win_count and win_rate (in percent).
+    With card_name only the pairs containing that card are returned.
+    """
+    pairs = get_card_pairs()
+    battles = select_game_mode(pairs.pair_battles, game_mode)
+    mask = np.triu(battles >= max(min_battles, 1), k=1)
+    if card_name:
+        selected = card_mask(pairs.card_names, card_name)
+        mask &= selected[:, None] | selected[None, :]
+    return top_pairs(pairs.card_names, battles, select_game_mode(pairs.pair_wins, game_mode), mask, limit,
+                     ascending=False, columns=("card1", "card2"))
+
+def get_counters(game_mode="ALL", card_name=None, min_battles=MIN_BATTLES, limit=PAIR_LIMIT):
+    """
+    Returns how cards fared against cards of the opposing deck in at least min_battles battles, lowest win rate
+    (the strongest counter) first, as dictionaries with card, enemy_card, battle_count, win_count and win_rate
+    (in percent). With card_name only the counters of that card are returned. Mirror matchups are left out.
+    """
+    pairs = get_card_pairs()
+    battles = select_game_mode(pairs.versus_battles, game_mode)
+    mask = battles >= max(min_battles, 1)
+    np.fill_diagonal(mask, False)
+    if card_name:
+        mask &= card_mask(pairs.card_names, card_name)[:, None]
+    return top_pairs(pairs.card_names, battles, select_game_mode(pairs.versus_wins, game_mode), mask, limit,
+                     ascending=True, columns=("card", "enemy_card"))
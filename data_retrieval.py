@@ -4,19 +4,96 @@ Module is used by db.py to write retrieved data to the database.
 """
 
 import os
+import time
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from utils import iso8601_to_datetime
 
 API_TOKEN = os.environ.get("CLASH_ROYALE_API_TOKEN")
-API_URL = "https://api.clashroyale.com/v1"
+API_URL = os.environ.get("CLASH_ROYALE_API_URL", "https://api.clashroyale.com/v1") # can point to a local stub server
 HEADERS = {"Authorization": "Bearer " + API_TOKEN}
 
+MAX_IN_FLIGHT = int(os.environ.get("CLASH_ROYALE_MAX_IN_FLIGHT", 8)) # concurrent requests
+REQUESTS_PER_SECOND = float(os.environ.get("CLASH_ROYALE_REQUESTS_PER_SECOND", 10)) # token bucket refill rate
+MAX_RETRIES = 4 # for 429 and 5xx responses and connection errors, with exponential backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BACKOFF_FACTOR = 0.5 # seconds before the first retry, doubled for every further one
+TIMEOUT = 10 # seconds
+
 CLAN_TAG = "#LGV2LVQY" # Clan: Retire
 PLAYER_TAG = "#2J200GLG8" # Spieler: Raue Hände
 
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter. acquire() blocks until a token is available.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def create_session():
+    """
+    Creates a keep-alive session. Retries are done by get_json, so every attempt takes a token of the rate limiter.
+    """
+    adapter = HTTPAdapter(max_retries=0, pool_connections=1, pool_maxsize=MAX_IN_FLIGHT)
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+session = create_session()
+rate_limiter = TokenBucket(REQUESTS_PER_SECOND)
+
+def retry_delay(response, attempt):
+    """
+    Returns the seconds to wait before the next attempt: the Retry-After header of the API if it sends one,
+    exponential backoff otherwise.
+    """
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        return int(retry_after)
+    return BACKOFF_FACTOR * 2 ** attempt
+
+def get_json(end_point):
+    """
+    Sends a rate limited GET request to the API and returns the decoded JSON response.
+    429 and 5xx responses, connection errors and timeouts are retried up to MAX_RETRIES times.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        try:
+            with session.get(API_URL + end_point, timeout=TIMEOUT) as response:
+                if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    response.raise_for_status()
+                    return response.json()
+                delay = retry_delay(response, attempt)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            delay = retry_delay(None, attempt)
+        time.sleep(delay)
+
 def fetch_clan_members(clan_tag=CLAN_TAG):
     """
     Fetches and returns the members of a clan from the API.
@@ -24,55 +101,85 @@ def fetch_clan_members(clan_tag=CLAN_TAG):
     END_POINT = "/clans/%23" + clan_tag[1:] + "/members"
     clan_members = []
     try:
-        with requests.get(API_URL + END_POINT, headers=HEADERS) as response:
-            response.raise_for_status()
-            json_data = response.json()
-            clan_members = [(item["tag"], item["name"]) for item in json_data["items"]]
-            return clan_members
+        json_data = get_json(END_POINT)
+        clan_members = [(item["tag"], item["name"]) for item in json_data["items"]]
+        return clan_members
     except requests.exceptions.RequestException  as e:
         print("Error: ", str(e))
 
+def parse_battle_log(match_data):
+    """
+    Parses the JSON battle log of a player into a list of battle tuples.
+    """
+    battles = []
+    for battle in match_data:
+         battle_info = (
+             iso8601_to_datetime(battle["battleTime"], "%Y%m%dT%H%M%S.%fZ"),
+             battle["type"], 
+             battle["gameMode"]["name"]
+         )
+         player_info = [
+             (
+                 it["name"],
+                 it["crowns"],
+                 it["elixirLeaked"],
+                 it["kingTowerHitPoints"],
+                 it["princessTowersHitPoints"]
+             ) for it in battle["team"]]   
+         opponent_info = [
+             (
+                 it["name"],
+                 it["crowns"], 
+                 it["elixirLeaked"], 
+                 it["kingTowerHitPoints"], 
+                 it["princessTowersHitPoints"]
+             ) for it in battle["opponent"]
+         ]
+         player_deck = [card["name"] for card in battle["team"][0]["cards"]]
+         opponent_deck = [card["name"] for card in battle["opponent"][0]["cards"]]
+         battles.append((battle_info, player_info, player_deck, opponent_info, opponent_deck))
+    return battles
+
 def fetch_battle_log(player_tag=PLAYER_TAG):
     """
     Fetches and returns the battle log of a player.
     """
     END_POINT = "/players/%23" + player_tag[1:] + "/battlelog"
     try:
-        with requests.get(API_URL + END_POINT, headers=HEADERS) as response:
-            response.raise_for_status()
-            match_data = response.json()
-            battles = []
-            for battle in match_data:
-                 battle_info = (
-                     iso8601_to_datetime(battle["battleTime"], "%Y%m%dT%H%M%S.%fZ"),
-                     battle["type"], 
-                     battle["gameMode"]["name"]
-                 )
-                 player_info = [
-                     (
-                         it["name"],
-                         it["crowns"],
-                         it["elixirLeaked"],
-                         it["kingTowerHitPoints"],
-                         it["princessTowersHitPoints"]
-                     ) for it in battle["team"]]   
-                 opponent_info = [
-                     (
-                         it["name"],
-                         it["crowns"], 
-                         it["elixirLeaked"], 
-                         it["kingTowerHitPoints"], 
-                         it["princessTowersHitPoints"]
-                     ) for it in battle["opponent"]
-                 ]
-                 player_deck = [card["name"] for card in battle["team"][0]["cards"]]
-                 opponent_deck = [card["name"] for card in battle["opponent"][0]["cards"]]
-                 battles.append((battle_info, player_info, player_deck, opponent_info, opponent_deck))
-        return battles
+        return parse_battle_log(get_json(END_POINT))
+    except requests.exceptions.RequestException  as e:
+        print("Error: ", str(e))
+
+def fetch_battle_log_if_changed(player_tag, last_battle_time=None):
+    """
+    Fetches the battle log of a player, but only parses it if its newest battle is not last_battle_time
+    (a battleTime as returned by the API). The API lists the newest battle first.
+    Returns (newest battleTime, battles). battles is an empty list if the battle log did not change
+    and None if it could not be fetched.
+    """
+    END_POINT = "/players/%23" + player_tag[1:] + "/battlelog"
+    try:
+        match_data = get_json(END_POINT)
     except requests.exceptions.RequestException  as e:
         print("Error: ", str(e))
+        return last_battle_time, None
+    newest_battle_time = match_data[0]["battleTime"] if match_data else last_battle_time
+    if newest_battle_time == last_battle_time:
+        return last_battle_time, []
+    return newest_battle_time, parse_battle_log(match_data)
+
+def fetch_battle_logs(player_tags, max_in_flight=MAX_IN_FLIGHT):
+    """
+    Fetches the battle logs of several players concurrently.
+    Yields (player_tag, battles) tuples in the order the responses arrive, so the caller can
+    process a battle log while the others are still being fetched.
+    battles is None if the battle log of a player could not be fetched.
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {executor.submit(fetch_battle_log, player_tag): player_tag for player_tag in player_tags}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
-    
 def main():
     print(fetch_battle_log())
 
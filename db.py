@@ -5,37 +5,63 @@ Module is used by run.py to write to access the database.
 
 import os
 import ast
-from datetime import datetime, timedelta
+import time
+import threading
+from collections import Counter
+from datetime import date, datetime, timedelta
 
-import mysql.connector
-
-from logger import configured_logger, TX_ROLLBACK_MSG
+from logger import configured_logger, log_query, TX_ROLLBACK_MSG
 import sql_statements as sql
+import storage
 import data_retrieval as api
-from utils import iso8601_to_datetime
+import cache
+import ratings
+import metrics
 
 ALLOWED_BATTLE_TYPE = "clanMate"
 ALLOWED_BATTLE_MODES = ["PickMode", "DraftMode", "Draft_Competitive", "ClassicDecks_Friendly", "Duel_1v1_Friendly"]
+WRITE_BATCH_SIZE = 500 # battles per transaction in insert_new_battles
+RATING_FETCH_SIZE = 10000 # battles fetched per round-trip by the rating engine
+PAGE_SIZE = 10 # battles per page on /battles and /player/<tag>
+MAX_PAGE_SIZE = 100
+STREAM_BATCH_SIZE = 1000 # battles per query of iter_battles
+SCORE_FETCH_SIZE = 20000 # scores per query of iter_scores
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DUPLICATE_TOLERANCE = (timedelta(seconds=-1), timedelta(0), timedelta(seconds=1))
+RATING_START = (datetime(1000, 1, 1), 0) # (time, id) checkpoint before the first battle, the smallest MySQL DATETIME
 
 logger = configured_logger("db.log")
+# statements and parameters of queries slower than metrics.SLOW_QUERY_SECONDS
+slow_query_logger = configured_logger("slow_queries.log", name="slow_queries") if metrics.SLOW_QUERY_SECONDS else None
+
+# In-process copy of the "cards" table. Card ids never change once assigned,
+# so the catalog only has to be reloaded when an unknown card shows up.
+_card_names_by_id = {}
+_card_ids_by_name = {}
+_cards_lock = threading.Lock()
 
+@metrics.timed
 def create_connection(host="localhost", port=3306, user=os.environ.get("MYSQL_USERNAME"), password=os.environ.get("MYSQL_PASSWORD"), database="clash_royale"):
     """
-    Creates a connection to the clash_royale database.
+    Borrows a connection to the clash_royale database from the configured storage backend.
+    Closing the connection (e.g. at the end of a with block) returns it to the backend.
     """
     cnx = None
     try:
-        cnx = mysql.connector.connect(
+        cnx = storage.backend.connect(
             host=host,
             port=port,
             user=user,
             password=password,
             database=database
         )
-    except mysql.connector.Error as e:
+        metrics.CONNECTIONS.inc(storage.backend.name)
+    except storage.Error as e:
         logger.critical(f"Error: {e}")
+        cache.mark_failed()
     except AttributeError as e:
         logger.critical(f"Error: {e}")
+        cache.mark_failed()
     return cnx
 
 def table_exists(cursor, table_name):
@@ -43,10 +69,7 @@ def table_exists(cursor, table_name):
     Checks if a table exists in the database. 
     Used in initialize_tables()
     """
-    cursor.execute("SHOW TABLES")
-    tables = cursor.fetchall()
-    # print("Tables variable:", tables)
-    return any(table_name.lower() == t[0] for t in tables)
+    return storage.backend.table_exists(cursor, table_name)
 
 def create_table(cursor, table_name, query):
     """
@@ -55,7 +78,19 @@ def create_table(cursor, table_name, query):
     """
     cursor.execute(query)
     logger.info(f"Created table: {table_name}")
-    logger.info(f"Query executed: {query}")
+    log_query(logger, query)
+
+def create_index(cursor, query):
+    """
+    Creates an index unless it already exists.
+    Used in initialize_tables() and create_battle_indexes()
+    """
+    try:
+        cursor.execute(query)
+        log_query(logger, query)
+    except storage.Error as e:
+        if not storage.backend.is_duplicate_index(e):
+            logger.critical(f"Error: {e}")
 
 def initialize_tables():
     """
@@ -63,7 +98,16 @@ def initialize_tables():
     """
     TABLE_CREATION_QUERIES = {"PLAYERS" : sql.PLAYERS, 
                               "BATTLES" : sql.BATTLES,
-                              "SCORES" : sql.SCORES}
+                              "SCORES" : sql.SCORES,
+                              "CARDS" : sql.CARDS,
+                              "SCORE_CARDS" : sql.SCORE_CARDS,
+                              "CARD_STATS" : sql.CARD_STATS,
+                              "HEAD_TO_HEAD" : sql.HEAD_TO_HEAD,
+                              "PLAYER_RATINGS" : sql.PLAYER_RATINGS,
+                              "RATING_CHECKPOINT" : sql.RATING_CHECKPOINT,
+                              "RATING_HISTORY" : sql.RATING_HISTORY,
+                              "PLAYER_ROLLUPS" : sql.PLAYER_ROLLUPS,
+                              "CARD_ROLLUPS" : sql.CARD_ROLLUPS}
     try:
         with create_connection() as cnx:
             with cnx.cursor() as cursor:
@@ -72,8 +116,10 @@ def initialize_tables():
                         logger.warning(f"Table already exists: {table_name}")
                     else:
                         create_table(cursor, table_name, query)
+                    for index_query in sql.TABLE_INDEXES.get(table_name, []):
+                        create_index(cursor, index_query)
                 logger.info("Tables checked and initialized")
-    except mysql.connector.Error as e:
+    except storage.Error as e:
         logger.critical(f"Error: {e}")
 
 def insert_with_error_handling(cnx, query, params, recursive_insertion=False):
@@ -85,43 +131,51 @@ def insert_with_error_handling(cnx, query, params, recursive_insertion=False):
     try:
         with cnx.cursor() as cursor:
             cursor.executemany(query, params)
-            logger.info(f"Query executed: {query}")
-            logger.info(f"Parameters: {params}")
+            log_query(logger, query, params)
             cnx.commit()
-    except mysql.connector.IntegrityError as e:
-        error_code = e.errno
-        if error_code == 1062 and recursive_insertion:
+    except storage.IntegrityError as e:
+        if storage.backend.is_duplicate_entry(e) and recursive_insertion:
             logger.warning("Duplicate entry found. Retrying with updated parameters")
             return insert_with_error_handling(cnx, query, params[1:], recursive_insertion=True)
         else:
             logger.critical(f"Error: {e}")
             cnx.rollback()
             logger.warning(TX_ROLLBACK_MSG)
-    except mysql.connector.Error as e:
+    except storage.Error as e:
         logger.critical(f"Error: {e}")
         cnx.rollback()
         logger.warning(TX_ROLLBACK_MSG)
 
-def select_with_error_handling(cnx, query, params):
+def observe_query(name, query, params, seconds, rows):
+    """
+    Records the latency and row count of a query and writes slow queries to the slow query log.
+    """
+    if metrics.observe_query(name, seconds, rows) and slow_query_logger:
+        slow_query_logger.warning(f"Slow query {name} ({seconds:.3f} s, {rows} rows): {query} Parameters: {params}")
+
+def select_with_error_handling(cnx, query, params, name):
     """
     Executes a select query with parameters and error handling. 
     If params is None or empty, no sql statements are executed.
+    Queries are recorded in the metrics under the given name.
     """
     try:
         with cnx.cursor() as cursor:
+            start = time.perf_counter()
             if params is None:
                 cursor.execute(query)
-                logger.info(f"Query executed: {query}")
             else:
                 cursor.execute(query, params)
-                logger.info(f"Query executed: {query}")
-                logger.info(f"Parameters: {params}")
+            log_query(logger, query, params)
             result = cursor.fetchall()
+            observe_query(name, query, params, time.perf_counter() - start, len(result))
             return result
-    except mysql.connector.IntegrityError as e:
+    except storage.IntegrityError as e:
         logger.critical(f"Error: {e}")
-    except mysql.connector.Error as e:
+        cache.mark_failed()
+    except storage.Error as e:
         logger.critical(f"Error: {e}")
+        cache.mark_failed()
 
 def get_player_id_by_name(player_name):
     """
@@ -129,7 +183,7 @@ def get_player_id_by_name(player_name):
     """
     with create_connection() as cnx:
         query = "SELECT id FROM players WHERE name = %s"
-        result = select_with_error_handling(cnx, query, (player_name,))
+        result = select_with_error_handling(cnx, query, (player_name,), "get_player_id_by_name")
         if result:
             return result[0][0]
         else:
@@ -141,7 +195,7 @@ def get_player_name_by_id(id):
     """
     with create_connection() as cnx:
         query = "SELECT name FROM players WHERE id = %s"
-        result = select_with_error_handling(cnx, query, (id,))
+        result = select_with_error_handling(cnx, query, (id,), "get_player_name_by_id")
         if result:
             return result[0][0]
         else:
@@ -153,7 +207,7 @@ def get_player_name_by_tag(player_tag):
     """
     with create_connection() as cnx:
         query = "SELECT name FROM players WHERE tag = %s"
-        result = select_with_error_handling(cnx, query, (player_tag,))
+        result = select_with_error_handling(cnx, query, (player_tag,), "get_player_name_by_tag")
         if result:
             return result[0][0]
         else:
@@ -165,7 +219,7 @@ def get_player_info(player_tag):
     """
     with create_connection() as cnx:
         query = "SELECT * FROM players WHERE tag = %s"
-        result = select_with_error_handling(cnx, query, (player_tag,))
+        result = select_with_error_handling(cnx, query, (player_tag,), "get_player_info")
         if result:
             column_names = ["id", "tag", "name", "1v1_battle_count", "1v1_win_count", "1v1_three_crowns_win_count"]
             player_info = dict(zip(column_names, result[0]))
@@ -179,7 +233,7 @@ def get_player_tags():
     """
     with create_connection() as cnx:
         query = "SELECT tag FROM players"
-        result = select_with_error_handling(cnx, query, ())
+        result = select_with_error_handling(cnx, query, (), "get_player_tags")
         if result:
             return [tag[0] for tag in result]
         else:
@@ -190,8 +244,8 @@ def get_players():
     Retrieves all tags, names etc. from the "players" table.
     """
     with create_connection() as cnx:
-        query = "SELECT tag, name, 1v1_battle_count, 1v1_win_count, 1v1_three_crowns_win_count FROM players"
-        result = select_with_error_handling(cnx, query, ())
+        query = "SELECT tag, name, `1v1_battle_count`, `1v1_win_count`, `1v1_three_crowns_win_count` FROM players"
+        result = select_with_error_handling(cnx, query, (), "get_players")
         if result:
             # return result as dict for better readability in template html
             columns = ["tag", "name", "1v1_battle_count", "1v1_win_count", "1v1_three_crowns_win_count"]
@@ -200,103 +254,251 @@ def get_players():
         else:
             return None
 
-def extract_battles(battles):
+def load_card_catalog():
     """
-    Processes the output of get_battles. Returns a list of dictionaries, containing battle data.
+    Loads the "cards" table into the in-process card catalog.
+    """
+    with create_connection() as cnx:
+        result = select_with_error_handling(cnx, "SELECT id, name FROM cards", None, "load_card_catalog")
+    with _cards_lock:
+        for card_id, card_name in result or []:
+            _card_names_by_id[card_id] = card_name
+            _card_ids_by_name[card_name] = card_id
+
+def get_card_names_by_id():
     """
-    player_ids = set()
+    Returns a dictionary mapping card ids to card names, read from the "cards" table.
+    """
+    load_card_catalog()
+    with _cards_lock:
+        return dict(_card_names_by_id)
+
+def get_card_ids(card_names):
+    """
+    Returns the card ids for the given card names. Unknown cards are added to the "cards" table first.
+    The catalog is written on its own connection, so a rolled back battle insert never leaves
+    a cached card id behind that does not exist in the database. On SQLite that write waits for a write
+    transaction open on the same thread, so callers register their cards before they start one.
+    """
+    missing = [card_name for card_name in set(card_names) if card_name not in _card_ids_by_name]
+    if missing:
+        with create_connection() as cnx:
+            query = "INSERT IGNORE INTO cards (name) VALUES (%s)"
+            insert_with_error_handling(cnx, query, [(card_name,) for card_name in missing])
+        load_card_catalog()
+    return [_card_ids_by_name[card_name] for card_name in card_names]
 
-    # Extract player IDs from battles
-    for battle_info in battles:
-        player_ids.add(battle_info[3])  # Player 1 ID
-        player_ids.add(battle_info[10])  # Player 2 ID
+def decode_deck(card_ids):
+    """
+    Decodes the comma separated card ids returned by the battle queries into a list of card names.
+    """
+    if not card_ids:
+        return []
+    card_ids = [int(card_id) for card_id in card_ids.split(",")]
+    if any(card_id not in _card_names_by_id for card_id in card_ids):
+        load_card_catalog()
+    return [_card_names_by_id.get(card_id, "Unknown") for card_id in card_ids]
 
-    # Fetch player names in a batch
-    player_names = {player_id: get_player_name_by_id(player_id) for player_id in player_ids}
+def encode_deck(card_names):
+    """
+    Returns the card ids of a decoded deck. Cards missing from the catalog are encoded as 0.
+    """
+    return [_card_ids_by_name.get(card_name, 0) for card_name in card_names]
 
-    # Process battles with cached player names
+@metrics.timed
+def extract_battles(battles):
+    """
+    Processes the output of get_battles. Returns a list of dictionaries, containing battle data.
+    The battle queries already join both player names, so no further lookups are necessary.
+    """
     battles_data = [{
         "time": battle_info[0],
         "game_mode": battle_info[1],
         "player1_crowns": battle_info[2],
-        "player1_name": player_names.get(battle_info[3], "Unknown"),  # Default to "Unknown" if name not found
+        "player1_name": battle_info[3],
         "player1_king_hp": battle_info[4],
         "player1_princess1_hp": battle_info[5],
         "player1_princess2_hp": battle_info[6],
         "player1_elixir_leaked": battle_info[7],
-        "player1_deck_string": battle_info[8],
+        "player1_deck": decode_deck(battle_info[8]),
         "player2_crowns": battle_info[9],
-        "player2_name": player_names.get(battle_info[10], "Unknown"),
+        "player2_name": battle_info[10],
         "player2_king_hp": battle_info[11],
         "player2_princess1_hp": battle_info[12],
         "player2_princess2_hp": battle_info[13],
         "player2_elixir_leaked": battle_info[14],
-        "player2_deck_string": battle_info[15],
+        "player2_deck": decode_deck(battle_info[15]),
+        "id": battle_info[16],
     } for battle_info in battles]
 
     return battles_data
 
-def get_query_and_params(latest_battle_time, game_mode, player_tag, enemy_tag, limit):
-    """
-    Generate a tuple of SQL query and its parameters based on input arguments.
-    """
-    query_params_dict = {
-        # All battles
-        (True, True, True, False) : (sql.ALL_BATTLES, ()),
-        # All battles with limit
-        (True, True, True, True) : (sql.ALL_BATTLES_WITH_LIMIT, (latest_battle_time,)),
-
-        # Battles by game_mode
-        (False, True, True, False) : (sql.BATTLES_BY_GAME_MODE, (game_mode,)),
-        # Battles by game_mode with limit
-        (False, True, True, True) : (sql.BATTLES_BY_GAME_MODE_WITH_LIMIT, (latest_battle_time, game_mode,)),
-        
-        # player_tag
-        (True, False, True, False) : (sql.BATTLES_BY_PLAYER_TAG_NO_LIMIT, (latest_battle_time, player_tag,)),
-        # player_tag with limit
-        (True, False, True, True) : (sql.BATTLES_BY_PLAYER_TAG, (latest_battle_time, player_tag,)),
-        
-        
-        # player_tag, game_mode 
-        (False, False, True, False) : (sql.BATTLES_BY_PLAYER_TAG_BY_GAME_MODE_NO_LIMIT, (latest_battle_time, player_tag, game_mode,)),
-        # player_tag, game_mode with limit
-        (False, False, True, True) : (sql.BATTLES_BY_PLAYER_TAG_BY_GAME_MODE, (latest_battle_time, player_tag, game_mode,)),
-       
-        # player_tag, enemy_tag
-        (True, False, False, False) : (sql.BATTLES_BY_PLAYER_TAG_BY_ENEMY_TAG_NO_LIMIT, (latest_battle_time, player_tag, enemy_tag)),
-        # player_tag, enemy_tag with limit
-        (True, False, False, True) : (sql.BATTLES_BY_PLAYER_TAG_BY_ENEMY_TAG, (latest_battle_time, player_tag, enemy_tag)),
-        
-        # player_tag, game_mode, enemy_tag
-        (False, False, False, False) : (sql.BATTLES_BY_PLAYER_TAG_BY_GAME_MODE_BY_ENEMY_TAG_NO_LIMIT, (latest_battle_time, player_tag, enemy_tag, game_mode,)),
-        # player_tag, game_mode, enemy_tag with limit
-        (False, False, False, True) : (sql.BATTLES_BY_PLAYER_TAG_BY_GAME_MODE_BY_ENEMY_TAG, (latest_battle_time, player_tag, enemy_tag, game_mode,)),
-    }
-    (query, params) = query_params_dict[(game_mode == "ALL", player_tag is None, enemy_tag is None, limit)]
-    return query, params
+def build_battles_query(game_mode="ALL", player_tag=None, enemy_tag=None, before=None, page_size=None, since=None, until=None):
+    """
+    Builds the SQL query and its parameters for the battles matching the given filters.
+    since and until restrict the battle times to the half-open range [since, until).
 
-def get_battles(latest_battle_time="2200-12-31", game_mode="ALL", player_tag=None, enemy_tag=None, limit=True):
-    
+    before is a (time, id) keyset cursor of the last battle of the previous page. Battles are ordered
+    by (time, id), so battles with the same time are neither skipped nor repeated across pages.
+    page_size limits the number of returned battles, None returns all of them.
+    """
+    conditions = []
+    params = []
+    if player_tag is None:
+        # every battle is returned once, with the player of the lower id as player 1
+        conditions.append("s1.player_id < s2.player_id")
+    else:
+        conditions.append("p1.tag = %s")
+        params.append(player_tag)
+    if enemy_tag is not None:
+        conditions.append("p2.tag = %s")
+        params.append(enemy_tag)
+    if game_mode != "ALL":
+        conditions.append("b.game_mode = %s")
+        params.append(game_mode)
+    if before is not None:
+        before_time, before_id = before
+        # the leading range on b.time lets the index scan start at the cursor instead of merging two scans
+        conditions.append("b.time <= %s AND (b.time < %s OR b.id < %s)")
+        params.extend([before_time, before_time, before_id])
+    if since is not None:
+        conditions.append("b.time >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("b.time < %s")
+        params.append(until)
+
+    join = "STRAIGHT_JOIN" if player_tag is None and enemy_tag is None else "JOIN"
+    query = sql.BATTLES_SELECT.format(join=join) + "WHERE " + "\nAND ".join(conditions) + sql.BATTLES_ORDER
+    if page_size is not None:
+        query += "LIMIT %s"
+        params.append(page_size)
+    return query, tuple(params)
+
+def get_latest_battle():
+    """
+    Retrieves the id and time of the latest battle as a dictionary.
+    """
+    with create_connection() as cnx:
+        query = "SELECT id, time FROM battles ORDER BY time DESC, id DESC LIMIT 1"
+        result = select_with_error_handling(cnx, query, None, "get_latest_battle")
+        if result:
+            return {"latest_battle_id": result[0][0], "latest_battle_time": str(result[0][1])}
+        else:
+            return {"latest_battle_id": None, "latest_battle_time": None}
+
+@metrics.timed
+def get_battles(before=None, game_mode="ALL", player_tag=None, enemy_tag=None, limit=True, page_size=PAGE_SIZE, since=None, until=None):
     """
     Retrieves a list of battle information dictionaries for the given parameters.
+    If limit is True, a single page of page_size battles after the (time, id) cursor before is returned.
+    Consumers of the whole history should use stream_battles instead of limit=False.
     """
     with create_connection() as cnx:
         try:
             with cnx.cursor() as cursor:
-                query, params = get_query_and_params(latest_battle_time, game_mode, player_tag, enemy_tag, limit)
+                query, params = build_battles_query(game_mode, player_tag, enemy_tag, before, page_size if limit else None, since, until)
+                start = time.perf_counter()
                 cursor.execute(query, params)
-                logger.info(f"Query executed: {query}")
-                logger.info(f"Parameters: {params}")
+                log_query(logger, query, params)
                 battles = cursor.fetchall()
+                observe_query("get_battles", query, params, time.perf_counter() - start, len(battles))
                 battles_data = extract_battles(battles)
                 return battles_data
         except TypeError as e:
-            # Example: Error:  403 Client Error: Forbidden for url: https://api.clashroyale.com/v1/players/%23UURVVJQJ/battlelog
-            # Authentication failed
-            logger.critical("Type Error:", str(e))
-        except mysql.connector.Error as e:
-            logger.critical("Error:", str(e))
+            logger.critical(f"Type Error: {e}")
+            cache.mark_failed()
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cache.mark_failed()
+
+def iter_battles(game_mode="ALL", player_tag=None, enemy_tag=None, since=None, until=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    Yields all battles matching the filters as lists of up to batch_size battle dictionaries, newest first.
+    Every batch is a keyset page of its own query, so memory use does not depend on the number of battles
+    and no connection is held while the consumer processes a batch.
+    Raises RuntimeError if a batch cannot be read, so consumers never mistake a failed query for the end of the history.
+    """
+    before = None
+    while True:
+        batch = get_battles(before, game_mode=game_mode, player_tag=player_tag, enemy_tag=enemy_tag,
+                            page_size=batch_size, since=since, until=until)
+        if batch is None:
+            raise RuntimeError(f"Could not read the battles before {before}")
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        before = (batch[-1]["time"], batch[-1]["id"])
+
+def stream_battles(game_mode="ALL", player_tag=None, enemy_tag=None, since=None, until=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    Yields all battles matching the filters one by one, newest first.
+    Streaming counterpart of get_battles(limit=False) for consumers that aggregate the whole history:
+    at most batch_size battles are held in memory at a time.
+    """
+    for batch in iter_battles(game_mode, player_tag, enemy_tag, since, until, batch_size):
+        yield from batch
+
+def iter_scores(query, after_score_id=0, batch_size=SCORE_FETCH_SIZE):
+    """
+    Yields the rows of a score query (see sql.DECKS) for all scores with an id greater than after_score_id
+    as lists of up to batch_size rows. The score id is the first column, the batches are keyset pages.
+    """
+    while True:
+        with create_connection() as cnx:
+            rows = select_with_error_handling(cnx, query, (after_score_id, batch_size), "iter_scores")
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        after_score_id = rows[-1][0]
+
+def iter_decks(after_score_id=0, batch_size=SCORE_FETCH_SIZE):
+    """
+    Yields the decks of all scores with an id greater than after_score_id, ordered by score id, as lists of
+    up to batch_size (score id, game mode, won, comma separated card ids, card ids of the opponent) tuples.
+    """
+    for rows in iter_scores(sql.DECKS, after_score_id, batch_size):
+        yield [(score_id, game_mode, crowns > opponent_crowns, card_ids, opponent_card_ids)
+               for score_id, game_mode, crowns, opponent_crowns, card_ids, opponent_card_ids in rows]
+
+def create_battle_indexes():
+    """
+    Adds the indexes of the battle queries to databases created before they were part of the table definitions.
+    """
+    with create_connection() as cnx:
+        with cnx.cursor() as cursor:
+            for query in sql.BATTLE_INDEXES:
+                create_index(cursor, query)
 
+def explain_battles_queries():
+    """
+    Runs EXPLAIN for every filter combination of build_battles_query and returns the query plans.
+    Logs a warning for every table that is accessed with a full table scan. MySQL only,
+    the SQLite plans are checked by tests/test_query_plans.py.
+    """
+    if storage.backend.name != "mysql":
+        logger.warning("explain_battles_queries() is only supported by the MySQL backend")
+        return {}
+    plans = {}
+    with create_connection() as cnx:
+        for game_mode in ("ALL", ALLOWED_BATTLE_MODES[0]):
+            for player_tag, enemy_tag in ((None, None), ("#PLAYER", None), ("#PLAYER", "#ENEMY")):
+                query, params = build_battles_query(game_mode, player_tag, enemy_tag,
+                                                    before=("2200-12-31", 0), page_size=PAGE_SIZE)
+                with cnx.cursor(dictionary=True) as cursor:
+                    cursor.execute("EXPLAIN " + query, params)
+                    plan = cursor.fetchall()
+                plans[(game_mode, player_tag, enemy_tag)] = plan
+                for row in plan:
+                    if row["type"] == "ALL":
+                        logger.warning(f"Full table scan on {row['table']} for filters {(game_mode, player_tag, enemy_tag)}")
+    return plans
+
+@metrics.timed
 def parse_princess_tower_hp(princess_tower_hp):
     """
     Parses the princess tower HP data and extracts the individual tower HP values.
@@ -309,185 +511,870 @@ def parse_princess_tower_hp(princess_tower_hp):
     else:
         return princess_tower_hp[0], princess_tower_hp[1]
 
-def insert_members():
+def insert_members(clan_members=None):
     """
     Fetches clan members (tag, name) from API, 
-    inserts them into the database"s players table.
+    inserts them into the database"s players table with zeroed counters.
+    Already fetched members can be passed as clan_members.
     """
-    clan_members = api.fetch_clan_members()
+    if clan_members is None:
+        clan_members = api.fetch_clan_members()
     with create_connection() as cnx:
-        query = "INSERT INTO players (tag, name) VALUES (%s, %s)"
+        # written explicitly, tables of older versions have no default for the counters
+        query = ("INSERT INTO players (tag, name, `1v1_battle_count`, `1v1_win_count`, `1v1_three_crowns_win_count`) "
+                 "VALUES (%s, %s, 0, 0, 0)")
         insert_with_error_handling(cnx, query, clan_members, recursive_insertion=True)
+    cache.bump_generation()
 
-def insert_battle(cursor, battle_info):
+def get_last_battle_times():
     """
-    Inserts a battle record into the "battles" table.
+    Retrieves a dictionary mapping player tags to the time of their latest battle in the database.
+    Players without battles are missing.
     """
-    query = "INSERT INTO battles (time, type, game_mode) VALUES (%s, %s, %s)"
-    try:
-        cursor.execute(query, battle_info[:3])
-        return True
-    except mysql.connector.Error as e:
-        logger.critical(f"Error: {e}")
-        return False
+    with create_connection() as cnx:
+        result = select_with_error_handling(cnx, sql.LAST_BATTLE_TIMES, None, "get_last_battle_times")
+        return {tag: datetime.fromisoformat(str(time)) for tag, time in result or []}
 
-def insert_score(cursor, player_data, player_deck, battle_id):
+def get_player_ids():
+    """
+    Retrieves a dictionary mapping player names to player ids from the "players" table.
     """
-    Inserts a score record into the "scores" table.
+    with create_connection() as cnx:
+        result = select_with_error_handling(cnx, "SELECT name, id FROM players", None, "get_player_ids")
+        return dict(result) if result else {}
+
+def score_values(player_data):
     """
-    query = """
-    INSERT INTO scores (crowns, king_tower_hp, princess_tower_1_hp, princess_tower_2_hp,
-                        elixir_leaked, deck_string, battle_id, player_id)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    Returns the (crowns, king_tower_hp, princess_tower_1_hp, princess_tower_2_hp, elixir_leaked) values
+    of a "scores" row for the player data of a battle log entry.
     """
-    name = player_data[0]
-    crowns = player_data[1]
-    elixir_leaked = player_data[2]
-    king_tower_hp = player_data[3]
     princess_tower_1_hp, princess_tower_2_hp = parse_princess_tower_hp(str(player_data[4]))
-    player_id = get_player_id_by_name(name)
+    return (player_data[1], player_data[3], princess_tower_1_hp, princess_tower_2_hp, player_data[2])
+
+def in_placeholders(values):
+    """
+    Returns the "%s, %s, ..." placeholder list for an IN clause with the given values.
+    """
+    return ", ".join(["%s"] * len(values))
+
+def insert_battles(cursor, battles):
+    """
+    Inserts a batch of battles with their scores and decks using multi-row inserts.
+    Must be called inside a transaction. Returns the ids of the inserted battles.
+    """
+    cursor.executemany(sql.INSERT_BATTLE, [battle["info"][:3] + battle["key"][:2] for battle in battles])
+
+    # battle keys are unique, so the new battle ids can be resolved with a single query
+    times = [battle["info"][0] for battle in battles]
+    cursor.execute(f"SELECT player_low_id, player_high_id, time, id FROM battles WHERE time IN ({in_placeholders(times)})", times)
+    battle_ids = {battle_key(str(time), player_low_id, player_high_id): battle_id
+                  for player_low_id, player_high_id, time, battle_id in cursor.fetchall()}
+    battle_ids = [battle_ids[battle["key"]] for battle in battles]
+
+    score_params = []
+    for battle, battle_id in zip(battles, battle_ids):
+        for player_id, player_data in ((battle["player1_id"], battle["player1_data"]),
+                                       (battle["player2_id"], battle["player2_data"])):
+            score_params.append(score_values(player_data) + (battle_id, player_id))
+    cursor.executemany(sql.INSERT_SCORE, score_params)
+
+    cursor.execute(f"SELECT battle_id, player_id, id FROM scores WHERE battle_id IN ({in_placeholders(battle_ids)})", battle_ids)
+    score_ids = {(battle_id, player_id): score_id for battle_id, player_id, score_id in cursor.fetchall()}
+
+    score_cards_params = []
+    for battle, battle_id in zip(battles, battle_ids):
+        for player_id, deck in ((battle["player1_id"], battle["player1_deck"]),
+                                (battle["player2_id"], battle["player2_deck"])):
+            score_id = score_ids[(battle_id, player_id)]
+            score_cards_params.extend((score_id, slot, card_id) for slot, card_id in enumerate(get_card_ids(deck)))
+    cursor.executemany(sql.INSERT_SCORE_CARDS, score_cards_params)
+    return battle_ids
+
+def count_card_stats(game_mode, player1_deck, player2_deck, player1_crowns, player2_crowns):
+    """
+    Returns the card_stats rows (game_mode, card_name, battle_count, win_count) for a single battle.
+    """
+    battle_counts = Counter(player1_deck + player2_deck)
+    win_counts = Counter()
+    if player1_crowns > player2_crowns:
+        win_counts.update(player1_deck)
+    elif player2_crowns > player1_crowns:
+        win_counts.update(player2_deck)
+    return [(game_mode, card_name, count, win_counts[card_name]) for card_name, count in battle_counts.items()]
+
+def count_player_infos(battles):
+    """
+    Returns the increments of the player counters as (battle_count, win_count, three_crowns_win_count, player_id) rows.
+    """
+    battle_counts = Counter()
+    win_counts = Counter()
+    three_crowns_win_counts = Counter()
+    for battle in battles:
+        player1_crowns = battle["player1_data"][1]
+        player2_crowns = battle["player2_data"][1]
+        for player_id, crowns, enemy_crowns in ((battle["player1_id"], player1_crowns, player2_crowns),
+                                                (battle["player2_id"], player2_crowns, player1_crowns)):
+            battle_counts[player_id] += 1
+            if crowns > enemy_crowns:
+                win_counts[player_id] += 1
+                if crowns == 3:
+                    three_crowns_win_counts[player_id] += 1
+    return [(count, win_counts[player_id], three_crowns_win_counts[player_id], player_id)
+            for player_id, count in battle_counts.items()]
+
+def update_player_counters(cursor, rows):
+    """
+    Adds the given (battle_count, win_count, three_crowns_win_count, player_id) rows to the player counters.
+    Must be called inside the transaction that writes the corresponding battles.
+    """
+    if rows:
+        cursor.executemany(sql.INCREMENT_PLAYER_INFOS, rows)
+
+def count_head_to_head(battles):
+    """
+    Returns the increments of the head-to-head matrix as
+    (player_id, opponent_id, game_mode, battle_count, win_count, three_crowns_win_count) rows.
+    Every battle is counted from the view of both players.
+    """
+    counts = {}
+    for battle in battles:
+        game_mode = battle["info"][2]
+        player1_crowns = battle["player1_data"][1]
+        player2_crowns = battle["player2_data"][1]
+        for player_id, opponent_id, crowns, enemy_crowns in (
+                (battle["player1_id"], battle["player2_id"], player1_crowns, player2_crowns),
+                (battle["player2_id"], battle["player1_id"], player2_crowns, player1_crowns)):
+            row = counts.setdefault((player_id, opponent_id, game_mode), [0, 0, 0])
+            row[0] += 1
+            if crowns > enemy_crowns:
+                row[1] += 1
+                if crowns >= 3:
+                    row[2] += 1
+    return [key + tuple(row) for key, row in counts.items()]
+
+def update_head_to_head(cursor, rows):
+    """
+    Adds the given rows to the "head_to_head" table.
+    Must be called inside the transaction that writes the corresponding battles.
+    """
+    if rows:
+        cursor.executemany(sql.UPSERT_HEAD_TO_HEAD, rows)
+
+def rebuild_head_to_head():
+    """
+    Recomputes the "head_to_head" table from the whole battle history with a single set-based statement.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cnx.start_transaction()
+                cursor.execute("DELETE FROM head_to_head")
+                cursor.execute(sql.REBUILD_HEAD_TO_HEAD)
+                log_query(logger, sql.REBUILD_HEAD_TO_HEAD)
+            cnx.commit()
+            cache.bump_generation()
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
+
+def sum_card_stats(rows):
+    """
+    Sums up card_stats rows (game_mode, card_name, battle_count, win_count) of the same card and game mode.
+    """
+    battle_counts = Counter()
+    win_counts = Counter()
+    for game_mode, card_name, battle_count, win_count in rows:
+        battle_counts[(game_mode, card_name)] += battle_count
+        win_counts[(game_mode, card_name)] += win_count
+    return [(game_mode, card_name, count, win_counts[(game_mode, card_name)])
+            for (game_mode, card_name), count in battle_counts.items()]
+
+def update_card_stats(cursor, rows):
+    """
+    Adds the given (game_mode, card_name, battle_count, win_count) rows to the "card_stats" table.
+    Must be called inside the transaction that writes the corresponding battles.
+    """
+    if rows:
+        cursor.executemany(sql.UPSERT_CARD_STATS, rows)
+
+def rebuild_card_stats():
+    """
+    Recomputes the "card_stats" table from the whole battle history.
+    Only needed once to backfill the table or after manual changes to the battle data.
+    The history is streamed, so only the aggregated counts are kept in memory.
+    """
     try:
-        cursor.execute(query, (crowns, king_tower_hp, princess_tower_1_hp, princess_tower_2_hp,
-                                   elixir_leaked, player_deck, battle_id, player_id))
-    except mysql.connector.Error as e:
+        params = sum_card_stats(row for battle in stream_battles()
+                                for row in count_card_stats(battle["game_mode"],
+                                                            battle["player1_deck"],
+                                                            battle["player2_deck"],
+                                                            battle["player1_crowns"],
+                                                            battle["player2_crowns"]))
+    except RuntimeError as e: # a partial history must not replace the counts
         logger.critical(f"Error: {e}")
+        return
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cnx.start_transaction()
+                cursor.execute("DELETE FROM card_stats")
+                update_card_stats(cursor, params)
+            cnx.commit()
+            cache.bump_generation()
+            logger.info(f"Rebuilt card_stats with {len(params)} rows")
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
 
-def check_for_battle_duplicate(time, player1_id, player2_id):
+def rollup_buckets(time):
     """
-    Check for duplicate battles in the "battles" table based on the provided time,
-    player1_id, and player2_id. 
-    
-    This method is necessary due to a bug in the clash royale system:
-    Sometimes the time of battles can differ by 1 second in the battle logs of different players.
+    Returns the ("day", day) and ("week", monday) buckets of the rollup tables a battle time belongs to.
+    """
+    day = date.fromisoformat(str(time)[:10])
+    return (("day", day), ("week", day - timedelta(days=day.weekday())))
+
+def count_rollups(scores):
+    """
+    Returns the increments of the "player_rollups" and "card_rollups" tables for the given
+    (time, game_mode, player_id, crowns, opponent_crowns, card_ids) scores as two lists of rows.
+    """
+    player_counts = {}
+    card_counts = {}
+    for time, game_mode, player_id, crowns, opponent_crowns, card_ids in scores:
+        won = crowns > opponent_crowns
+        for period, bucket in rollup_buckets(time):
+            row = player_counts.setdefault((period, bucket, player_id, game_mode), [0, 0, 0])
+            row[0] += 1
+            if won:
+                row[1] += 1
+                if crowns >= 3:
+                    row[2] += 1
+            for card_id in card_ids:
+                row = card_counts.setdefault((period, bucket, card_id, game_mode), [0, 0])
+                row[0] += 1
+                row[1] += won
+    return ([key + tuple(row) for key, row in player_counts.items()],
+            [key + tuple(row) for key, row in card_counts.items()])
+
+def rollup_scores(battles):
+    """
+    Yields both scores of the given battles in the input format of count_rollups.
+    """
+    for battle in battles:
+        time, _, game_mode = battle["info"][:3]
+        player1_crowns = battle["player1_data"][1]
+        player2_crowns = battle["player2_data"][1]
+        yield time, game_mode, battle["player1_id"], player1_crowns, player2_crowns, get_card_ids(battle["player1_deck"])
+        yield time, game_mode, battle["player2_id"], player2_crowns, player1_crowns, get_card_ids(battle["player2_deck"])
+
+def update_rollups(cursor, player_rows, card_rows):
+    """
+    Adds the given rows to the "player_rollups" and "card_rollups" tables.
+    Must be called inside the transaction that writes the corresponding battles.
+    """
+    if player_rows:
+        cursor.executemany(sql.UPSERT_PLAYER_ROLLUPS, player_rows)
+    if card_rows:
+        cursor.executemany(sql.UPSERT_CARD_ROLLUPS, card_rows)
+
+def rebuild_rollups():
+    """
+    Recomputes the rollup tables from the whole battle history.
+    Only needed once to backfill the tables or after manual changes to the battle data.
+    The scores are read in batches, so only the aggregated counts are kept in memory.
+    """
+    scores = ((time, game_mode, player_id, crowns, opponent_crowns,
+               [int(card_id) for card_id in card_ids.split(",")] if card_ids else [])
+              for rows in iter_scores(sql.ROLLUP_SCORES)
+              for _, time, game_mode, player_id, crowns, opponent_crowns, card_ids in rows)
+    player_rows, card_rows = count_rollups(scores)
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cnx.start_transaction()
+                cursor.execute("DELETE FROM player_rollups")
+                cursor.execute("DELETE FROM card_rollups")
+                update_rollups(cursor, player_rows, card_rows)
+            cnx.commit()
+            cache.bump_generation()
+            logger.info(f"Rebuilt the rollups with {len(player_rows)} player and {len(card_rows)} card rows")
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
+
+def rollup_ranges(since, until):
+    """
+    Splits the date range [since, until) into (period, first bucket, end) ranges of the rollup tables:
+    the whole weeks are read from the weekly buckets, the remaining days at both ends from the daily buckets.
+    Any range is covered by the weeks in between and at most 12 days.
+    """
+    first_monday = since + timedelta(days=-since.weekday() % 7)
+    last_monday = until - timedelta(days=until.weekday())
+    if first_monday >= last_monday:
+        return [("day", since, until)]
+    return [("day", since, first_monday), ("week", first_monday, last_monday), ("day", last_monday, until)]
+
+def get_rollup_series(query, ranges, game_mode="ALL", player_tag=None, group_by=("r.period", "r.bucket")):
+    """
+    Executes a rollup series query of sql_statements.py for the given bucket ranges (see rollup_ranges).
+    """
+    conditions = ["(" + " OR ".join("(r.period = %s AND r.bucket >= %s AND r.bucket < %s)" for _ in ranges) + ")"]
+    params = [value for bucket_range in ranges for value in bucket_range]
+    for condition, value in (("r.game_mode = %s", None if game_mode == "ALL" else game_mode),
+                             ("p.tag = %s", player_tag)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    query += "WHERE " + "\nAND ".join(conditions) + "\nGROUP BY " + ", ".join(group_by)
+    with create_connection() as cnx:
+        return select_with_error_handling(cnx, query, tuple(params), "get_rollup_series") or []
+
+def get_player_series(player_tag, period, since, until, game_mode="ALL"):
+    """
+    Returns the battle, win and three crowns win counts of a player per day or week bucket in [since, until)
+    as a dictionary mapping the first day of each bucket to a tuple. Buckets without battles are missing.
+    """
+    rows = get_rollup_series(sql.PLAYER_ROLLUP_SERIES, [(period, since, until)], game_mode, player_tag)
+    return {date.fromisoformat(str(bucket)): (int(battle_count), int(win_count), int(three_crowns_win_count))
+            for _, bucket, battle_count, win_count, three_crowns_win_count in rows}
+
+def get_player_totals(player_tag, since, until, game_mode="ALL"):
+    """
+    Returns the battle count, win count and three crowns win count of a player in the date range [since, until).
+    """
+    rows = get_rollup_series(sql.PLAYER_ROLLUP_SERIES, rollup_ranges(since, until), game_mode, player_tag)
+    totals = [sum(int(row[column]) for row in rows) for column in (2, 3, 4)]
+    return dict(zip(("battle_count", "win_count", "three_crowns_win_count"), totals))
+
+def get_card_series(period, since, until, game_mode="ALL"):
     """
-    # Prepare datetime variables
-    datetime_format = "%Y-%m-%d %H:%M:%S"
-    datetime_object = datetime.strptime(time, datetime_format)
-    time_plus_1 = datetime_object + timedelta(seconds=1)
-    time_plus_1 = iso8601_to_datetime(str(time_plus_1), datetime_format)
-    time_minus_1 = datetime_object - timedelta(seconds=1)
-    time_minus_1 = iso8601_to_datetime(str(time_minus_1), datetime_format)
-    # Query
-    with create_connection() as cnx:
-        query = sql.BATTLE_QUERY_FOR_DUPLICATION_CHECK
-        query = query.format(time_plus_1, time_minus_1)
-        result = select_with_error_handling(cnx, query, None)
+    Returns the battle and win counts of all cards per day or week bucket in [since, until) as a dictionary
+    mapping the first day of each bucket to a dictionary of card names and (battle_count, win_count) tuples.
+    """
+    series = {}
+    for _, bucket, card_name, battle_count, win_count in get_rollup_series(
+            sql.CARD_ROLLUP_SERIES, [(period, since, until)], game_mode, group_by=("r.period", "r.bucket", "c.name")):
+        series.setdefault(date.fromisoformat(str(bucket)), {})[card_name] = (int(battle_count), int(win_count))
+    return series
+
+def get_card_totals(since, until, game_mode="ALL"):
+    """
+    Returns the battle and win counts of all cards in the date range [since, until) as a dictionary
+    mapping card names to (battle_count, win_count) tuples.
+    """
+    totals = {}
+    for _, _, card_name, battle_count, win_count in get_rollup_series(
+            sql.CARD_ROLLUP_SERIES, rollup_ranges(since, until), game_mode, group_by=("r.period", "r.bucket", "c.name")):
+        card_battle_count, card_win_count = totals.get(card_name, (0, 0))
+        totals[card_name] = (card_battle_count + int(battle_count), card_win_count + int(win_count))
+    return totals
+
+def get_deck_series(period, since, until, game_mode="ALL"):
+    """
+    Returns the number of played decks (two per battle) per day or week bucket in [since, until)
+    as a dictionary mapping the first day of each bucket to the deck count.
+    """
+    rows = get_rollup_series(sql.DECK_ROLLUP_SERIES, [(period, since, until)], game_mode)
+    return {date.fromisoformat(str(bucket)): int(deck_count) for _, bucket, deck_count in rows}
+
+def get_card_stats(game_mode="ALL"):
+    """
+    Retrieves the battle and win counts per card from the "card_stats" table.
+    Returns a dictionary mapping card names to (battle_count, win_count) tuples.
+    """
+    with create_connection() as cnx:
+        if game_mode == "ALL":
+            result = select_with_error_handling(cnx, sql.CARD_STATS_ALL_GAME_MODES, None, "get_card_stats")
+        else:
+            result = select_with_error_handling(cnx, sql.CARD_STATS_BY_GAME_MODE, (game_mode,), "get_card_stats")
         if result:
-            player1_idx = result[0][3]
-            player2_idx = result[0][10]
-            if (player1_id == player1_idx or player1_id == player2_idx) and (player2_id == player1_idx or player2_id == player2_idx):
-                logger.critical("Duplicate found. Insertion of battle and scores will be aborted for this battle.")
-                return True
-        return False
+            return {card_name: (int(battle_count), int(win_count)) for card_name, battle_count, win_count in result}
+        else:
+            return {}
 
-def insert_new_battles():
+def battle_key(time, player1_id, player2_id):
     """
-    Inserts new battles into the system. Skips battles that are already in the database.
+    Returns the deduplication key (lower player id, higher player id, time) of a battle.
+    The key does not depend on whose battle log the battle was taken from.
+    """
+    if isinstance(time, str):
+        time = datetime.strptime(time, DATETIME_FORMAT)
+    return (min(player1_id, player2_id), max(player1_id, player2_id), time)
 
-    Retrieves player tags, fetches battles for each player, and inserts the battles and scores into the 
-    corresponding table.
+def is_known_battle(known_keys, key):
     """
-    player_tags = get_player_tags()
-    for player_tag in player_tags:
-        battles = api.fetch_battle_log(player_tag)
-        # if api key doesn"t allow current ip addr, then battles will have the error: TypeError: "NoneType" object is not iterable
+    Checks if a battle key is in the set of known battle keys.
+
+    A tolerance of 1 second is necessary due to a bug in the clash royale system:
+    Sometimes the time of battles can differ by 1 second in the battle logs of different players.
+    """
+    player_low_id, player_high_id, time = key
+    return any((player_low_id, player_high_id, time + offset) in known_keys for offset in DUPLICATE_TOLERANCE)
+
+def load_battle_keys(start_time, end_time):
+    """
+    Loads the keys of all battles between start_time and end_time (inclusive, with 1 second tolerance)
+    from the database into a set.
+    """
+    with create_connection() as cnx:
+        query = "SELECT player_low_id, player_high_id, time FROM battles WHERE time BETWEEN %s AND %s"
+        params = (start_time - timedelta(seconds=1), end_time + timedelta(seconds=1))
+        result = select_with_error_handling(cnx, query, params, "load_battle_keys")
+        return set(result) if result else set()
+
+def remove_duplicate_battles(battles):
+    """
+    Removes battles that are already in the database or that occur twice in the given battles
+    with a time difference of up to 1 second. The database is only queried once for the whole time window.
+    """
+    if not battles:
+        return []
+    times = [battle["key"][2] for battle in battles]
+    known_keys = load_battle_keys(min(times), max(times))
+    new_battles = []
+    for battle in battles:
+        key = battle["key"]
+        if is_known_battle(known_keys, key):
+            logger.info(f"Duplicate found. Insertion of battle at {key[2]} will be skipped.")
+            continue
+        known_keys.add(key)
+        new_battles.append(battle)
+    return new_battles
+
+def collect_new_battles(battle_logs, player_ids):
+    """
+    Collects the allowed battles of all battle logs in a dictionary. Every battle appears in the
+    battle logs of both players, so battles are deduplicated by their battle_key.
+    """
+    new_battles = {}
+    for player_tag, battles in battle_logs:
+        # if api key doesn"t allow current ip addr, then battles will be None
+        if battles is None:
+            logger.critical(f"Could not fetch battle log of player {player_tag}")
+            continue
         for battle in battles:
             battle_info = battle[0]
             if not (battle_info[1] == ALLOWED_BATTLE_TYPE and battle_info[2] in ALLOWED_BATTLE_MODES):
                 logger.warning("Battle type or game mode not allowed")
                 continue
-            
-            time = battle_info[0]
+
             player1_data = battle[1][0]
-            player1_deck = str(battle[2])
             player2_data = battle[3][0]
-            player2_deck = str(battle[4])
-            player1_id = get_player_id_by_name(player1_data[0])
-            player2_id = get_player_id_by_name(player2_data[0])
-            found_duplicate = check_for_battle_duplicate(time, player1_id, player2_id)
-            
-            if found_duplicate:
+            player1_id = player_ids.get(player1_data[0])
+            player2_id = player_ids.get(player2_data[0])
+            if player1_id is None or player2_id is None:
+                logger.warning(f"Unknown player in battle at {battle_info[0]}. Battle will be skipped")
                 continue
 
-            with create_connection() as cnx:
+            key = battle_key(battle_info[0], player1_id, player2_id)
+            new_battles.setdefault(key, {
+                "key": key,
+                "info": battle_info,
+                "player1_id": player1_id,
+                "player1_data": player1_data,
+                "player1_deck": battle[2],
+                "player2_id": player2_id,
+                "player2_data": player2_data,
+                "player2_deck": battle[4],
+            })
+    return list(new_battles.values())
+
+def write_battles(battles, batch_size=WRITE_BATCH_SIZE, failed=None):
+    """
+    Writes the given battles, their scores, the card statistics, the player counters, the head-to-head matrix
+    and the rollups in batches of batch_size battles.
+    Every batch is written in its own transaction. A batch that violates a unique key is written again
+    battle by battle, so only the offending battles are skipped. The battles of batches rolled back because of
+    other database errors are appended to the list failed, if given. Returns the number of inserted battles.
+    """
+    inserted = 0
+    if not battles:
+        return inserted
+    # register all cards of the run up front, so the batches only need cached lookups
+    get_card_ids([card_name for battle in battles for card_name in battle["player1_deck"] + battle["player2_deck"]])
+
+    batches = [battles[start:start + batch_size] for start in range(0, len(battles), batch_size)]
+    with create_connection() as cnx:
+        while batches:
+            batch = batches.pop(0)
+            card_stats_params = sum_card_stats(row for battle in batch
+                                               for row in count_card_stats(battle["info"][2],
+                                                                           battle["player1_deck"],
+                                                                           battle["player2_deck"],
+                                                                           battle["player1_data"][1],
+                                                                           battle["player2_data"][1]))
+            player_params = count_player_infos(batch)
+            head_to_head_params = count_head_to_head(batch)
+            player_rollup_params, card_rollup_params = count_rollups(rollup_scores(batch))
+            try:
                 with cnx.cursor() as cursor:
                     cnx.start_transaction()
-                    success = insert_battle(cursor, battle_info)
-                    
-                    if success:
-                        battle_id = cursor.lastrowid
-                        insert_score(cursor, player1_data, player1_deck, battle_id)
-                        insert_score(cursor, player2_data, player2_deck, battle_id)
-                        cnx.commit()
-                        logger.info(f"Inserted battle with the id:{battle_id} and the corresponding scores")
-                    else:
-                        cnx.rollback()
-                        logger.warning(TX_ROLLBACK_MSG)
+                    battle_ids = insert_battles(cursor, batch)
+                    update_card_stats(cursor, card_stats_params)
+                    update_player_counters(cursor, player_params)
+                    update_head_to_head(cursor, head_to_head_params)
+                    update_rollups(cursor, player_rollup_params, card_rollup_params)
+                cnx.commit()
+                inserted += len(battle_ids)
+                logger.info(f"Inserted {len(battle_ids)} battles and the corresponding scores")
+            except storage.IntegrityError as e:
+                cnx.rollback()
+                logger.warning(TX_ROLLBACK_MSG)
+                if len(batch) > 1:
+                    logger.warning(f"Error: {e}. Writing the batch battle by battle")
+                    batches[:0] = [[battle] for battle in batch]
+                else:
+                    logger.critical(f"Error: {e}. Battle at {batch[0]['info'][0]} will be skipped")
+            except storage.Error as e:
+                logger.critical(f"Error: {e}")
+                cnx.rollback()
+                logger.warning(TX_ROLLBACK_MSG)
+                if failed is not None:
+                    failed.extend(batch)
+    return inserted
 
-def update_player_infos():
+def analyze_tables():
+    """
+    Refreshes the statistics the query planner uses to pick indexes. Called after battles were written.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                storage.backend.analyze(cursor)
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+
+def insert_new_battles():
     """
-    Updates the columns "1v1_battle_count", "1v1_win_count" and "1v1_three_crowns_win_count" 
-    for all players in the "players" table by calculating them from the retrieved data
-    battles data from the database.
+    Inserts new battles into the system. Skips battles that are already in the database.
+
+    Retrieves player tags, fetches battles for each player, and inserts the battles and scores into the 
+    corresponding table.
     """
     player_tags = get_player_tags()
+    player_ids = get_player_ids()
+    candidates = collect_new_battles(api.fetch_battle_logs(player_tags), player_ids)
+    if write_battles(remove_duplicate_battles(candidates)):
+        finish_ingest()
+
+def finish_ingest():
+    """
+    Updates everything that depends on newly written battles: the ratings, the planner statistics
+    and the data generation, which invalidates the read caches and ETags of the web application.
+    """
+    update_ratings()
+    analyze_tables()
+    cache.bump_generation(**get_latest_battle())
+
+def migrate_deck_strings():
+    """
+    One-shot migration of the old "scores.deck_string" column (str(list) of card names)
+    into the "cards" and "score_cards" tables. Drops the column afterwards.
+    Only needed for MySQL databases created by older versions.
+    """
     with create_connection() as cnx:
         try:
-            for player_tag in player_tags:
-                battles = get_battles(player_tag=player_tag, limit=False)
-                battle_count_1v1 = len(battles)
-                win_count_1v1 = 0
-                three_crowns_win_count_1v1 = 0
-
-                for battle in battles:
-                    player_crowns = battle["player1_crowns"]
-                    enemy_crowns = battle["player2_crowns"]
-
-                    if player_crowns > enemy_crowns:
-                        win_count_1v1 += 1
-
-                        if player_crowns == 3:
-                            three_crowns_win_count_1v1 += 1
-                
-                with cnx.cursor() as cursor:
-                    params = (battle_count_1v1, win_count_1v1, three_crowns_win_count_1v1, player_tag)
-                    query = """UPDATE players 
-                    SET 1v1_battle_count = %s, 1v1_win_count = %s, 1v1_three_crowns_win_count = %s 
-                    WHERE tag = %s"""
-                    cursor.execute(query, params)
-                    logger.info(f"Query executed: {query}")
-                    logger.info(f"Parameters: {params}")
+            with cnx.cursor() as cursor:
+                cursor.execute("SHOW COLUMNS FROM scores LIKE 'deck_string'")
+                if not cursor.fetchall():
+                    logger.warning("Column scores.deck_string does not exist. Nothing to migrate")
+                    return
+                cursor.execute(sql.CARDS)
+                cursor.execute(sql.SCORE_CARDS)
+                cursor.execute("SELECT id, deck_string FROM scores")
+                decks = {score_id: ast.literal_eval(deck_string) for score_id, deck_string in cursor.fetchall()}
+                # mysql.connector opened an implicit transaction for the reads, start_transaction would fail on it
                 cnx.commit()
-                logger.info("Updated the columns battle_count, 1v1_win_count and 1v1_three_crowns_win_count for all players")
-        except TypeError as e:
-            # Example: Error:  403 Client Error: Forbidden for url: https://api.clashroyale.com/v1/players/%23UURVVJQJ/battlelog
-            # Authentication failed
-            logger.critical("Type Error:", str(e))
+                card_names = {card_name for deck in decks.values() for card_name in deck}
+                get_card_ids(list(card_names))
+                params = [(score_id, slot, _card_ids_by_name[card_name])
+                          for score_id, deck in decks.items()
+                          for slot, card_name in enumerate(deck)]
+                cnx.start_transaction()
+                cursor.executemany(sql.INSERT_SCORE_CARDS, params)
+                cnx.commit()
+                logger.info(f"Migrated {len(decks)} decks into score_cards")
+                cursor.execute("ALTER TABLE scores DROP COLUMN deck_string")
+                logger.info("Dropped column scores.deck_string")
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
             cnx.rollback()
             logger.warning(TX_ROLLBACK_MSG)
-        except mysql.connector.Error as e:
-            logger.critical("Error:", str(e))
+
+def migrate_battle_players():
+    """
+    One-shot migration that fills the "player_low_id" and "player_high_id" columns of existing battles
+    from the "scores" table and adds the unique index used for duplicate detection.
+    Only needed for MySQL databases created by older versions.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cursor.execute("SHOW COLUMNS FROM battles LIKE 'player_low_id'")
+                if cursor.fetchall():
+                    logger.warning("Column battles.player_low_id already exists. Nothing to migrate")
+                    return
+                for query in sql.MIGRATE_BATTLE_PLAYERS:
+                    cursor.execute(query)
+                    log_query(logger, query)
+            cnx.commit()
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
+
+def migrate_battle_time():
+    """
+    One-shot migration that drops the unique index of "battles.time" and replaces it with the (time, id) index
+    of the battle queries. Battles are identified by the battle_key index, see migrate_battle_players.
+    Only needed for MySQL databases created by older versions.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cursor.execute("SHOW INDEX FROM battles WHERE Key_name = 'time'")
+                if not cursor.fetchall():
+                    logger.warning("Index battles.time does not exist. Nothing to migrate")
+                    return
+                for query in sql.MIGRATE_BATTLE_TIME:
+                    cursor.execute(query)
+                    log_query(logger, query)
+            cnx.commit()
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
+
+def migrate_player_counters():
+    """
+    One-shot migration that sets the NULL counters of players without battles to 0
+    and, on MySQL, declares the counter columns NOT NULL DEFAULT 0.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cursor.execute(sql.MIGRATE_PLAYER_COUNTERS)
+                log_query(logger, sql.MIGRATE_PLAYER_COUNTERS)
+                logger.info(f"Set the counters of {cursor.rowcount} players to 0")
+                if storage.backend.name == "mysql":
+                    cursor.execute(sql.MODIFY_PLAYER_COUNTERS)
+                    log_query(logger, sql.MODIFY_PLAYER_COUNTERS)
+            cnx.commit()
+            cache.bump_generation()
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
+
+def update_player_infos():
+    """
+    Recomputes the columns "1v1_battle_count", "1v1_win_count" and "1v1_three_crowns_win_count" 
+    for all players in the "players" table with set-based statements: the battles of every player
+    are counted in one grouped pass over the "scores" table and joined into the update.
+
+    The counters are already maintained incrementally by insert_new_battles, so this is
+    only needed to backfill them or to repair them after manual changes to the battle data.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cnx.start_transaction()
+                for query in sql.REBUILD_PLAYER_INFOS:
+                    cursor.execute(query)
+                    log_query(logger, query)
+            cnx.commit()
+            cache.bump_generation()
+            logger.info("Updated the columns battle_count, 1v1_win_count and 1v1_three_crowns_win_count for all players")
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
             cnx.rollback()
             logger.warning(TX_ROLLBACK_MSG)
     
+def rate_battles(cursor, checkpoint, state):
+    """
+    Applies all battles after the (time, id) checkpoint to the rating state, in chronological order.
+    Battles are fetched in batches of RATING_FETCH_SIZE.
+    Returns the changed keys, the new checkpoint, the highest id of the rated battles and the
+    rating history rows with the ratings before every battle.
+    """
+    last_battle_time, last_battle_id = checkpoint
+    cursor.execute(sql.RATING_BATTLES, (last_battle_time, last_battle_time, last_battle_id))
+    changed = set()
+    history = []
+    max_battle_id = 0
+    while True:
+        rows = cursor.fetchmany(RATING_FETCH_SIZE)
+        if not rows:
+            break
+        for battle_id, _, game_mode, player1_id, player1_crowns, player2_id, player2_crowns in rows:
+            history.extend((battle_id,) + entry for entry in ratings.snapshot(state, game_mode, player1_id, player2_id))
+            changed.update(ratings.apply_battle(state, game_mode, player1_id, player1_crowns, player2_id, player2_crowns))
+        checkpoint = (rows[-1][1], rows[-1][0])
+        max_battle_id = max(max_battle_id, max(row[0] for row in rows))
+    return changed, checkpoint, max_battle_id, history
+
+def save_ratings(cursor, state, changed, checkpoint, max_battle_id, history):
+    """
+    Writes the changed rating entries, the rating history and the checkpoint. Must be called inside a transaction.
+    """
+    params = [key + (state[key][0], state[key][1]) for key in changed]
+    if params:
+        cursor.executemany(sql.UPSERT_PLAYER_RATINGS, params)
+    if history:
+        cursor.executemany(sql.INSERT_RATING_HISTORY, history)
+    last_battle_time, last_battle_id = checkpoint
+    cursor.execute(sql.UPSERT_RATING_CHECKPOINT, (last_battle_id, last_battle_time, max_battle_id))
+
+def rewind_position(cursor, checkpoint, max_battle_id):
+    """
+    Returns the (time, id) position right before the oldest battle that arrived after newer battles were rated
+    (e.g. from a battle log fetched late), None if there is none. Returns RATING_START if the rating history
+    does not reach back to that battle, because the battles after it were rated before the history existed.
+    """
+    cursor.execute(sql.EARLIEST_LATE_RATING_BATTLE, (max_battle_id, checkpoint[0], checkpoint[0], checkpoint[1]))
+    result = cursor.fetchall()
+    if not result:
+        return None
+    position = (result[0][0], result[0][1] - 1)
+    cursor.execute(sql.UNRECORDED_RATING_BATTLES, (position[0], position[0], position[1], max_battle_id))
+    if cursor.fetchall()[0][0]:
+        logger.info("Battles older than the rating checkpoint arrived, the rating history does not reach back to them")
+        return RATING_START
+    logger.info(f"Battles older than the rating checkpoint arrived. Replaying the battles since {position[0]}")
+    return position
+
+def apply_rating_battles(cursor, replay=False):
+    """
+    Rates the battles after the checkpoint, or all battles if replay is True. Must be called inside a transaction.
+    Elo ratings depend on the order of the battles, so a battle that arrived after newer battles were rated
+    rewinds the ratings to the position before it, from the ratings stored with every battle in "rating_history",
+    and only the battles since then are rated again.
+    Returns the number of changed ratings and the new checkpoint.
+    """
+    # locks the checkpoint, so concurrent ingests never rate a battle twice
+    cursor.execute("SELECT last_battle_time, last_battle_id, max_battle_id FROM rating_checkpoint WHERE id = 1 FOR UPDATE")
+    result = cursor.fetchall()
+    checkpoint, max_battle_id = ((result[0][0], result[0][1]), result[0][2]) if result else (RATING_START, 0)
+    position = RATING_START if replay else rewind_position(cursor, checkpoint, max_battle_id)
+    if position == RATING_START:
+        state, checkpoint = {}, RATING_START
+        cursor.execute("DELETE FROM player_ratings")
+        cursor.execute("DELETE FROM rating_history")
+    else:
+        cursor.execute("SELECT game_mode, player_id, rating, battle_count FROM player_ratings")
+        state = {(game_mode, player_id): [rating, battle_count]
+                 for game_mode, player_id, rating, battle_count in cursor.fetchall()}
+    if position is not None and position != RATING_START:
+        params = (position[0], position[0], position[1])
+        cursor.execute(sql.RATING_HISTORY_SINCE, params)
+        rewound = {}
+        for game_mode, player_id, rating, battle_count in cursor.fetchall():
+            rewound.setdefault((game_mode, player_id), [rating, battle_count])
+        state.update(rewound)
+        cursor.execute(sql.DELETE_RATING_HISTORY_SINCE, params)
+        checkpoint = position
+    changed, checkpoint, rated_max_battle_id, history = rate_battles(cursor, checkpoint, state)
+    save_ratings(cursor, state, changed, checkpoint, max(max_battle_id, rated_max_battle_id), history)
+    return len(changed), checkpoint
+
+def update_ratings():
+    """
+    Rates all battles that were inserted since the last checkpoint. Only the new battles are read,
+    if battles arrived out of order the battles since the oldest of them are rated again.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cnx.start_transaction()
+                changed_count, checkpoint = apply_rating_battles(cursor)
+            cnx.commit()
+            logger.info(f"Updated {changed_count} ratings up to battle {checkpoint[1]} at {checkpoint[0]}")
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
+
+def rebuild_ratings():
+    """
+    Replays the whole battle history and replaces all ratings and the rating history.
+    Needed once to backfill the ratings and whenever the rating formula in ratings.py changes.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                cnx.start_transaction()
+                changed_count, checkpoint = apply_rating_battles(cursor, replay=True)
+            cnx.commit()
+            cache.bump_generation()
+            logger.info(f"Rebuilt {changed_count} ratings up to battle {checkpoint[1]} at {checkpoint[0]}")
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
+
+def migrate_rating_checkpoint():
+    """
+    One-shot migration that adds the (time, id) columns to a rating checkpoint created when battles were rated
+    in id order, and replays the battle history once.
+    """
+    with create_connection() as cnx:
+        try:
+            with cnx.cursor() as cursor:
+                for query in sql.MIGRATE_RATING_CHECKPOINT:
+                    cursor.execute(query)
+                    log_query(logger, query)
+            cnx.commit()
+        except storage.Error as e:
+            logger.critical(f"Error: {e}")
+            cnx.rollback()
+            logger.warning(TX_ROLLBACK_MSG)
+            return
+    rebuild_ratings()
+
+def get_ranking(game_mode="ALL"):
+    """
+    Retrieves the players ordered by their rating in the given game mode as a list of dictionaries.
+    """
+    with create_connection() as cnx:
+        result = select_with_error_handling(cnx, sql.RANKING, (game_mode,), "get_ranking")
+        columns = ["tag", "name", "rating", "battle_count"]
+        return [dict(zip(columns, row)) for row in result or []]
+
+def get_head_to_head(game_mode="ALL", player_tag=None, enemy_tag=None):
+    """
+    Retrieves the head-to-head matrix from the "head_to_head" table, optionally restricted to a
+    player and / or an enemy. Returns a dictionary mapping (player_tag, enemy_tag) to
+    (battle_count, win_count, three_crowns_win_count) tuples.
+    """
+    conditions = []
+    params = []
+    for condition, value in (("h.game_mode = %s", None if game_mode == "ALL" else game_mode),
+                             ("p1.tag = %s", player_tag),
+                             ("p2.tag = %s", enemy_tag)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    query = sql.HEAD_TO_HEAD_MATRIX
+    if conditions:
+        query += "WHERE " + "\nAND ".join(conditions)
+    query += "\nGROUP BY p1.tag, p2.tag"
+    with create_connection() as cnx:
+        result = select_with_error_handling(cnx, query, tuple(params), "get_head_to_head")
+        return {(tag1, tag2): (int(battle_count), int(win_count), int(three_crowns_win_count))
+                for tag1, tag2, battle_count, win_count, three_crowns_win_count in result or []}
+
 def stats_versus(player_tag1, player_tag2, game_mode="ALL"):
     """
     Calculate and return statistics for battles between two players in a specified game mode.
+    If player_tag2 is None, the statistics against all enemies are returned.
     """
-    battles = get_battles(game_mode=game_mode, player_tag=player_tag1, enemy_tag=player_tag2, limit=False)
-    
-    battle_count = len(battles)
-    win_count = 0
-    three_crowns_win_count = 0
-    
-    for battle in battles:
-        player1_crowns = battle["player1_crowns"]
-        player2_crowns = battle["player2_crowns"]
-        
-        if player1_crowns > player2_crowns:
-            win_count += 1
-            if player1_crowns >= 3:
-                three_crowns_win_count += 1
+    matrix = get_head_to_head(game_mode=game_mode, player_tag=player_tag1, enemy_tag=player_tag2)
+    battle_count = sum(row[0] for row in matrix.values())
+    win_count = sum(row[1] for row in matrix.values())
+    three_crowns_win_count = sum(row[2] for row in matrix.values())
 
     win_rate = round((win_count / battle_count) * 100, 2) if battle_count > 0 else 0
 
@@ -503,7 +1390,6 @@ def main():
     # initialize_tables()
     # insert_members()
     insert_new_battles()
-    update_player_infos()
                  
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+"""
+Deck similarity search over the whole battle history.
+Every deck of the "scores" table is encoded as a bitset over the card ids (bit n is set if the deck
+contains the card with id n), packed into a NumPy array of 64 bit words with one row per distinct deck.
+A query compares its deck with all rows at once: the Jaccard similarity |A & B| / |A | B| only needs
+vectorized AND and popcounts.
+The index is kept in the memory of every process and extended with the scores inserted since its last
+update whenever the data generation changes (see cache.bump_generation), so only the first query of a
+process reads the whole history.
+"""
+
+import threading
+
+import numpy as np
+
+import db
+import cache
+
+SIMILAR_DECKS = 10 # decks returned by default
+MAX_SIMILAR_DECKS = 100
+GAME_MODES = db.ALLOWED_BATTLE_MODES
+WORD_BITS = 64
+
+if hasattr(np, "bitwise_count"): # NumPy 2.0
+    def popcount(words):
+        """
+        Returns the number of set bits of every row of a 2D array of 64 bit words.
+        """
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int32)
+else:
+    POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        """
+        Returns the number of set bits of every row of a 2D array of 64 bit words.
+        """
+        return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+def encode_bitsets(decks, width):
+    """
+    Returns a (len(decks), width) array of bitsets for the given card id tuples.
+    """
+    bits = np.zeros((len(decks), width), dtype=np.uint64)
+    card_ids = np.fromiter((card_id for deck in decks for card_id in deck), dtype=np.int64)
+    rows = np.repeat(np.arange(len(decks)), [len(deck) for deck in decks])
+    np.bitwise_or.at(bits, (rows, card_ids // WORD_BITS), np.left_shift(np.uint64(1), (card_ids % WORD_BITS).astype(np.uint64)))
+    return bits
+
+def word_count(card_ids):
+    return max(card_ids, default=0) // WORD_BITS + 1
+
+class DeckIndex:
+    """
+    In-process deck index. The arrays are replaced as a whole on update, so queries never need a lock.
+    Identical decks share one row, their battle and win counts are kept per game mode.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {} # card id tuple -> row
+        self._decks = [] # row -> card id tuple
+        self._card_ids = {}
+        self._card_names = {}
+        self._last_score_id = 0
+        self._generation = None
+        # bitsets, cards per deck, battle counts and win counts per row and game mode
+        self._arrays = (np.zeros((0, 1), dtype=np.uint64), np.zeros(0, dtype=np.int32),
+                        np.zeros((0, len(GAME_MODES)), dtype=np.int32), np.zeros((0, len(GAME_MODES)), dtype=np.int32))
+
+    def update(self):
+        """
+        Adds the scores inserted since the last update. Does nothing if the data generation did not change.
+        """
+        if self._generation == cache.get_generation():
+            return
+        with self._lock:
+            generation = cache.get_generation()
+            if self._generation == generation:
+                return
+            card_names = db.get_card_names_by_id()
+            self._card_names = card_names
+            self._card_ids = {card_name: card_id for card_id, card_name in card_names.items()}
+
+            first_new_row = len(self._decks)
+            rows, game_modes, wins = [], [], []
+            for batch in db.iter_decks(self._last_score_id):
+                for score_id, game_mode, won, card_ids, _ in batch:
+                    if game_mode not in GAME_MODES or not card_ids:
+                        continue
+                    deck = tuple(sorted({int(card_id) for card_id in card_ids.split(",")}))
+                    row = self._rows.get(deck)
+                    if row is None:
+                        row = self._rows[deck] = len(self._decks)
+                        self._decks.append(deck)
+                    rows.append(row)
+                    game_modes.append(GAME_MODES.index(game_mode))
+                    wins.append(won)
+                self._last_score_id = batch[-1][0]
+
+            bits, deck_sizes, battle_counts, win_counts = self._arrays
+            new_decks = self._decks[first_new_row:]
+            width = max(bits.shape[1], word_count(card_id for deck in new_decks for card_id in deck))
+            if width > bits.shape[1]:
+                bits = np.pad(bits, ((0, 0), (0, width - bits.shape[1])))
+            bits = np.concatenate([bits, encode_bitsets(new_decks, width)])
+            deck_sizes = np.concatenate([deck_sizes, np.array([len(deck) for deck in new_decks], dtype=np.int32)])
+            battle_counts = np.pad(battle_counts, ((0, len(new_decks)), (0, 0)))
+            win_counts = np.pad(win_counts, ((0, len(new_decks)), (0, 0)))
+            np.add.at(battle_counts, (rows, game_modes), 1)
+            np.add.at(win_counts, (rows, game_modes), np.array(wins, dtype=np.int32))
+            self._arrays = (bits, deck_sizes, battle_counts, win_counts)
+            self._generation = generation
+            db.logger.info(f"Indexed {len(rows)} decks up to score {self._last_score_id}, {len(self._decks)} distinct decks")
+
+    def similar_decks(self, card_names, game_mode="ALL", k=SIMILAR_DECKS):
+        """
+        Returns the k decks played in the given game mode with the highest Jaccard similarity to the given cards,
+        ordered by similarity and battle count, as dictionaries with the card names (ordered by card id),
+        the similarity, the number of shared cards, the battle count and the win count.
+        """
+        self.update()
+        bits, deck_sizes, battle_counts, win_counts = self._arrays
+        if game_mode == "ALL":
+            battle_counts, win_counts = battle_counts.sum(axis=1), win_counts.sum(axis=1)
+        else:
+            column = GAME_MODES.index(game_mode)
+            battle_counts, win_counts = battle_counts[:, column], win_counts[:, column]
+
+        card_names = set(card_names)
+        # cards that never occurred still count towards the union
+        known_ids = [self._card_ids[card_name] for card_name in card_names if card_name in self._card_ids]
+        query = encode_bitsets([known_ids], max(bits.shape[1], word_count(known_ids)))[:, :bits.shape[1]]
+        shared = popcount(bits & query)
+        similarity = shared / (deck_sizes + len(card_names) - shared)
+        similarity[battle_counts == 0] = -1
+
+        k = min(k, int(np.count_nonzero(battle_counts)))
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-similarity, k - 1)[:k]
+        candidates = candidates[np.lexsort((-battle_counts[candidates], -similarity[candidates]))]
+        return [{"deck": [self._card_names.get(card_id, "Unknown") for card_id in self._decks[row]],
+                 "similarity": round(float(similarity[row]), 4),
+                 "shared_cards": int(shared[row]),
+                 "battle_count": int(battle_counts[row]),
+                 "win_count": int(win_counts[row])}
+                for row in candidates]
+
+index = DeckIndex()
@@ -0,0 +1,115 @@
+"""
+Export of the battle history as NDJSON (one JSON object per line) or CSV.
+Used by the /api/export route of run.py and as a command line tool:
+python export.py --format csv --player-tag "#ABC123" --since 2024-01-01 --output battles.csv
+"""
+
+import io
+import csv
+import sys
+import json
+import argparse
+from datetime import datetime
+
+from db import iter_battles, ALLOWED_BATTLE_MODES, DATETIME_FORMAT
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_COLUMNS = ["id", "time", "game_mode",
+                  "player1_name", "player1_crowns", "player1_king_hp", "player1_princess1_hp",
+                  "player1_princess2_hp", "player1_elixir_leaked", "player1_deck",
+                  "player2_name", "player2_crowns", "player2_king_hp", "player2_princess1_hp",
+                  "player2_princess2_hp", "player2_elixir_leaked", "player2_deck"]
+CSV_DECK_SEPARATOR = ";"
+
+def parse_time(value):
+    """
+    Parses a "YYYY-mm-dd", "YYYY-mm-dd HH:MM" or "YYYY-mm-dd HH:MM:SS" time filter. Raises ValueError for other formats.
+    """
+    if value is None:
+        return None
+    for datetime_format in (DATETIME_FORMAT, "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, datetime_format)
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid time {value!r}, expected YYYY-mm-dd, YYYY-mm-dd HH:MM or YYYY-mm-dd HH:MM:SS")
+
+def export_row(battle):
+    return {column: str(battle[column]) if column == "time" else
+                    float(battle[column]) if column.endswith("_elixir_leaked") else battle[column]
+            for column in EXPORT_COLUMNS}
+
+def iter_ndjson(batches):
+    """
+    Yields one chunk of NDJSON lines per batch of battles.
+    """
+    for batch in batches:
+        yield "".join(json.dumps(export_row(battle), ensure_ascii=False) + "\n" for battle in batch)
+
+def iter_csv(batches):
+    """
+    Yields the CSV header and one chunk of CSV lines per batch of battles. Decks are joined with CSV_DECK_SEPARATOR.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batches:
+        for battle in batch:
+            row = export_row(battle)
+            writer.writerow([CSV_DECK_SEPARATOR.join(row[column]) if column.endswith("_deck") else row[column]
+                             for column in EXPORT_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell(): # header of an empty export
+        yield buffer.getvalue()
+
+def error_record(export_format, message):
+    """
+    Returns the last line of an export that failed after its first chunk was sent:
+    {"error": message} in NDJSON, a row "error,message" in CSV.
+    """
+    if export_format == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(["error", message])
+        return buffer.getvalue()
+    return json.dumps({"error": message}, ensure_ascii=False) + "\n"
+
+def export_battles(export_format="ndjson", **filters):
+    """
+    Returns a generator of text chunks with all battles matching the filters of db.iter_battles.
+    If reading the battles fails, the export ends with an error_record and the RuntimeError is raised again,
+    so a streamed HTTP response is aborted instead of looking complete.
+    """
+    serializer = iter_csv if export_format == "csv" else iter_ndjson
+    try:
+        yield from serializer(iter_battles(**filters))
+    except RuntimeError as e:
+        yield error_record(export_format, str(e))
+        raise
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the battle history as NDJSON or CSV.")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--game-mode", choices=["ALL"] + ALLOWED_BATTLE_MODES, default="ALL")
+    parser.add_argument("--player-tag")
+    parser.add_argument("--enemy-tag")
+    parser.add_argument("--since", type=parse_time, help="first battle time, inclusive")
+    parser.add_argument("--until", type=parse_time, help="last battle time, exclusive")
+    parser.add_argument("--output", help="output file, stdout by default")
+    args = parser.parse_args()
+
+    chunks = export_battles(args.format, game_mode=args.game_mode, player_tag=args.player_tag,
+                            enemy_tag=args.enemy_tag, since=args.since, until=args.until)
+    output = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    except RuntimeError as e:
+        sys.exit(f"Export failed: {e}")
+    finally:
+        if args.output:
+            output.close()
+
+if __name__ == "__main__":
+    main()
@@ -20,3 +20,8 @@ class GameModeEnemySelection(GameModeSelection):
     # Form to select game mode and enemy
     # Choices to be set in /player routing method in run.py
     enemy_selection = SelectField('enemy', choices =[])
+
+class GameModeCardSelection(GameModeSelection):
+    # Form to select game mode and card
+    # Choices to be set in /cards/pairs routing method in run.py
+    card_selection = SelectField('card', choices =[])
@@ -1,25 +1,100 @@
 """
 Logger used by db.py
+Records are handed to a queue on the calling thread and written to the log file and the console
+by a background listener thread, so logging never blocks a request on disk I/O.
 """
+import os
+import queue
+import atexit
+import random
 import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
 
-def configured_logger(file_name):
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper() # DEBUG additionally logs the executed queries
+QUERY_LOG_SAMPLE_RATE = float(os.environ.get("QUERY_LOG_SAMPLE_RATE", 1)) # share of queries logged at DEBUG
+QUERY_LOG_MAX_LENGTH = 500 # characters of a query or its parameters in the log
+QUERY_LOG_MAX_ROWS = 3 # parameter rows of an executemany call in the log
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Queue handler that owns the listener thread writing to the actual handlers.
+    The listener is (re)started lazily, so every forked gunicorn worker runs its own thread.
+    """
+    def __init__(self, *handlers):
+        super().__init__(queue.SimpleQueue())
+        self.handlers = handlers
+        self.listener = None
+        self.pid = None
+        self.listener_lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            with self.listener_lock:
+                if self.pid != os.getpid():
+                    # a forked process must neither wait for the listener of its parent nor repeat its queued records
+                    self.queue = queue.SimpleQueue()
+                    self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                    self.listener.start()
+                    self.pid = os.getpid()
+        super().emit(record)
+
+    def stop(self):
+        """
+        Writes the remaining records and stops the listener thread.
+        """
+        if self.listener and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self.pid = None
+
+def configured_logger(file_name, name=__name__):
     """
     Configures and returns a logger object for logging database operations.
     """
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
     formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d - %(funcName)s)")
 
-    file_handler = logging.FileHandler(file_name)
-    file_handler.setLevel(logging.DEBUG)
+    file_handler = logging.FileHandler(file_name, delay=True)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
 
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.DEBUG)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+
+    logger.addHandler(BackgroundQueueHandler(file_handler, console_handler))
     return logger
 
+def truncate(text, max_length=QUERY_LOG_MAX_LENGTH):
+    return text if len(text) <= max_length else f"{text[:max_length]}... ({len(text) - max_length} more characters)"
+
+def format_params(params):
+    """
+    Returns a shortened representation of query parameters. Of executemany parameter lists only the first rows are kept.
+    """
+    if isinstance(params, list) and len(params) > QUERY_LOG_MAX_ROWS:
+        params = f"{params[:QUERY_LOG_MAX_ROWS]!r}[:{QUERY_LOG_MAX_ROWS}] of {len(params)} rows"
+    return truncate(str(params))
+
+class LazyQuery:
+    """
+    Formats a query and its parameters only if the record is actually written.
+    """
+    def __init__(self, query, params):
+        self.query = query
+        self.params = params
+
+    def __str__(self):
+        query = truncate(" ".join(self.query.split()))
+        return query if self.params is None else f"{query} Parameters: {format_params(self.params)}"
+
+def log_query(logger, query, params=None):
+    """
+    Logs an executed query at DEBUG level. Only a sample of QUERY_LOG_SAMPLE_RATE of all queries is logged,
+    long queries and parameter lists are truncated.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < QUERY_LOG_SAMPLE_RATE:
+        logger.debug("Query executed: %s", LazyQuery(query, params), stacklevel=2)
+
 TX_ROLLBACK_MSG = "Transaction rolled back"
@@ -0,0 +1,124 @@
+"""
+Latency histograms and counters of the web application and the database layer.
+Exposed in the Prometheus text format by the /metrics route of run.py.
+Metrics are kept per process, every gunicorn worker reports its own values.
+"""
+
+import os
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+# seconds, from a cached page up to a full battle history
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 100000)
+SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_SECONDS", 0)) # 0 disables the slow query log
+
+REGISTRY = []
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """
+    Monotonically increasing value per label combination.
+    """
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    """
+    Distribution of observed values per label combination, with cumulative buckets like Prometheus.
+    """
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {} # labels -> [counts per bucket (the last one is +Inf), sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    le = ("le", bound if bound == "+Inf" else repr(float(bound)))
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, [le])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latency of the Flask routes.", ("endpoint", "method", "status"))
+TEMPLATE_LATENCY = Histogram("template_render_duration_seconds", "Jinja rendering time per template.", ("template",))
+FUNCTION_LATENCY = Histogram("function_duration_seconds", "Latency of instrumented functions.", ("function",))
+QUERY_LATENCY = Histogram("db_query_duration_seconds", "Execution and fetch time of SQL queries.", ("query",))
+QUERY_ROWS = Histogram("db_query_rows", "Rows returned by SQL queries.", ("query",), buckets=ROW_BUCKETS)
+CONNECTIONS = Counter("db_connections_total", "Connections borrowed from the storage backend.", ("backend",))
+SLOW_QUERIES = Counter("db_slow_queries_total", "Queries slower than SLOW_QUERY_SECONDS.", ("query",))
+
+def timed(function):
+    """
+    Records the latency of every call of function in FUNCTION_LATENCY.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            FUNCTION_LATENCY.observe(time.perf_counter() - start, function.__name__)
+    return wrapper
+
+def observe_query(name, seconds, rows):
+    """
+    Records the latency and row count of a query. Returns True if the query counts as slow.
+    """
+    QUERY_LATENCY.observe(seconds, name)
+    QUERY_ROWS.observe(rows, name)
+    if SLOW_QUERY_SECONDS and seconds >= SLOW_QUERY_SECONDS:
+        SLOW_QUERIES.inc(name)
+        return True
+    return False
+
+def render():
+    """
+    Returns all metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
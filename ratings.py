@@ -0,0 +1,53 @@
+"""
+Elo rating engine used by db.py.
+The engine only works on in-memory rating state, persisting the state is done by db.py.
+"""
+
+INITIAL_RATING = 1000.0
+K_FACTOR = 32
+OVERALL = "ALL" # ratings over all game modes are stored under this game mode
+
+def expected_score(rating, opponent_rating):
+    """
+    Returns the expected score (win probability) of a player against an opponent.
+    """
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+def actual_score(crowns, opponent_crowns):
+    """
+    Returns the score of a player in a battle: 1 for a win, 0.5 for a draw and 0 for a loss.
+    """
+    if crowns > opponent_crowns:
+        return 1.0
+    elif crowns < opponent_crowns:
+        return 0.0
+    return 0.5
+
+def snapshot(state, game_mode, player1_id, player2_id):
+    """
+    Returns the (game_mode, player_id, rating, battle_count) entries a battle is about to change,
+    as they are before the battle.
+    """
+    return [key + tuple(state.get(key, (INITIAL_RATING, 0)))
+            for mode in (game_mode, OVERALL) for key in ((mode, player1_id), (mode, player2_id))]
+
+def apply_battle(state, game_mode, player1_id, player1_crowns, player2_id, player2_crowns):
+    """
+    Updates the rating state with a single battle, for its game mode and for all game modes.
+    state maps (game_mode, player_id) to [rating, battle_count] and is updated in place.
+    Returns the keys of the changed entries.
+    """
+    changed = []
+    for mode in (game_mode, OVERALL):
+        key1 = (mode, player1_id)
+        key2 = (mode, player2_id)
+        entry1 = state.setdefault(key1, [INITIAL_RATING, 0])
+        entry2 = state.setdefault(key2, [INITIAL_RATING, 0])
+        expected1 = expected_score(entry1[0], entry2[0])
+        delta = K_FACTOR * (actual_score(player1_crowns, player2_crowns) - expected1)
+        entry1[0] += delta
+        entry2[0] -= delta
+        entry1[1] += 1
+        entry2[1] += 1
+        changed.extend((key1, key2))
+    return changed
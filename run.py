@@ -3,49 +3,200 @@ This module serves as the backend of this web application. It defines routes and
 """
 
 import os
+import json
+import time
+import hashlib
+from functools import wraps
+from datetime import date, datetime, timedelta, timezone
 
-from flask import Flask, render_template, abort, request, jsonify
+from flask import Flask, render_template, abort, request, jsonify, make_response, g, session, before_render_template, template_rendered, stream_with_context
 
-from db import get_players, get_player_name_by_tag, get_battles, get_player_info, stats_versus
-from utils import replace_card_names_by_img_path, initialize_cards_data, update_cards_data_stats
-from forms import GameModeSelection, GameModeEnemySelection
+from db import get_players, get_player_name_by_tag, get_battles, get_player_info, stats_versus, get_card_stats, encode_deck, get_head_to_head, get_ranking, get_player_totals, get_card_totals, PAGE_SIZE, MAX_PAGE_SIZE
+from utils import apply_card_stats, negotiate_encoding, compress_body
+from forms import GameModeSelection, GameModeEnemySelection, GameModeCardSelection
+from cache import get_or_compute, read_generation_file
+from card_catalog import catalog
+from export import export_battles, parse_time, EXPORT_FORMATS
+from deck_index import index as deck_index, SIMILAR_DECKS, MAX_SIMILAR_DECKS, GAME_MODES
+from card_pairs import get_synergies, get_counters, MIN_BATTLES, PAIR_LIMIT, MAX_PAIR_LIMIT
+from trends import player_win_rate_trend, card_meta_trend, ROLLING_DAYS
+import metrics
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
 
+# Compact format of /api/next_battles (?format=compact). Battles are sent as rows of COMPACT_COLUMNS,
+# decks as lists of card ids and the image paths of all cards of the page once in "cards".
+COMPACT_FORMAT_VERSION = 1
+COMPACT_COLUMNS = ["id", "time", "game_mode",
+                   "player1_name", "player1_crowns", "player1_king_hp", "player1_princess1_hp",
+                   "player1_princess2_hp", "player1_elixir_leaked", "player1_deck",
+                   "player2_name", "player2_crowns", "player2_king_hp", "player2_princess1_hp",
+                   "player2_princess2_hp", "player2_elixir_leaked", "player2_deck"]
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    if "request_start" in g:
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - g.request_start,
+                                        request.endpoint or "unknown", request.method, response.status_code)
+    return response
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_template_latency(sender, template, context, **extra):
+    if "template_start" in g:
+        metrics.TEMPLATE_LATENCY.observe(time.perf_counter() - g.template_start, template.name)
+
+def cached(function, *args, **kwargs):
+    """
+    Calls function with the given arguments, or returns its cached result of the current data generation.
+    """
+    key = (function.__name__, args, tuple(sorted(kwargs.items())))
+    return get_or_compute(key, lambda: function(*args, **kwargs))
+
+def load_battles(**kwargs):
+    """
+    Retrieves battles via get_battles and adds the image paths of both decks.
+    """
+    battles_data = get_battles(**kwargs) or []
+    for battle in battles_data:
+        battle["player1_deck_images"] = catalog.image_urls(battle["player1_deck"])
+        battle["player2_deck_images"] = catalog.image_urls(battle["player2_deck"])
+    return battles_data
+
+def conditional(view=None, csrf=False, daily=False):
+    """
+    Answers GET requests with 304 Not Modified if the client already has the current version.
+    The strong ETag is derived from the data generation, the latest ingested battle and the
+    route parameters, so it is checked before any database query runs.
+
+    Pages with a form pass csrf=True: their ETag also depends on the CSRF token of the session and changes
+    every half WTF_CSRF_TIME_LIMIT, so a revalidated page never carries an expired token.
+    Views that depend on the current date pass daily=True, their ETag changes at midnight.
+    """
+    if view is None:
+        return lambda view: conditional(view, csrf=csrf, daily=daily)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != "GET":
+            return view(*args, **kwargs)
+
+        info = read_generation_file()
+        validator = [info.get("generation"), info.get("latest_battle_id"), info.get("latest_battle_time"),
+                     request.endpoint, sorted(kwargs.items()), sorted(request.args.items(multi=True)),
+                     negotiate_encoding(request.headers.get("Accept-Encoding", ""))]
+        modified = [info["modified"]] if "modified" in info else []
+        csrf_time_limit = app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+        if csrf and csrf_time_limit:
+            period = csrf_time_limit / 2
+            period_start = time.time() // period * period
+            validator += [session.get("csrf_token"), period_start]
+            modified.append(period_start)
+        if daily:
+            today = date.today()
+            validator.append(today.isoformat())
+            modified.append(datetime.combine(today, datetime.min.time()).timestamp())
+        etag = hashlib.sha1(json.dumps(validator, default=str).encode()).hexdigest()
+        last_modified = datetime.fromtimestamp(max(modified), timezone.utc) if modified else None
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = bool(last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
+
+        response = app.response_class(status=304) if not_modified else make_response(view(*args, **kwargs))
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # browsers must revalidate before reusing the response
+            response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+def encode_compact_battles(battles_data):
+    """
+    Encodes battles in the compact format of /api/next_battles.
+    """
+    cards = {}
+    rows = []
+    for battle in battles_data:
+        row = []
+        for column in COMPACT_COLUMNS:
+            value = battle[column]
+            if column.endswith("_deck"):
+                card_ids = encode_deck(value)
+                cards.update(zip(card_ids, catalog.image_urls(value)))
+                value = card_ids
+            elif column == "time":
+                value = str(value)
+            elif column.endswith("_elixir_leaked"):
+                value = float(value)
+            row.append(value)
+        rows.append(row)
+    return {"v": COMPACT_FORMAT_VERSION, "columns": COMPACT_COLUMNS, "cards": cards, "rows": rows}
+
+def compact_response(battles_data):
+    """
+    Returns the compact JSON encoding of battles_data, compressed according to the Accept-Encoding header.
+    The compressed body is cached per request arguments and encoding.
+    """
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+    key = ("compact_battles", tuple(sorted(request.args.items(multi=True))), encoding)
+    body = get_or_compute(key, lambda: compress_body(json.dumps(encode_compact_battles(battles_data),
+                                                                separators=(",", ":")).encode(), encoding))
+    response = make_response(body)
+    response.mimetype = "application/json"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
 @app.route("/", methods=["GET"])
 def index():
     return render_template("index.html")
 
 @app.route("/players", methods=["GET"])
 def players():
-    return render_template("players.html", players=get_players())
+    return get_or_compute(("players.html",), lambda: render_template("players.html", players=get_players()))
 
 @app.route("/player/<string:player_tag>", methods=["GET", "POST"])
+@conditional(csrf=True, daily=True)
 def player(player_tag):
-    player_name = get_player_name_by_tag(player_tag)
+    player_name = cached(get_player_name_by_tag, player_tag)
     if player_name is None:
         abort(404, description="Player not found.")
     
     form = GameModeEnemySelection()
-    form.enemy_selection.choices = [("None", "Alle Gegner")] + [(player["tag"], player["name"]) for player in get_players() if player["tag"] != player_tag]
+    form.enemy_selection.choices = [("None", "Alle Gegner")] + [(player["tag"], player["name"]) for player in cached(get_players) if player["tag"] != player_tag]
     
-    player_info = get_player_info(player_tag)
+    player_info = cached(get_player_info, player_tag)
     battles_data = []
+    game_mode = form.game_mode_selection.data if request.method == "POST" else "ALL"
+    win_rate_trend = cached(player_win_rate_trend, player_tag, date.today(), game_mode=game_mode)
     
     if request.method == "POST":
         if form.enemy_selection.data == "None":
             form.enemy_selection.data = None
             
-        battles_data = get_battles(game_mode=form.game_mode_selection.data,
-                                   player_tag=player_tag,
-                                   enemy_tag=form.enemy_selection.data)
+        battles_data = cached(load_battles,
+                              game_mode=form.game_mode_selection.data,
+                              player_tag=player_tag,
+                              enemy_tag=form.enemy_selection.data)
         
-        stats_data = stats_versus(player_tag, 
-                                  player_tag2=form.enemy_selection.data, 
-                                  game_mode=form.game_mode_selection.data)
+        stats_data = cached(stats_versus,
+                            player_tag, 
+                            player_tag2=form.enemy_selection.data, 
+                            game_mode=form.game_mode_selection.data)
     else:
-        battles_data = get_battles(player_tag=player_tag)
+        battles_data = cached(load_battles, player_tag=player_tag)
         win_rate = round((player_info["1v1_win_count"] / player_info["1v1_battle_count"]) * 100, 2) if player_info["1v1_battle_count"] > 0 else 0
         stats_data = {
             "win_rate": win_rate,
@@ -53,41 +204,42 @@ def player(player_tag):
             "win_count": player_info["1v1_win_count"],
             "three_crowns_win_count": player_info["1v1_three_crowns_win_count"]
         }
-    for battle in battles_data:
-        battle["player1_deck_string"] = replace_card_names_by_img_path(battle["player1_deck_string"])
-        battle["player2_deck_string"] = replace_card_names_by_img_path(battle["player2_deck_string"])
-    
     return render_template("player.html",
                            form=form,
                            player_info=player_info,
                            battles_data=battles_data,
-                           stats_data=stats_data)
+                           stats_data=stats_data,
+                           win_rate_trend=win_rate_trend,
+                           rolling_days=ROLLING_DAYS)
 
 @app.route("/battles", methods=["GET", "POST"])
+@conditional(csrf=True)
 def battles():
     form = GameModeSelection()
     battles_data = []
     
     if request.method == "POST":
-        battles_data = get_battles(game_mode=form.game_mode_selection.data)
+        battles_data = cached(load_battles, game_mode=form.game_mode_selection.data)
     else:
-        battles_data = get_battles()
-        
-    for battle in battles_data:
-        battle["player1_deck_string"] = replace_card_names_by_img_path(battle["player1_deck_string"])
-        battle["player2_deck_string"] = replace_card_names_by_img_path(battle["player2_deck_string"])
+        battles_data = cached(load_battles)
         
     return render_template("battles.html",
                            form=form,
                            battles_data=battles_data) 
 
 @app.route("/api/next_battles", methods=["GET"])
+@conditional
 def next_battles():
     latest_battle_time = request.args.get("battle-time")
     
     if not latest_battle_time:
         return jsonify(error="Missing battle-time parameter"), 400
     
+    # (time, id) keyset cursor of the last displayed battle. Without an id all battles of that time are skipped.
+    latest_battle_id = request.args.get("battle-id", 0, type=int)
+    page_size = min(request.args.get("page-size", PAGE_SIZE, type=int), MAX_PAGE_SIZE)
+    before = (latest_battle_time, latest_battle_id)
+
     player_tag = request.args.get("player-tag")
     game_mode_selection = request.args.get("game-mode-selection")
     enemy_selection = request.args.get("enemy-selection") # also a tag like player_tag
@@ -96,37 +248,196 @@ def next_battles():
         enemy_selection = None
 
     if player_tag:
-        battles_data = get_battles(player_tag=player_tag, latest_battle_time=latest_battle_time, game_mode=game_mode_selection, enemy_tag=enemy_selection)
+        battles_data = cached(get_battles, before, player_tag=player_tag, game_mode=game_mode_selection, enemy_tag=enemy_selection, page_size=page_size)
     else:
-        battles_data = get_battles(latest_battle_time, game_mode=game_mode_selection)
+        battles_data = cached(get_battles, before, game_mode=game_mode_selection, page_size=page_size)
 
+    if request.args.get("format") == "compact":
+        return compact_response(battles_data or [])
     if battles_data:
         return jsonify(battles_data)
     else:
         return jsonify(message="No more battles to fetch.")
 
 
+@app.route("/api/h2h", methods=["GET"])
+@conditional
+def head_to_head():
+    """
+    Returns the head-to-head matrix of the clan as
+    {"game_mode": ..., "matrix": {player_tag: {enemy_tag: {"battle_count": ..., "win_count": ..., "three_crowns_win_count": ...}}}}.
+    The optional parameters player-tag and enemy-tag restrict the matrix to a row / cell.
+    """
+    game_mode = request.args.get("game-mode-selection", "ALL")
+    player_tag = request.args.get("player-tag")
+    enemy_tag = request.args.get("enemy-tag")
+
+    matrix = {}
+    for (tag1, tag2), (battle_count, win_count, three_crowns_win_count) in cached(get_head_to_head, game_mode, player_tag, enemy_tag).items():
+        matrix.setdefault(tag1, {})[tag2] = {
+            "battle_count": battle_count,
+            "win_count": win_count,
+            "three_crowns_win_count": three_crowns_win_count
+        }
+    return jsonify(game_mode=game_mode, matrix=matrix)
+
+@app.route("/api/similar_decks", methods=["GET"])
+@conditional
+def similar_decks():
+    """
+    Returns the recorded decks most similar to the given deck and how they fared as
+    {"game_mode": ..., "deck": [...], "decks": [{"deck": [...], "images": [...], "similarity": ..., "shared_cards": ...,
+    "battle_count": ..., "win_count": ...}]}.
+    Parameters: deck (comma separated card names), k (number of decks) and game-mode-selection.
+    """
+    deck = [card_name.strip() for card_name in request.args.get("deck", "").split(",") if card_name.strip()]
+    if not deck:
+        return jsonify(error="Missing deck parameter"), 400
+    game_mode = request.args.get("game-mode-selection", "ALL")
+    if game_mode != "ALL" and game_mode not in GAME_MODES:
+        return jsonify(error=f"Unknown game mode, expected ALL or one of {GAME_MODES}"), 400
+    k = max(1, min(request.args.get("k", SIMILAR_DECKS, type=int), MAX_SIMILAR_DECKS))
+
+    decks = deck_index.similar_decks(deck, game_mode=game_mode, k=k)
+    for similar_deck in decks:
+        similar_deck["images"] = catalog.image_urls(similar_deck["deck"])
+    return jsonify(game_mode=game_mode, deck=deck, decks=decks)
+
+def add_card_images(rows, *columns):
+    """
+    Adds the image url of the cards in the given columns as "<column>_image" to every row.
+    """
+    for row in rows:
+        for column in columns:
+            row[column + "_image"] = catalog.get(row[column]).image_url
+    return rows
+
+@app.route("/api/card_pairs", methods=["GET"])
+@conditional
+def card_pairs_api():
+    """
+    Returns the card pairs with the highest win rate within a deck and the strongest counters as
+    {"game_mode": ..., "card": ..., "synergies": [{"card1": ..., "card2": ..., "battle_count": ..., "win_count": ..., "win_rate": ...}],
+    "counters": [{"card": ..., "enemy_card": ..., "battle_count": ..., "win_count": ..., "win_rate": ...}]}.
+    Parameters: game-mode-selection, card (only pairs with this card), min-battles and limit.
+    """
+    game_mode = request.args.get("game-mode-selection", "ALL")
+    if game_mode != "ALL" and game_mode not in GAME_MODES:
+        return jsonify(error=f"Unknown game mode, expected ALL or one of {GAME_MODES}"), 400
+    card_name = request.args.get("card")
+    min_battles = request.args.get("min-battles", MIN_BATTLES, type=int)
+    limit = max(1, min(request.args.get("limit", PAIR_LIMIT, type=int), MAX_PAIR_LIMIT))
+
+    return jsonify(game_mode=game_mode,
+                   card=card_name,
+                   synergies=get_synergies(game_mode, card_name, min_battles, limit),
+                   counters=get_counters(game_mode, card_name, min_battles, limit))
+
+@app.route("/api/rollups", methods=["GET"])
+@conditional(daily=True)
+def rollups():
+    """
+    Returns the battle and win counts of the date range [since, until) from the daily and weekly rollups as
+    {"since": ..., "until": ..., "game_mode": ..., "player": {"battle_count": ..., "win_count": ..., "three_crowns_win_count": ...}}
+    if player-tag is given, otherwise with "cards": {card_name: {"battle_count": ..., "win_count": ...}} instead of "player".
+    Parameters: since (YYYY-mm-dd), until (defaults to tomorrow), player-tag and game-mode-selection.
+    """
+    try:
+        since = parse_time(request.args.get("since"))
+        until = parse_time(request.args.get("until"))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if since is None:
+        return jsonify(error="Missing since parameter"), 400
+    since = since.date()
+    until = until.date() if until else date.today() + timedelta(days=1)
+    game_mode = request.args.get("game-mode-selection", "ALL")
+    player_tag = request.args.get("player-tag")
+
+    if player_tag:
+        return jsonify(since=since.isoformat(), until=until.isoformat(), game_mode=game_mode,
+                       player=cached(get_player_totals, player_tag, since, until, game_mode=game_mode))
+    cards = {card_name: {"battle_count": battle_count, "win_count": win_count}
+             for card_name, (battle_count, win_count) in cached(get_card_totals, since, until, game_mode=game_mode).items()}
+    return jsonify(since=since.isoformat(), until=until.isoformat(), game_mode=game_mode, cards=cards)
+
+@app.route("/api/export", methods=["GET"])
+def export():
+    """
+    Streams all battles matching the filters as NDJSON (default) or CSV (?format=csv).
+    Filters: game-mode-selection, player-tag, enemy-selection and the time range since / until.
+    """
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify(error=f"Unknown format, expected one of {sorted(EXPORT_FORMATS)}"), 400
+    try:
+        since = parse_time(request.args.get("since"))
+        until = parse_time(request.args.get("until"))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    enemy_selection = request.args.get("enemy-selection")
+    if enemy_selection == "None":
+        enemy_selection = None
+
+    chunks = export_battles(export_format,
+                            game_mode=request.args.get("game-mode-selection", "ALL"),
+                            player_tag=request.args.get("player-tag"),
+                            enemy_tag=enemy_selection,
+                            since=since,
+                            until=until)
+    response = app.response_class(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format])
+    response.headers["Content-Disposition"] = f"attachment; filename=battles.{export_format}"
+    # proxies like NGINX must pass the chunks on instead of buffering the whole export
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
 @app.route("/cards", methods=["GET", "POST"])
 def cards():
     form = GameModeSelection()
-    
-    cards_path = r"C:\Users\samca\Documents\d\clash_royale_app\static\images\cards"
-    card_files = os.listdir(cards_path)
-    cards_data = initialize_cards_data(card_files)
+    cards_data = catalog.cards_data()
     
     if request.method == "POST":
-        battles_data = get_battles(game_mode=form.game_mode_selection.data, limit=False)
+        card_stats = cached(get_card_stats, game_mode=form.game_mode_selection.data)
+        meta_trend = cached(card_meta_trend, date.today(), game_mode=form.game_mode_selection.data)
     else:
-        battles_data = get_battles(limit=False)
+        card_stats = cached(get_card_stats)
+        meta_trend = cached(card_meta_trend, date.today())
     
-    update_cards_data_stats(battles_data, cards_data)
+    apply_card_stats(card_stats, cards_data)
 
-    return render_template("cards.html", form=form, cards_data=cards_data)
+    return render_template("cards.html", form=form, cards_data=cards_data, meta_trend=meta_trend)
     
 
-@app.route("/ranking", methods=["GET"])
+@app.route("/cards/pairs", methods=["GET", "POST"])
+def card_pairs():
+    form = GameModeCardSelection()
+    form.card_selection.choices = [("None", "Alle Karten")] + [(card.name, card.display_name) for card in catalog.cards()]
+    game_mode, card_name = "ALL", None
+
+    if request.method == "POST":
+        game_mode = form.game_mode_selection.data
+        if form.card_selection.data != "None":
+            card_name = form.card_selection.data
+
+    synergy_data = add_card_images(get_synergies(game_mode, card_name), "card1", "card2")
+    counter_data = add_card_images(get_counters(game_mode, card_name), "card", "enemy_card")
+
+    return render_template("card_pairs.html", form=form, synergy_data=synergy_data, counter_data=counter_data, min_battles=MIN_BATTLES)
+
+@app.route("/ranking", methods=["GET", "POST"])
 def ranking():
-    return render_template("ranking.html")
+    form = GameModeSelection()
+    
+    if request.method == "POST":
+        ranking_data = cached(get_ranking, game_mode=form.game_mode_selection.data)
+    else:
+        ranking_data = cached(get_ranking)
+    
+    return render_template("ranking.html", form=form, ranking_data=ranking_data)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @app.errorhandler(404)
 def page_not_found(error):
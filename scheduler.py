@@ -0,0 +1,317 @@
+"""
+Adaptive ingest scheduler, a long-running replacement for the cron jobs calling insert_members and insert_new_battles.
+Every clan member has its own poll interval: a player whose battle log changed is polled again after
+MIN_POLL_INTERVAL, every unchanged battle log multiplies the interval by BACKOFF_FACTOR up to MAX_POLL_INTERVAL.
+The opponents of new battles are woken up as well, clan mates play their friendly battles in sessions.
+Unchanged battle logs are recognized by their newest battleTime and not parsed at all.
+The members, battles and stats stages run as a pipeline in their own threads, connected by a queue:
+the battle logs are written while the next ones are fetched, and the ratings, planner statistics and
+the data generation are updated once per STATS_DELAY instead of after every battle log.
+Run with: python scheduler.py
+"""
+
+import os
+import heapq
+import queue
+import random
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import data_retrieval as api
+from logger import configured_logger
+from utils import iso8601_to_datetime
+
+MIN_POLL_INTERVAL = float(os.environ.get("INGEST_MIN_POLL_INTERVAL", 300)) # seconds between polls of an active player
+MAX_POLL_INTERVAL = float(os.environ.get("INGEST_MAX_POLL_INTERVAL", 6 * 3600)) # seconds between polls of an idle player
+BACKOFF_FACTOR = float(os.environ.get("INGEST_BACKOFF_FACTOR", 2))
+MEMBERS_INTERVAL = float(os.environ.get("INGEST_MEMBERS_INTERVAL", 3600)) # seconds between fetches of the clan members
+STATS_DELAY = float(os.environ.get("INGEST_STATS_DELAY", 30)) # seconds written battles are collected before the stats stage runs
+API_TIME_FORMAT = "%Y%m%dT%H%M%S.%fZ"
+
+logger = configured_logger("scheduler.log", name="scheduler")
+
+class PollSchedule:
+    """
+    Poll times and intervals of the clan members, ordered in a heap of (poll time, player tag).
+    Rescheduled players leave their old heap entry behind, it is skipped when it comes up.
+    Players are taken out of the schedule while their battle log is fetched and put back by record.
+    Every scheduled poll interrupts wait, so a poll moved before the one waited for is not delayed.
+    """
+    def __init__(self, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL, backoff_factor=BACKOFF_FACTOR):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self._lock = threading.Lock()
+        self._heap = []
+        self._poll_times = {} # player tag -> next poll, missing while the battle log is fetched
+        self._intervals = {} # player tag -> poll interval
+        self._battle_times = {} # player tag -> newest battleTime of the written battle log, as returned by the API
+        self._changed = threading.Event()
+
+    def clamp(self, interval):
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def _schedule(self, player_tag, poll_time):
+        self._poll_times[player_tag] = poll_time
+        heapq.heappush(self._heap, (poll_time, player_tag))
+        self._changed.set()
+
+    def set_players(self, player_tags, last_battle_times, now, utc_now):
+        """
+        Adds new players and removes players that left the clan. The interval of a new player starts at the
+        time since its last battle in the database, its first poll is spread randomly over that interval.
+        """
+        with self._lock:
+            for player_tag in set(self._intervals) - set(player_tags):
+                del self._intervals[player_tag]
+                self._poll_times.pop(player_tag, None)
+                self._battle_times.pop(player_tag, None)
+            for player_tag in player_tags:
+                if player_tag in self._intervals:
+                    continue
+                last_battle_time = last_battle_times.get(player_tag)
+                idle_seconds = (utc_now - last_battle_time).total_seconds() if last_battle_time else self.max_interval
+                interval = self._intervals[player_tag] = self.clamp(idle_seconds)
+                self._schedule(player_tag, now + random.uniform(0, interval))
+
+    def pop_due(self, now):
+        """
+        Returns the tags of all players due at now with the newest battleTime seen of them,
+        and takes them out of the schedule.
+        """
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                poll_time, player_tag = heapq.heappop(self._heap)
+                if self._poll_times.get(player_tag) == poll_time:
+                    del self._poll_times[player_tag]
+                    due.append((player_tag, self._battle_times.get(player_tag)))
+        return due
+
+    def next_poll_time(self):
+        with self._lock:
+            while self._heap and self._poll_times.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds or until a poll is scheduled or interrupt is called.
+        """
+        self._changed.wait(timeout)
+        self._changed.clear()
+
+    def interrupt(self):
+        self._changed.set()
+
+    def record(self, player_tag, changed, now):
+        """
+        Puts a polled player back into the schedule: after the minimum interval if its battle log changed,
+        after the backed off interval otherwise.
+        """
+        with self._lock:
+            if player_tag not in self._intervals: # left the clan while its battle log was fetched
+                return
+            interval = self.min_interval if changed else self.clamp(self._intervals[player_tag] * self.backoff_factor)
+            self._intervals[player_tag] = interval
+            self._schedule(player_tag, now + interval)
+
+    def set_battle_time(self, player_tag, battle_time):
+        """
+        Stores the newest battleTime of a written battle log. Until then every poll of the player fetches
+        the battle log again, so battles that could not be written are not lost.
+        """
+        with self._lock:
+            if player_tag in self._intervals and battle_time > self._battle_times.get(player_tag, ""):
+                self._battle_times[player_tag] = battle_time
+
+    def wake(self, player_tag, now):
+        """
+        Resets the interval of an active player and moves its next poll forward to at most the minimum interval.
+        """
+        with self._lock:
+            if player_tag not in self._intervals:
+                return
+            self._intervals[player_tag] = self.min_interval
+            poll_time = self._poll_times.get(player_tag)
+            if poll_time is not None and poll_time > now + self.min_interval:
+                self._schedule(player_tag, now + self.min_interval)
+
+class IngestScheduler:
+    """
+    Runs the members, battles and stats stages until stop is called.
+    The battles stage is split into the fetch loop in the calling thread, which hands the due battle logs
+    to a pool of MAX_IN_FLIGHT threads, and the write loop, which writes the fetched battle logs in batches.
+    """
+    def __init__(self, schedule=None, members_interval=MEMBERS_INTERVAL, stats_delay=STATS_DELAY,
+                 max_in_flight=api.MAX_IN_FLIGHT):
+        self.schedule = schedule or PollSchedule()
+        self.members_interval = members_interval
+        self.stats_delay = stats_delay
+        self.max_in_flight = max_in_flight
+        self._stop = threading.Event()
+        self._members_loaded = threading.Event()
+        self._battles_written = threading.Event()
+        self._battle_logs = queue.Queue()
+        self._player_ids = {} # player name -> player id
+        self._player_tags = {} # player name -> player tag
+        self.counters = {"polls": 0, "unchanged": 0, "errors": 0, "written": 0}
+        self._counters_lock = threading.Lock()
+
+    def count(self, counter, value=1):
+        with self._counters_lock:
+            self.counters[counter] += value
+
+    def stop(self, *args):
+        self._stop.set()
+        self.schedule.interrupt()
+
+    def update_members(self):
+        """
+        Inserts the clan members that are not in the database yet and updates the schedule.
+        New members start with zeroed counters, write_battles keeps them up to date from then on.
+        """
+        clan_members = api.fetch_clan_members()
+        if clan_members is None:
+            raise RuntimeError("Could not fetch the clan members")
+        known_tags = set(db.get_player_tags() or [])
+        new_members = [member for member in clan_members if member[0] not in known_tags]
+        if new_members:
+            db.insert_members(new_members)
+            logger.info(f"Inserted {len(new_members)} new clan members")
+        self._player_ids = db.get_player_ids()
+        self._player_tags = {name: tag for tag, name in clan_members}
+        self.schedule.set_players([tag for tag, _ in clan_members], db.get_last_battle_times(),
+                                  time.monotonic(), datetime.now(timezone.utc).replace(tzinfo=None))
+
+    def members_stage(self):
+        while not self._stop.is_set():
+            try:
+                self.update_members()
+                self._members_loaded.set()
+                with self._counters_lock:
+                    logger.info(f"Battle logs since the last member update: {self.counters}")
+                    self.counters = dict.fromkeys(self.counters, 0)
+            except Exception as e:
+                logger.critical(f"Error in the members stage: {e}")
+            # without members there is nothing to poll, so a failed first fetch is retried soon
+            self._stop.wait(self.members_interval if self._members_loaded.is_set() else self.schedule.min_interval)
+
+    def fetch(self, player_tag, battle_time):
+        """
+        Fetches the battle log of a player if it changed, reschedules the player and passes the battles
+        on to the write stage together with their newest battleTime.
+        """
+        try:
+            newest_battle_time, battles = api.fetch_battle_log_if_changed(player_tag, battle_time)
+        except Exception as e:
+            logger.critical(f"Error: {e}")
+            newest_battle_time, battles = battle_time, None
+        now = time.monotonic()
+        self.count("polls")
+        if battles is None:
+            self.count("errors")
+            logger.critical(f"Could not fetch battle log of player {player_tag}")
+        elif not battles:
+            self.count("unchanged")
+        self.schedule.record(player_tag, bool(battles), now)
+        if battles:
+            self._battle_logs.put((player_tag, battles, newest_battle_time))
+            self.wake_opponents(battles, battle_time, now)
+
+    def wake_opponents(self, battles, battle_time, now):
+        last_seen = iso8601_to_datetime(battle_time, API_TIME_FORMAT) if battle_time else ""
+        for battle in battles:
+            if battle[0][0] > last_seen:
+                opponent_tag = self._player_tags.get(battle[3][0][0])
+                if opponent_tag:
+                    self.schedule.wake(opponent_tag, now)
+
+    def fetch_stage(self):
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while not self._stop.is_set():
+                for player_tag, battle_time in self.schedule.pop_due(time.monotonic()):
+                    executor.submit(self.fetch, player_tag, battle_time)
+                next_poll_time = self.schedule.next_poll_time()
+                timeout = self.members_interval if next_poll_time is None else next_poll_time - time.monotonic()
+                # polls scheduled after pop_due end the wait early, the ones before it were seen by next_poll_time
+                self.schedule.wait(max(timeout, 0))
+
+    def write_stage(self):
+        """
+        Writes all battle logs fetched in the meantime with one write_battles call. Ends on the None sentinel.
+        The newest battleTimes of the battle logs are only stored if all their battles were written,
+        otherwise the next polls fetch the battle logs again.
+        """
+        stopping = False
+        while not stopping:
+            battle_logs = [self._battle_logs.get()]
+            while not self._battle_logs.empty():
+                battle_logs.append(self._battle_logs.get())
+            if None in battle_logs:
+                stopping = True
+                battle_logs.remove(None)
+            failed = []
+            try:
+                candidates = db.collect_new_battles([battle_log[:2] for battle_log in battle_logs], self._player_ids)
+                inserted = db.write_battles(db.remove_duplicate_battles(candidates), failed=failed)
+            except Exception as e:
+                logger.critical(f"Error in the write stage: {e}")
+                continue
+            if failed:
+                logger.critical(f"Could not write {len(failed)} battles, the battle logs are fetched again")
+            else:
+                for player_tag, _, battle_time in battle_logs:
+                    self.schedule.set_battle_time(player_tag, battle_time)
+            if inserted:
+                self.count("written", inserted)
+                self._battles_written.set()
+
+    def stats_stage(self):
+        """
+        Runs db.finish_ingest once per stats_delay while battles are written, and a last time on stop.
+        """
+        while not self._stop.is_set():
+            if not self._battles_written.wait(timeout=1):
+                continue
+            self._stop.wait(self.stats_delay)
+            self.finish_ingest()
+
+    def finish_ingest(self):
+        if self._battles_written.is_set():
+            self._battles_written.clear()
+            try:
+                db.finish_ingest()
+            except Exception as e:
+                logger.critical(f"Error in the stats stage: {e}")
+
+    def run(self):
+        members = threading.Thread(target=self.members_stage, name="members", daemon=True)
+        writer = threading.Thread(target=self.write_stage, name="writer", daemon=True)
+        stats = threading.Thread(target=self.stats_stage, name="stats", daemon=True)
+        members.start()
+        writer.start()
+        stats.start()
+        logger.info("Ingest scheduler started")
+        while not self._members_loaded.wait(timeout=1) and not self._stop.is_set():
+            pass
+        self.fetch_stage() # returns after all submitted battle logs were fetched
+        self._battle_logs.put(None)
+        writer.join()
+        stats.join()
+        self.finish_ingest()
+        members.join()
+        logger.info("Ingest scheduler stopped")
+
+def main():
+    scheduler = IngestScheduler()
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run()
+
+if __name__ == "__main__":
+    main()
@@ -9,18 +9,20 @@ CREATE TABLE IF NOT EXISTS `players`(
     `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, -- is not retrieved from the api
     `tag` CHAR(10) NOT NULL, -- identifies a player,
     `name` VARCHAR(16) UNIQUE NOT NULL,
-    `1v1_battle_count` INT UNSIGNED,
-    `1v1_win_count` INT UNSIGNED,
-    `1v1_three_crowns_win_count` INT UNSIGNED
+    `1v1_battle_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    `1v1_win_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    `1v1_three_crowns_win_count` INT UNSIGNED NOT NULL DEFAULT 0
 )
 """
 
 BATTLES = """
 CREATE TABLE IF NOT EXISTS `battles`(
     `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, -- is not retrieved from the api
-    `time` DATETIME UNIQUE NOT NULL, -- identifies a match
+    `time` DATETIME NOT NULL, -- identifies a match together with the players, see battle_key
     `type` VARCHAR(255) NOT NULL,
-    `game_mode` VARCHAR(255) NOT NULL
+    `game_mode` VARCHAR(255) NOT NULL,
+    `player_low_id` INT UNSIGNED NOT NULL, -- lower player id of both scores
+    `player_high_id` INT UNSIGNED NOT NULL -- higher player id of both scores
 )
 """
 
@@ -32,7 +34,6 @@ CREATE TABLE IF NOT EXISTS `scores`(
     `princess_tower_1_hp` INT NOT NULL,
     `princess_tower_2_hp` INT NOT NULL,
     `elixir_leaked` DECIMAL(5, 2) NOT NULL,
-    `deck_string` TEXT NOT NULL,
     `battle_id` INT UNSIGNED NOT NULL,
     `player_id` INT UNSIGNED NOT NULL,
     FOREIGN KEY (battle_id) REFERENCES battles(id),
@@ -40,234 +41,427 @@ CREATE TABLE IF NOT EXISTS `scores`(
 )
 """
 
-BATTLE_QUERY_FOR_DUPLICATION_CHECK = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
-FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-WHERE s1.player_id < s2.player_id AND (b.time = '{}' OR b.time = '{}')
+CARDS = """
+CREATE TABLE IF NOT EXISTS `cards`(
+    `id` SMALLINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    `name` VARCHAR(64) UNIQUE NOT NULL
+)
 """
 
-ALL_BATTLES = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
-FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-WHERE s1.player_id < s2.player_id 
-ORDER BY b.time DESC
+SCORE_CARDS = """
+CREATE TABLE IF NOT EXISTS `score_cards`(
+    `score_id` INT UNSIGNED NOT NULL,
+    `slot` TINYINT UNSIGNED NOT NULL, -- position of the card in the deck (duels have up to 24 slots)
+    `card_id` SMALLINT UNSIGNED NOT NULL,
+    PRIMARY KEY (`score_id`, `slot`),
+    FOREIGN KEY (score_id) REFERENCES scores(id),
+    FOREIGN KEY (card_id) REFERENCES cards(id)
+)
 """
 
-ALL_BATTLES_WITH_LIMIT = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
-FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-WHERE s1.player_id < s2.player_id 
-AND b.time < %s
-ORDER BY b.time DESC
-LIMIT 10
+CARD_STATS = """
+CREATE TABLE IF NOT EXISTS `card_stats`(
+    `game_mode` VARCHAR(255) NOT NULL,
+    `card_name` VARCHAR(64) NOT NULL,
+    `battle_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    `win_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (`game_mode`, `card_name`)
+)
 """
 
-BATTLES_BY_GAME_MODE = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
-FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-WHERE s1.player_id < s2.player_id 
-AND b.game_mode = %s
-ORDER BY b.time DESC
+HEAD_TO_HEAD = """
+CREATE TABLE IF NOT EXISTS `head_to_head`(
+    `player_id` INT UNSIGNED NOT NULL,
+    `opponent_id` INT UNSIGNED NOT NULL,
+    `game_mode` VARCHAR(255) NOT NULL,
+    `battle_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    `win_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    `three_crowns_win_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (`player_id`, `opponent_id`, `game_mode`),
+    FOREIGN KEY (player_id) REFERENCES players(id),
+    FOREIGN KEY (opponent_id) REFERENCES players(id)
+)
 """
 
-BATTLES_BY_GAME_MODE_WITH_LIMIT = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
-FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-WHERE s1.player_id < s2.player_id 
-AND b.time < %s 
-AND b.game_mode = %s
-ORDER BY b.time DESC
-LIMIT 10
+PLAYER_RATINGS = """
+CREATE TABLE IF NOT EXISTS `player_ratings`(
+    `game_mode` VARCHAR(255) NOT NULL, -- "ALL" for the rating over all game modes
+    `player_id` INT UNSIGNED NOT NULL,
+    `rating` DOUBLE NOT NULL,
+    `battle_count` INT UNSIGNED NOT NULL,
+    PRIMARY KEY (`game_mode`, `player_id`),
+    FOREIGN KEY (player_id) REFERENCES players(id)
+)
 """
 
-BATTLES_BY_PLAYER_TAG = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
-FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-JOIN players AS p ON p.id = s1.player_id
-WHERE b.time < %s 
-AND p.tag = %s
-ORDER BY b.time DESC
-LIMIT 10
+RATING_CHECKPOINT = """
+CREATE TABLE IF NOT EXISTS `rating_checkpoint`(
+    `id` TINYINT UNSIGNED NOT NULL PRIMARY KEY, -- always 1
+    `last_battle_id` INT UNSIGNED NOT NULL, -- battles are rated in (time, id) order, this is the id of the last one
+    `last_battle_time` DATETIME NOT NULL DEFAULT '1000-01-01 00:00:00', -- and its time
+    `max_battle_id` INT UNSIGNED NOT NULL DEFAULT 0 -- highest rated id, newer ids with an older time arrived late
+)
 """
 
-BATTLES_BY_PLAYER_TAG_NO_LIMIT = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
-FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-JOIN players AS p ON p.id = s1.player_id
-WHERE b.time < %s 
-AND p.tag = %s
-ORDER BY b.time DESC
+RATING_HISTORY = """
+CREATE TABLE IF NOT EXISTS `rating_history`(
+    `battle_id` INT UNSIGNED NOT NULL,
+    `game_mode` VARCHAR(255) NOT NULL, -- "ALL" for the rating over all game modes
+    `player_id` INT UNSIGNED NOT NULL,
+    `rating` DOUBLE NOT NULL, -- before the battle, the ratings are rewound to it when older battles arrive late
+    `battle_count` INT UNSIGNED NOT NULL, -- before the battle
+    PRIMARY KEY (`battle_id`, `game_mode`, `player_id`),
+    FOREIGN KEY (battle_id) REFERENCES battles(id)
+)
 """
 
-BATTLES_BY_PLAYER_TAG_BY_GAME_MODE = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
-FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-JOIN players AS p ON p.id = s1.player_id
-WHERE b.time < %s 
-AND p.tag = %s 
-AND b.game_mode = %s
-ORDER BY b.time DESC
-LIMIT 10
+PLAYER_ROLLUPS = """
+CREATE TABLE IF NOT EXISTS `player_rollups`(
+    `period` VARCHAR(4) NOT NULL, -- "day" or "week"
+    `bucket` DATE NOT NULL, -- first day of the period, weeks start on monday
+    `player_id` INT UNSIGNED NOT NULL,
+    `game_mode` VARCHAR(255) NOT NULL,
+    `battle_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    `win_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    `three_crowns_win_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (`period`, `player_id`, `game_mode`, `bucket`),
+    FOREIGN KEY (player_id) REFERENCES players(id)
+)
 """
 
-BATTLES_BY_PLAYER_TAG_BY_GAME_MODE_NO_LIMIT = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
+CARD_ROLLUPS = """
+CREATE TABLE IF NOT EXISTS `card_rollups`(
+    `period` VARCHAR(4) NOT NULL, -- "day" or "week"
+    `bucket` DATE NOT NULL, -- first day of the period, weeks start on monday
+    `card_id` SMALLINT UNSIGNED NOT NULL,
+    `game_mode` VARCHAR(255) NOT NULL,
+    `battle_count` INT UNSIGNED NOT NULL DEFAULT 0, -- decks containing the card
+    `win_count` INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (`period`, `card_id`, `game_mode`, `bucket`),
+    FOREIGN KEY (card_id) REFERENCES cards(id)
+)
+"""
+
+# Secondary indexes, created by db.initialize_tables right after their table.
+# They are kept out of the CREATE TABLE statements, because inline index definitions are MySQL only.
+TABLE_INDEXES = {
+    "PLAYERS": ["CREATE INDEX `tag` ON players (`tag`)"],
+    "BATTLES": ["CREATE UNIQUE INDEX `battle_key` ON battles (`player_low_id`, `player_high_id`, `time`)",
+                "CREATE INDEX `game_mode_time_id` ON battles (`game_mode`, `time`, `id`)",
+                "CREATE INDEX `time_id` ON battles (`time`, `id`)"],
+    # MySQL already has the battle_id index of the foreign key, SQLite needs it for the score joins
+    "SCORES": ["CREATE INDEX `player_battle` ON scores (`player_id`, `battle_id`)",
+               "CREATE INDEX `battle_id` ON scores (`battle_id`)"],
+    "SCORE_CARDS": ["CREATE INDEX `card_id` ON score_cards (`card_id`)"],
+    "PLAYER_RATINGS": ["CREATE INDEX `game_mode_rating` ON player_ratings (`game_mode`, `rating`)"],
+    # range queries over all players / cards of a period
+    "PLAYER_ROLLUPS": ["CREATE INDEX `period_bucket` ON player_rollups (`period`, `bucket`)"],
+    "CARD_ROLLUPS": ["CREATE INDEX `period_bucket` ON card_rollups (`period`, `bucket`)"],
+}
+
+# Battle ingest queries
+INSERT_BATTLE = """
+INSERT INTO battles (time, type, game_mode, player_low_id, player_high_id)
+VALUES (%s, %s, %s, %s, %s)
+"""
+
+# Migration of battles created before the player_low_id / player_high_id columns existed
+MIGRATE_BATTLE_PLAYERS = [
+"""
+ALTER TABLE battles
+ADD COLUMN `player_low_id` INT UNSIGNED,
+ADD COLUMN `player_high_id` INT UNSIGNED
+""",
+"""
+UPDATE battles AS b
+JOIN (SELECT battle_id, MIN(player_id) AS player_low_id, MAX(player_id) AS player_high_id
+      FROM scores
+      GROUP BY battle_id) AS s ON s.battle_id = b.id
+SET b.player_low_id = s.player_low_id, b.player_high_id = s.player_high_id
+""",
+"""
+ALTER TABLE battles
+MODIFY `player_low_id` INT UNSIGNED NOT NULL,
+MODIFY `player_high_id` INT UNSIGNED NOT NULL,
+ADD UNIQUE KEY `battle_key` (`player_low_id`, `player_high_id`, `time`)
+"""
+]
+
+# Migration of battles created while battle times had to be unique. Two pairs of players can finish
+# a battle in the same second, battles are identified by the battle_key index instead.
+MIGRATE_BATTLE_TIME = [
+"CREATE INDEX `time_id` ON battles (`time`, `id`)",
+"ALTER TABLE battles DROP INDEX `time`"
+]
+
+# Migration of the player counters created without a default, which stayed NULL for members without battles
+MIGRATE_PLAYER_COUNTERS = """
+UPDATE players
+SET `1v1_battle_count` = COALESCE(`1v1_battle_count`, 0),
+    `1v1_win_count` = COALESCE(`1v1_win_count`, 0),
+    `1v1_three_crowns_win_count` = COALESCE(`1v1_three_crowns_win_count`, 0)
+WHERE `1v1_battle_count` IS NULL OR `1v1_win_count` IS NULL OR `1v1_three_crowns_win_count` IS NULL
+"""
+
+MODIFY_PLAYER_COUNTERS = """
+ALTER TABLE players
+MODIFY `1v1_battle_count` INT UNSIGNED NOT NULL DEFAULT 0,
+MODIFY `1v1_win_count` INT UNSIGNED NOT NULL DEFAULT 0,
+MODIFY `1v1_three_crowns_win_count` INT UNSIGNED NOT NULL DEFAULT 0
+"""
+
+INSERT_SCORE = """
+INSERT INTO scores (crowns, king_tower_hp, princess_tower_1_hp, princess_tower_2_hp,
+                    elixir_leaked, battle_id, player_id)
+VALUES (%s, %s, %s, %s, %s, %s, %s)
+"""
+
+INSERT_SCORE_CARDS = """
+INSERT IGNORE INTO score_cards (score_id, slot, card_id)
+VALUES (%s, %s, %s)
+"""
+
+# Player statistics queries
+INCREMENT_PLAYER_INFOS = """
+UPDATE players
+SET `1v1_battle_count` = COALESCE(`1v1_battle_count`, 0) + %s,
+    `1v1_win_count` = COALESCE(`1v1_win_count`, 0) + %s,
+    `1v1_three_crowns_win_count` = COALESCE(`1v1_three_crowns_win_count`, 0) + %s
+WHERE id = %s
+"""
+
+# resets the players without battles, then sets the counts of all others grouped in one pass over scores
+REBUILD_PLAYER_INFOS = [
+"UPDATE players SET `1v1_battle_count` = 0, `1v1_win_count` = 0, `1v1_three_crowns_win_count` = 0",
+"""
+UPDATE players AS p
+JOIN (SELECT s1.player_id,
+             COUNT(*) AS battle_count,
+             SUM(s1.crowns > s2.crowns) AS win_count,
+             SUM(s1.crowns > s2.crowns AND s1.crowns = 3) AS three_crowns_win_count
+      FROM scores AS s1
+      JOIN scores AS s2 ON s1.battle_id = s2.battle_id AND s1.player_id != s2.player_id
+      GROUP BY s1.player_id) AS c ON c.player_id = p.id
+SET `1v1_battle_count` = c.battle_count,
+    `1v1_win_count` = c.win_count,
+    `1v1_three_crowns_win_count` = c.three_crowns_win_count
+"""
+]
+
+# Head-to-head queries
+UPSERT_HEAD_TO_HEAD = """
+INSERT INTO head_to_head (player_id, opponent_id, game_mode, battle_count, win_count, three_crowns_win_count)
+VALUES (%s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE battle_count = battle_count + VALUES(battle_count),
+                        win_count = win_count + VALUES(win_count),
+                        three_crowns_win_count = three_crowns_win_count + VALUES(three_crowns_win_count)
+"""
+
+REBUILD_HEAD_TO_HEAD = """
+INSERT INTO head_to_head (player_id, opponent_id, game_mode, battle_count, win_count, three_crowns_win_count)
+SELECT s1.player_id, s2.player_id, b.game_mode,
+       COUNT(*),
+       SUM(s1.crowns > s2.crowns),
+       SUM(s1.crowns > s2.crowns AND s1.crowns >= 3)
 FROM battles AS b
 JOIN scores AS s1 ON b.id = s1.battle_id
 JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-JOIN players AS p ON p.id = s1.player_id
-WHERE b.time < %s 
-AND p.tag = %s 
-AND b.game_mode = %s
-ORDER BY b.time DESC
+GROUP BY s1.player_id, s2.player_id, b.game_mode
 """
 
-BATTLES_BY_PLAYER_TAG_BY_ENEMY_TAG = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
+HEAD_TO_HEAD_MATRIX = """
+SELECT p1.tag, p2.tag, SUM(h.battle_count), SUM(h.win_count), SUM(h.three_crowns_win_count)
+FROM head_to_head AS h
+JOIN players AS p1 ON p1.id = h.player_id
+JOIN players AS p2 ON p2.id = h.opponent_id
+"""
+
+# Latest battle of every player, used by the ingest scheduler
+LAST_BATTLE_TIMES = """
+SELECT p.tag, MAX(b.time)
+FROM players AS p
+JOIN scores AS s ON s.player_id = p.id
+JOIN battles AS b ON b.id = s.battle_id
+GROUP BY p.tag
+"""
+
+# Rating queries
+RATING_BATTLES = """
+SELECT b.id, b.time, b.game_mode, s1.player_id, s1.crowns, s2.player_id, s2.crowns
 FROM battles AS b
 JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-JOIN players AS p1 ON p1.id = s1.player_id
-JOIN players AS p2 ON p2.id = s2.player_id
-WHERE b.time < %s 
-AND p1.tag = %s 
-AND p2.tag = %s
-ORDER BY b.time DESC
-LIMIT 10
+JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id < s2.player_id
+WHERE b.time >= %s AND (b.time > %s OR b.id > %s)
+ORDER BY b.time, b.id
 """
 
-BATTLES_BY_PLAYER_TAG_BY_ENEMY_TAG_NO_LIMIT = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
+# oldest battle inserted after the last rating update that is older than the (time, id) checkpoint
+EARLIEST_LATE_RATING_BATTLE = """
+SELECT time, id
+FROM battles
+WHERE id > %s AND time <= %s AND (time < %s OR id < %s)
+ORDER BY time, id
+LIMIT 1
+"""
+
+# rated battles after a (time, id) position without rating history, rated before the history existed
+UNRECORDED_RATING_BATTLES = """
+SELECT COUNT(*)
 FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-JOIN players AS p1 ON p1.id = s1.player_id
-JOIN players AS p2 ON p2.id = s2.player_id
-WHERE b.time < %s 
-AND p1.tag = %s 
-AND p2.tag = %s
-ORDER BY b.time DESC
+WHERE b.time >= %s AND (b.time > %s OR b.id > %s) AND b.id <= %s
+AND NOT EXISTS (SELECT 1 FROM rating_history AS h WHERE h.battle_id = b.id)
 """
 
-BATTLES_BY_PLAYER_TAG_BY_GAME_MODE_BY_ENEMY_TAG = """
-SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
-       s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
-       s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
+# ratings before the battles after a (time, id) position, the first row of every player is its rating at that position
+RATING_HISTORY_SINCE = """
+SELECT h.game_mode, h.player_id, h.rating, h.battle_count
 FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
-JOIN players AS p1 ON p1.id = s1.player_id
-JOIN players AS p2 ON p2.id = s2.player_id
-WHERE b.time < %s
-AND p1.tag = %s 
-AND p2.tag = %s
-AND b.game_mode = %s 
-ORDER BY b.time DESC
-LIMIT 10
+JOIN rating_history AS h ON h.battle_id = b.id
+WHERE b.time >= %s AND (b.time > %s OR b.id > %s)
+ORDER BY b.time, b.id
+"""
+
+DELETE_RATING_HISTORY_SINCE = """
+DELETE FROM rating_history
+WHERE battle_id IN (SELECT id FROM battles WHERE time >= %s AND (time > %s OR id > %s))
+"""
+
+INSERT_RATING_HISTORY = """
+INSERT INTO rating_history (battle_id, game_mode, player_id, rating, battle_count)
+VALUES (%s, %s, %s, %s, %s)
+"""
+
+UPSERT_PLAYER_RATINGS = """
+INSERT INTO player_ratings (game_mode, player_id, rating, battle_count)
+VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE rating = VALUES(rating), battle_count = VALUES(battle_count)
+"""
+
+UPSERT_RATING_CHECKPOINT = """
+INSERT INTO rating_checkpoint (id, last_battle_id, last_battle_time, max_battle_id)
+VALUES (1, %s, %s, %s)
+ON DUPLICATE KEY UPDATE last_battle_id = VALUES(last_battle_id), last_battle_time = VALUES(last_battle_time),
+                        max_battle_id = VALUES(max_battle_id)
 """
 
-BATTLES_BY_PLAYER_TAG_BY_GAME_MODE_BY_ENEMY_TAG_NO_LIMIT = """
+# Migration of the rating checkpoint created when battles were rated in id order
+MIGRATE_RATING_CHECKPOINT = [
+"ALTER TABLE rating_checkpoint ADD COLUMN `last_battle_time` DATETIME NOT NULL DEFAULT '1000-01-01 00:00:00'",
+"ALTER TABLE rating_checkpoint ADD COLUMN `max_battle_id` INT UNSIGNED NOT NULL DEFAULT 0"
+]
+
+RANKING = """
+SELECT p.tag, p.name, r.rating, r.battle_count
+FROM player_ratings AS r
+JOIN players AS p ON p.id = r.player_id
+WHERE r.game_mode = %s
+ORDER BY r.rating DESC
+"""
+
+# Card statistics queries
+UPSERT_CARD_STATS = """
+INSERT INTO card_stats (game_mode, card_name, battle_count, win_count)
+VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE battle_count = battle_count + VALUES(battle_count),
+                        win_count = win_count + VALUES(win_count)
+"""
+
+CARD_STATS_ALL_GAME_MODES = """
+SELECT card_name, SUM(battle_count), SUM(win_count)
+FROM card_stats
+GROUP BY card_name
+"""
+
+CARD_STATS_BY_GAME_MODE = """
+SELECT card_name, battle_count, win_count
+FROM card_stats
+WHERE game_mode = %s
+"""
+
+# Rollup queries
+UPSERT_PLAYER_ROLLUPS = """
+INSERT INTO player_rollups (period, bucket, player_id, game_mode, battle_count, win_count, three_crowns_win_count)
+VALUES (%s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE battle_count = battle_count + VALUES(battle_count),
+                        win_count = win_count + VALUES(win_count),
+                        three_crowns_win_count = three_crowns_win_count + VALUES(three_crowns_win_count)
+"""
+
+UPSERT_CARD_ROLLUPS = """
+INSERT INTO card_rollups (period, bucket, card_id, game_mode, battle_count, win_count)
+VALUES (%s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE battle_count = battle_count + VALUES(battle_count),
+                        win_count = win_count + VALUES(win_count)
+"""
+
+# scores of the rollup rebuild, after a given score id in keyset batches
+ROLLUP_SCORES = """
+SELECT s1.id, b.time, b.game_mode, s1.player_id, s1.crowns, s2.crowns,
+       (SELECT GROUP_CONCAT(sc.card_id) FROM score_cards AS sc WHERE sc.score_id = s1.id)
+FROM scores AS s1
+JOIN scores AS s2 ON s1.battle_id = s2.battle_id AND s1.player_id != s2.player_id
+JOIN battles AS b ON b.id = s1.battle_id
+WHERE s1.id > %s
+ORDER BY s1.id
+LIMIT %s
+"""
+
+# rollup series, filtered and grouped by db.get_rollup_series
+PLAYER_ROLLUP_SERIES = """
+SELECT r.period, r.bucket, SUM(r.battle_count), SUM(r.win_count), SUM(r.three_crowns_win_count)
+FROM player_rollups AS r
+JOIN players AS p ON p.id = r.player_id
+"""
+
+CARD_ROLLUP_SERIES = """
+SELECT r.period, r.bucket, c.name, SUM(r.battle_count), SUM(r.win_count)
+FROM card_rollups AS r
+JOIN cards AS c ON c.id = r.card_id
+"""
+
+DECK_ROLLUP_SERIES = """
+SELECT r.period, r.bucket, SUM(r.battle_count)
+FROM player_rollups AS r
+"""
+
+# Deck query of the deck index and the card pair statistics, scores after a given score id in keyset batches
+DECKS = """
+SELECT s1.id, b.game_mode, s1.crowns, s2.crowns,
+       (SELECT GROUP_CONCAT(sc.card_id) FROM score_cards AS sc WHERE sc.score_id = s1.id),
+       (SELECT GROUP_CONCAT(sc.card_id) FROM score_cards AS sc WHERE sc.score_id = s2.id)
+FROM scores AS s1
+JOIN scores AS s2 ON s1.battle_id = s2.battle_id AND s1.player_id != s2.player_id
+JOIN battles AS b ON b.id = s1.battle_id
+WHERE s1.id > %s
+ORDER BY s1.id
+LIMIT %s
+"""
+
+# Battle query parts, combined by db.build_battles_query.
+# Without a player filter, {join} is STRAIGHT_JOIN: it keeps the battles in the outer loop, so they are read
+# in (time, id) order from an index and the scan stops after the page. With a player filter it is a plain JOIN,
+# the planner starts from the player's scores and only sorts that player's battles.
+BATTLES_SELECT = """
 SELECT b.time, b.game_mode,
-       s1.crowns, s1.player_id, s1.king_tower_hp,
+       s1.crowns, p1.name, s1.king_tower_hp,
        s1.princess_tower_1_hp, s1.princess_tower_2_hp,
-       s1.elixir_leaked, s1.deck_string,
-       s2.crowns, s2.player_id, s2.king_tower_hp,
+       s1.elixir_leaked,
+       (SELECT GROUP_CONCAT(sc.card_id ORDER BY sc.slot) FROM score_cards AS sc WHERE sc.score_id = s1.id),
+       s2.crowns, p2.name, s2.king_tower_hp,
        s2.princess_tower_1_hp, s2.princess_tower_2_hp,
-       s2.elixir_leaked, s2.deck_string
+       s2.elixir_leaked,
+       (SELECT GROUP_CONCAT(sc.card_id ORDER BY sc.slot) FROM score_cards AS sc WHERE sc.score_id = s2.id),
+       b.id
 FROM battles AS b
-JOIN scores AS s1 ON b.id = s1.battle_id
-JOIN scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
+{join} scores AS s1 ON b.id = s1.battle_id
+{join} scores AS s2 ON b.id = s2.battle_id AND s1.player_id != s2.player_id
 JOIN players AS p1 ON p1.id = s1.player_id
 JOIN players AS p2 ON p2.id = s2.player_id
-WHERE b.time < %s
-AND p1.tag = %s 
-AND p2.tag = %s
-AND b.game_mode = %s 
-ORDER BY b.time DESC
-"""
\ No newline at end of file
+"""
+
+BATTLES_ORDER = """
+ORDER BY b.time DESC, b.id DESC
+"""
+
+# Indexes for the battle queries. Every filter combination of build_battles_query is an index range scan.
+BATTLE_INDEXES = [TABLE_INDEXES["BATTLES"][1], TABLE_INDEXES["BATTLES"][2], TABLE_INDEXES["SCORES"][0], TABLE_INDEXES["PLAYERS"][0]]
@@ -0,0 +1,21 @@
+// draws a line chart into every canvas with data-labels and data-series attributes (trend data of trends.py)
+// series values are percentages, days or weeks without battles have no value (null)
+document.addEventListener("DOMContentLoaded", function () {
+  Chart.defaults.color = "#EFEFEF";
+
+  document.querySelectorAll("canvas[data-series]").forEach(canvas => {
+    new Chart(canvas, {
+      type: "line",
+      data: {
+        labels: JSON.parse(canvas.dataset.labels),
+        datasets: JSON.parse(canvas.dataset.series)
+      },
+      options: {
+        spanGaps: true,
+        scales: {
+          y: {min: 0, max: 100, ticks: {callback: value => value + "%"}}
+        }
+      }
+    });
+  });
+});
@@ -3,20 +3,17 @@ function calculateDamage(kingHP, princess1HP, princess2HP) {
   return (4824 + (3052 * 2) - kingHP - princess1HP - princess2HP);
 }
 
-function replaceCardNamesByImgPath(cardNames) {
-  // transforms card names to img paths for HTML src
-
-  return cardNames.map(card => {
-    const transformedCardName = card
-      .toLowerCase()
-      .replace(/ /g, '_') 
-      .replace(/'/g, '') 
-      .replace(/\[/g, '')
-      .replace(/\]/g, '');
-
-    // construct the image path
-    const imgPath = `/static/images/cards/${transformedCardName}.webp`;
-    return imgPath;
+function decodeCompactBattles(payload) {
+  // turns the compact format of /api/next_battles into battle objects
+  // decks are lists of card ids, the img path of every card is sent once in payload.cards
+  return payload.rows.map(row => {
+    const battle = {};
+    payload.columns.forEach((column, i) => {
+      battle[column] = row[i];
+    });
+    battle.player1ImgPaths = battle.player1_deck.map(cardId => payload.cards[cardId]);
+    battle.player2ImgPaths = battle.player2_deck.map(cardId => payload.cards[cardId]);
+    return battle;
   });
 }
 
@@ -37,8 +34,8 @@ const gameModes = {
 
 document.addEventListener("DOMContentLoaded", function () {
 
-  function getLastBattleTimeInDiv() {
-    // gets time data of the last battle displayed in the browser
+  function getLastBattleInDiv() {
+    // gets time and id of the last battle displayed in the browser (keyset cursor for the next page)
     const battleElements = document.querySelectorAll(".battle");
     if (battleElements.length === 0) {
       // no battles are displayed
@@ -47,11 +44,13 @@ document.addEventListener("DOMContentLoaded", function () {
 
     const lastBattleElement = battleElements[battleElements.length - 1];
     const timestampElement = lastBattleElement.querySelector(".timestamp");
-    const lastBattleTimeInDiv = timestampElement.textContent;
-    return lastBattleTimeInDiv;
+    return {
+      time: timestampElement.textContent,
+      id: lastBattleElement.dataset.battleId
+    };
   }
 
-  function fetchNextBattles(battleTime) {
+  function fetchNextBattles(lastBattle) {
     // fetches next battles (on click on load-more button in /battles and /player/<playerTag>)
 
     let url;
@@ -62,12 +61,14 @@ document.addEventListener("DOMContentLoaded", function () {
     if (playerTagElement) {
       const playerTag = playerTagElement.textContent.trim();
       const enemySelection = document.getElementById("enemy_selection").value // tag like playerTag
-      url = `/api/next_battles?battle-time=${encodeURIComponent(battleTime)}&` + 
+      url = `/api/next_battles?format=compact&battle-time=${encodeURIComponent(lastBattle.time)}&` + 
+            `battle-id=${encodeURIComponent(lastBattle.id)}&` +
             `player-tag=${encodeURIComponent(playerTag)}&` + 
             `game-mode-selection=${encodeURIComponent(gameModeSelection)}&` +
             `enemy-selection=${encodeURIComponent(enemySelection)}`;
     } else {
-      url = `/api/next_battles?battle-time=${encodeURIComponent(battleTime)}&` +
+      url = `/api/next_battles?format=compact&battle-time=${encodeURIComponent(lastBattle.time)}&` +
+            `battle-id=${encodeURIComponent(lastBattle.id)}&` +
             `game-mode-selection=${encodeURIComponent(gameModeSelection)}`;
     }
 
@@ -78,10 +79,13 @@ document.addEventListener("DOMContentLoaded", function () {
         }
         return response.json();
       })
-      .then(battles => {
-        if (battles.length > 0) {
-          return battles;
-        } else if (battles.message && battles.message === "No more battles to fetch.") {
+      .then(payload => {
+        if (payload.v !== 1) {
+          throw new Error(`Unsupported response format version: ${payload.v}`);
+        }
+        if (payload.rows.length > 0) {
+          return decodeCompactBattles(payload);
+        } else {
           console.log("No more battles to fetch");
           return null;
         }
@@ -102,9 +106,9 @@ document.addEventListener("DOMContentLoaded", function () {
 
     const contentDiv = document.getElementById("content");
     const loadMoreDiv = document.getElementById("load-more");
-    const battleTime = getLastBattleTimeInDiv();
+    const lastBattle = getLastBattleInDiv();
 
-    fetchNextBattles(battleTime)
+    fetchNextBattles(lastBattle)
       .then(battles => {
         // remove loadMoreDiv
         contentDiv.removeChild(loadMoreDiv);
@@ -118,17 +122,10 @@ document.addEventListener("DOMContentLoaded", function () {
         battles.forEach(battle => {
           const div = document.createElement("div");
           div.classList.add("battle");
+          div.dataset.battleId = battle.id;
 
-          // format battle time
-          const timeString = battle.time;
-          const timeObject = new Date(timeString);
-          const year = timeObject.getUTCFullYear();
-          const month = (timeObject.getUTCMonth() + 1).toString().padStart(2, '0');
-          const day = timeObject.getUTCDate().toString().padStart(2, '0');
-          const hours = timeObject.getUTCHours().toString().padStart(2, '0');
-          const minutes = timeObject.getUTCMinutes().toString().padStart(2, '0');
-          const seconds = timeObject.getUTCSeconds().toString().padStart(2, '0');
-          const formattedTime = `${year}-${month}-${day} ${hours}:${minutes}:${seconds}`;
+          // battle time is already formatted as YYYY-MM-DD HH:MM:SS
+          const formattedTime = battle.time;
 
           // hp values
           const player1KingHP = parseFloat(battle.player1_king_hp);
@@ -139,10 +136,8 @@ document.addEventListener("DOMContentLoaded", function () {
           const player2Princess2HP = parseFloat(battle.player2_princess2_hp);
 
           // list of img paths
-          const player1DeckList = JSON.parse(battle.player1_deck_string.replace(/'/g, '"'));
-          const player1ImgPaths = replaceCardNamesByImgPath(player1DeckList);
-          const player2DeckList = JSON.parse(battle.player2_deck_string.replace(/'/g, '"'));
-          const player2ImgPaths = replaceCardNamesByImgPath(player2DeckList);
+          const player1ImgPaths = battle.player1ImgPaths;
+          const player2ImgPaths = battle.player2ImgPaths;
 
           // inside of each battle div
           const firstPart = `
@@ -0,0 +1,258 @@
+"""
+Storage backends used by db.py.
+db.py is written against MySQL flavoured SQL. The MySQL backend hands out pooled mysql.connector
+connections, the SQLite backend hands out embedded connections that translate the few dialect
+specific statements on the fly. Both behave the same way behind db.py.
+The backend is selected with the STORAGE_BACKEND environment variable ("mysql" or "sqlite").
+"""
+
+import os
+import re
+import time
+import sqlite3
+import threading
+from datetime import date, datetime
+from functools import lru_cache
+
+try:
+    import mysql.connector
+    import mysql.connector.pooling
+except ImportError: # only required by the MySQL backend
+    mysql = None
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "mysql").lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "clash_royale.db"))
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 30)) # seconds to wait for the write lock
+SQLITE_ANALYSIS_LIMIT = 1000 # rows sampled per index by ANALYZE, keeps it fast on large tables
+
+POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", 5)) # connections per (gunicorn) worker process
+POOL_TIMEOUT = float(os.environ.get("MYSQL_POOL_TIMEOUT", 5)) # seconds to wait for a free connection
+
+# Exception classes of all available drivers, so db.py can catch them independent of the backend
+Error = (sqlite3.Error,) + ((mysql.connector.Error,) if mysql else ())
+IntegrityError = (sqlite3.IntegrityError,) + ((mysql.connector.IntegrityError,) if mysql else ())
+
+class MySQLBackend:
+    """
+    Connections are borrowed from a mysql.connector pool.
+    Pools are cached per process id, because connections must never be shared
+    between a gunicorn master and its forked workers.
+    """
+    name = "mysql"
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get_connection_pool(self, **config):
+        """
+        Returns the connection pool of the current process for the given connection config.
+        The pool is created lazily, so every forked worker builds its own pool on first use.
+        """
+        key = (os.getpid(),) + tuple(sorted(config.items()))
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    # drop pools inherited from a parent process
+                    for stale_key in [k for k in self._pools if k[0] != os.getpid()]:
+                        del self._pools[stale_key]
+                    pool = mysql.connector.pooling.MySQLConnectionPool(
+                        pool_name=f"clash_royale_{os.getpid()}_{len(self._pools)}",
+                        pool_size=POOL_SIZE,
+                        pool_reset_session=True,
+                        **config
+                    )
+                    self._pools[key] = pool
+        return pool
+
+    def connect(self, **config):
+        """
+        Borrows a connection from the pool. Waits up to POOL_TIMEOUT seconds if the pool is exhausted.
+        The pool itself pings the connection and reconnects if it went stale.
+        Closing the connection returns it to the pool.
+        """
+        pool = self.get_connection_pool(**config)
+        deadline = time.monotonic() + POOL_TIMEOUT
+        while True:
+            try:
+                return pool.get_connection()
+            except mysql.connector.PoolError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.01)
+
+    def table_exists(self, cursor, table_name):
+        cursor.execute("SHOW TABLES")
+        return any(table_name.lower() == t[0] for t in cursor.fetchall())
+
+    def analyze(self, cursor):
+        pass # InnoDB recalculates its statistics automatically
+
+    def is_duplicate_entry(self, e):
+        return getattr(e, "errno", None) == 1062 # Duplicate entry
+
+    def is_duplicate_index(self, e):
+        return getattr(e, "errno", None) == 1061 # Duplicate key name
+
+# MySQL constructs used by db.py and sql_statements.py and their SQLite counterparts
+_SQLITE_REWRITES = [
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\bINSERT IGNORE\b"), "INSERT OR IGNORE"),
+    (re.compile(r"\bON DUPLICATE KEY UPDATE\b"), "ON CONFLICT DO UPDATE SET"),
+    (re.compile(r"\bVALUES\((\w+)\)"), r"excluded.\1"),
+    (re.compile(r"(`\w+`) \w+(?: UNSIGNED)? NOT NULL AUTO_INCREMENT PRIMARY KEY"), r"\1 INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r"\bCREATE (UNIQUE )?INDEX\b"), r"CREATE \1INDEX IF NOT EXISTS"),
+    (re.compile(r"\s+FOR UPDATE\b"), ""), # BEGIN IMMEDIATE already holds the write lock
+    (re.compile(r"\bSTRAIGHT_JOIN\b"), "CROSS JOIN"), # both keep the left table in the outer loop
+    # UPDATE ... JOIN (derived table) ... SET needs the UPDATE ... SET ... FROM ... WHERE form of SQLite 3.33
+    (re.compile(r"^(\s*UPDATE \w+ AS \w+)\s+JOIN (\(.*\) AS \w+) ON ([^\n]+)\n(SET .*)$", re.DOTALL),
+     r"\1\n\4\nFROM \2\nWHERE \3"),
+    # GROUP_CONCAT(x ORDER BY y) needs SQLite 3.44, an ordered subquery works on every version
+    (re.compile(r"GROUP_CONCAT\((\w+\.\w+) ORDER BY (\w+\.\w+)\) FROM ([^)]*?)(?=\))"),
+     r"GROUP_CONCAT(v) FROM (SELECT \1 AS v FROM \3 ORDER BY \2)"),
+]
+
+@lru_cache(maxsize=256)
+def translate_to_sqlite(query):
+    """
+    Rewrites a MySQL flavoured query into its SQLite equivalent.
+    Queries are static strings, so the translation is cached.
+    """
+    for pattern, replacement in _SQLITE_REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+class SQLiteCursor:
+    """
+    Wraps a sqlite3 cursor with the parts of the mysql.connector cursor API db.py uses.
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def execute(self, query, params=()):
+        return self._cursor.execute(translate_to_sqlite(query), params)
+
+    def executemany(self, query, params):
+        return self._cursor.executemany(translate_to_sqlite(query), params)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+class SQLiteConnection:
+    """
+    Wraps a sqlite3 connection with the parts of the mysql.connector connection API db.py uses.
+    Leaving the with block rolls back an unfinished transaction and returns the connection to its thread.
+    """
+    def __init__(self, connection, release):
+        self._connection = connection
+        self._release = release
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def cursor(self):
+        return SQLiteCursor(self._connection.cursor())
+
+    def start_transaction(self):
+        # take the write lock up front, so concurrent writers wait instead of failing on upgrade
+        self._connection.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        if self._release is None:
+            return
+        if self._connection.in_transaction:
+            self._connection.rollback()
+        self._release(self._connection)
+        self._release = None
+
+class SQLiteBackend:
+    """
+    Embedded database file in WAL mode, so readers never block the writer.
+    Every thread of a process keeps its connections open for its lifetime. Like with the MySQL pool, a connection
+    is only handed out to one user at a time: a create_connection nested in an open one gets a connection of its own,
+    so closing it cannot roll back, and committing it cannot commit, the transaction of the outer one.
+    """
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+        sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+        sqlite3.register_adapter(date, lambda value: value.isoformat())
+        sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+
+    def connect(self, **config):
+        """
+        Returns an idle connection of the current thread, or a new one if all of them are in use.
+        Connection parameters only apply to MySQL and are ignored.
+        """
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.idle = []
+            local.pid = os.getpid()
+        connection = local.idle.pop() if local.idle else self.open_connection()
+        return SQLiteConnection(connection, local.idle.append)
+
+    def open_connection(self):
+        connection = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                                     detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        return connection
+
+    def table_exists(self, cursor, table_name):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name.lower(),))
+        return cursor.fetchone() is not None
+
+    def analyze(self, cursor):
+        # without statistics the planner prefers sorting a full table scan over the (time, id) index
+        cursor.execute(f"PRAGMA analysis_limit={SQLITE_ANALYSIS_LIMIT}")
+        cursor.execute("ANALYZE")
+
+    def is_duplicate_entry(self, e):
+        return isinstance(e, sqlite3.IntegrityError) and "UNIQUE constraint failed" in str(e)
+
+    def is_duplicate_index(self, e):
+        return isinstance(e, sqlite3.OperationalError) and "already exists" in str(e)
+
+BACKENDS = {"mysql": MySQLBackend, "sqlite": SQLiteBackend}
+
+if STORAGE_BACKEND not in BACKENDS:
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}, expected one of {sorted(BACKENDS)}")
+backend = BACKENDS[STORAGE_BACKEND]()
@@ -0,0 +1,31 @@
+"""
+Test configuration. The modules of the application read their settings from the environment at import time,
+so the tests run against an embedded SQLite database in a temporary directory.
+"""
+
+import os
+import sys
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix="clash_royale_tests_")
+
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("CLASH_ROYALE_API_TOKEN", "test")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(TEST_DIR, "clash_royale.db")
+os.environ["DATA_GENERATION_FILE"] = os.path.join(TEST_DIR, "data_generation.json")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the log files are created in the working directory
+os.chdir(TEST_DIR)
+
+import pytest
+
+@pytest.fixture(scope="session")
+def database():
+    """
+    Creates the tables of the test database once per test run.
+    """
+    import db
+    db.initialize_tables()
+    return db
@@ -0,0 +1,63 @@
+"""
+Tests of the read cache.
+"""
+
+import cache
+
+def test_caches_values_of_the_current_generation():
+    calls = []
+    def compute():
+        calls.append(1)
+        return [1, 2]
+    assert cache.get_or_compute(("test_cache", "value"), compute) == [1, 2]
+    assert cache.get_or_compute(("test_cache", "value"), compute) == [1, 2]
+    assert len(calls) == 1
+
+def test_does_not_cache_none():
+    calls = []
+    def compute():
+        calls.append(1)
+        return None
+    assert cache.get_or_compute(("test_cache", "none"), compute) is None
+    assert cache.get_or_compute(("test_cache", "none"), compute) is None
+    assert len(calls) == 2
+
+def test_does_not_cache_results_of_failed_queries():
+    results = iter([[], ["alice"]])
+    def compute():
+        value = next(results)
+        if not value:
+            cache.mark_failed() # like db.select_with_error_handling on a database error
+        return value
+    assert cache.get_or_compute(("test_cache", "failed"), compute) == []
+    assert cache.get_or_compute(("test_cache", "failed"), compute) == ["alice"]
+    assert cache.get_or_compute(("test_cache", "failed"), lambda: []) == ["alice"]
+
+def test_failed_nested_value_fails_the_outer_value():
+    def inner():
+        cache.mark_failed()
+        return []
+    outer_calls = []
+    def outer():
+        outer_calls.append(1)
+        return {"inner": cache.get_or_compute(("test_cache", "inner"), inner)}
+    cache.get_or_compute(("test_cache", "outer"), outer)
+    cache.get_or_compute(("test_cache", "outer"), outer)
+    assert len(outer_calls) == 2
+
+def bump_many(count):
+    for _ in range(count):
+        cache.bump_generation()
+
+def test_concurrent_bumps_are_not_lost():
+    import threading
+    import multiprocessing
+    start = cache.bump_generation()
+    # processes first, a process forked while a thread holds the lock would inherit it locked
+    workers = [multiprocessing.get_context("fork").Process(target=bump_many, args=(50,)) for _ in range(2)]
+    workers += [threading.Thread(target=bump_many, args=(50,)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert cache.load_generation_file()["generation"] == start + 300
@@ -0,0 +1,24 @@
+"""
+Tests of the card catalog of card_catalog.py.
+"""
+
+import os
+
+from card_catalog import CardCatalog
+
+def test_new_card_rebuilds_the_catalog(database, tmp_path):
+    catalog = CardCatalog(image_dir=os.path.join(tmp_path, "missing"))
+    catalog.cards()
+    card_id = database.get_card_ids(["Catalog Test Card"])[0]
+    assert catalog.get("Catalog Test Card").id == card_id
+    assert "Catalog Test Card" in [card.name for card in catalog.cards()]
+
+def test_unknown_card_is_only_looked_up_once(database, tmp_path, monkeypatch):
+    catalog = CardCatalog(image_dir=os.path.join(tmp_path, "missing"))
+    catalog.cards()
+    loads = []
+    load = catalog.load
+    monkeypatch.setattr(catalog, "load", lambda: loads.append(1) or load())
+    assert catalog.get("Not A Card").image_url.endswith("not_a_card.webp")
+    assert catalog.get("Not A Card").id is None
+    assert len(loads) == 1
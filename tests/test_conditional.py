@@ -0,0 +1,54 @@
+"""
+Tests of the conditional GET handling of run.py.
+"""
+
+from datetime import date, timedelta
+
+import pytest
+
+@pytest.fixture
+def client(database):
+    import run
+    run.app.config["TESTING"] = True
+    with run.app.test_client() as client:
+        yield client
+
+def revalidate(client, path, response):
+    return client.get(path, headers={"If-None-Match": response.headers["ETag"]})
+
+def test_revalidated_page_is_not_modified(client):
+    first = client.get("/battles")
+    assert first.status_code == 200
+    # the first request created the CSRF token of the session
+    second = client.get("/battles")
+    assert revalidate(client, "/battles", second).status_code == 304
+
+def test_form_page_changes_before_its_csrf_token_expires(client, monkeypatch):
+    import run
+    client.get("/battles")
+    response = client.get("/battles")
+    half_limit = run.app.config.get("WTF_CSRF_TIME_LIMIT", 3600) / 2
+    now = run.time.time()
+    monkeypatch.setattr(run.time, "time", lambda: now + half_limit)
+    assert revalidate(client, "/battles", response).status_code == 200
+
+def test_form_page_of_another_session_is_modified(client):
+    import run
+    client.get("/battles")
+    response = client.get("/battles")
+    with run.app.test_client() as other_client:
+        other_client.get("/battles")
+        assert revalidate(other_client, "/battles", response).status_code == 200
+
+def test_date_dependent_view_changes_at_midnight(client, monkeypatch):
+    import run
+    path = "/api/rollups?since=2024-01-01"
+    response = client.get(path)
+    assert revalidate(client, path, response).status_code == 304
+
+    class Tomorrow(date):
+        @classmethod
+        def today(cls):
+            return date.today() + timedelta(days=1)
+    monkeypatch.setattr(run, "date", Tomorrow)
+    assert revalidate(client, path, response).status_code == 200
@@ -0,0 +1,129 @@
+"""
+Tests of the API client against a local stub HTTP server.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import data_retrieval as api
+
+BATTLE_TIME = "20240101T120000.000Z"
+
+def battle(battle_time=BATTLE_TIME):
+    player = {"name": "alice", "crowns": 1, "elixirLeaked": 1.5, "kingTowerHitPoints": 4000,
+              "princessTowersHitPoints": [2000], "cards": [{"name": "Knight"}]}
+    opponent = dict(player, name="bob", crowns=0, cards=[{"name": "Archers"}])
+    return {"battleTime": battle_time, "type": "clanMate", "gameMode": {"name": "PickMode"},
+            "team": [player], "opponent": [opponent]}
+
+class StubServer:
+    """
+    Answers GET requests with the queued (status, headers, body) responses of their path, the last one repeats.
+    A response with a "delay" header is sent that many seconds late.
+    """
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append((self.path, time.monotonic()))
+                queued = stub.responses.get(self.path, [(404, {}, {})])
+                status, headers, body = queued.pop(0) if len(queued) > 1 else queued[0]
+                threading.Event().wait(float(headers.get("delay", 0))) # the tests replace time.sleep
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def paths(self):
+        return [path for path, _ in self.requests]
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = StubServer()
+    server.thread.start()
+    monkeypatch.setattr(api, "API_URL", server.url)
+    monkeypatch.setattr(api, "rate_limiter", api.TokenBucket(1000))
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+def test_retries_429_after_retry_after(stub, monkeypatch):
+    stub.responses["/clans/%23ABC/members"] = [(429, {"Retry-After": "1"}, {"reason": "requestThrottled"}),
+                                               (200, {}, {"items": [{"tag": "#A", "name": "alice"}]})]
+    delays = []
+    monkeypatch.setattr(api.time, "sleep", delays.append)
+    assert api.fetch_clan_members("#ABC") == [("#A", "alice")]
+    assert stub.paths() == ["/clans/%23ABC/members"] * 2
+    assert delays == [1]
+
+def test_gives_up_after_max_retries(stub, monkeypatch):
+    stub.responses["/clans/%23ABC/members"] = [(503, {}, {})]
+    monkeypatch.setattr(api.time, "sleep", lambda seconds: None)
+    assert api.fetch_clan_members("#ABC") is None
+    assert len(stub.requests) == api.MAX_RETRIES + 1
+
+def test_retries_timeouts(stub, monkeypatch):
+    stub.responses["/clans/%23ABC/members"] = [(200, {"delay": "1"}, {"items": []}),
+                                               (200, {}, {"items": [{"tag": "#A", "name": "alice"}]})]
+    delays = []
+    monkeypatch.setattr(api, "TIMEOUT", 0.2)
+    monkeypatch.setattr(api.time, "sleep", delays.append)
+    assert api.fetch_clan_members("#ABC") == [("#A", "alice")]
+    assert len(stub.requests) == 2
+    assert delays == [api.BACKOFF_FACTOR]
+
+def test_every_attempt_takes_a_token(stub, monkeypatch):
+    stub.responses["/clans/%23ABC/members"] = [(429, {"Retry-After": "0"}, {}), (429, {"Retry-After": "0"}, {}),
+                                               (200, {}, {"items": []})]
+    acquired = []
+    bucket = api.TokenBucket(1000)
+    monkeypatch.setattr(bucket, "acquire", lambda: acquired.append(1))
+    monkeypatch.setattr(api, "rate_limiter", bucket)
+    assert api.fetch_clan_members("#ABC") == []
+    assert len(acquired) == len(stub.requests) == 3
+
+def test_token_bucket_limits_the_request_rate(stub, monkeypatch):
+    stub.responses["/clans/%23ABC/members"] = [(200, {}, {"items": []})]
+    monkeypatch.setattr(api, "rate_limiter", api.TokenBucket(20, capacity=1))
+    for _ in range(6):
+        api.fetch_clan_members("#ABC")
+    times = [request_time for _, request_time in stub.requests]
+    # the first token is available right away, every further one after 1 / 20 seconds
+    assert times[-1] - times[0] >= 5 / 20 * 0.9
+
+def test_fetch_battle_log_if_changed(stub):
+    stub.responses["/players/%23A/battlelog"] = [(200, {}, [battle()])]
+    battle_time, battles = api.fetch_battle_log_if_changed("#A")
+    assert battle_time == BATTLE_TIME
+    assert len(battles) == 1
+    assert battles[0][0] == ("2024-01-01 12:00:00", "clanMate", "PickMode")
+    assert battles[0][2] == ["Knight"] and battles[0][4] == ["Archers"]
+
+    assert api.fetch_battle_log_if_changed("#A", BATTLE_TIME) == (BATTLE_TIME, [])
+
+    stub.responses["/players/%23A/battlelog"] = [(200, {}, [battle("20240101T130000.000Z"), battle()])]
+    battle_time, battles = api.fetch_battle_log_if_changed("#A", BATTLE_TIME)
+    assert battle_time == "20240101T130000.000Z"
+    assert len(battles) == 2
+
+def test_fetch_battle_log_if_changed_failure(stub, monkeypatch):
+    monkeypatch.setattr(api.time, "sleep", lambda seconds: None)
+    assert api.fetch_battle_log_if_changed("#X", BATTLE_TIME) == (BATTLE_TIME, None)
@@ -0,0 +1,71 @@
+"""
+Tests of the battle export of export.py and the /api/export route of run.py.
+"""
+
+import json
+import functools
+
+import pytest
+
+from test_write_battles import make_battle
+
+@pytest.fixture(scope="module")
+def export_database(database):
+    tags = ["#E0", "#E1"]
+    database.insert_members([(tag, f"exporter {tag}") for tag in tags])
+    ids = database.get_player_ids()
+    database.write_battles([make_battle(database, f"2023-07-0{day} 10:00:00", ids["exporter #E0"], ids["exporter #E1"])
+                            for day in (1, 2)])
+    return database
+
+@pytest.fixture
+def export(export_database, monkeypatch):
+    import export
+    # one battle per batch, so the export needs a second query
+    monkeypatch.setattr(export, "iter_battles", functools.partial(export_database.iter_battles, batch_size=1))
+    return export
+
+@pytest.fixture
+def client(export):
+    import run
+    run.app.config["TESTING"] = True
+    with run.app.test_client() as client:
+        yield client
+
+@pytest.fixture
+def failing_second_batch(export_database, monkeypatch):
+    get_battles = export_database.get_battles
+    calls = []
+    def failing_get_battles(*args, **kwargs):
+        calls.append(1)
+        return get_battles(*args, **kwargs) if len(calls) == 1 else None
+    monkeypatch.setattr(export_database, "get_battles", failing_get_battles)
+
+def export_lines(chunks):
+    lines = []
+    with pytest.raises(RuntimeError):
+        for chunk in chunks:
+            lines.extend(chunk.splitlines())
+    return lines
+
+def test_export_of_all_enemies(client):
+    response = client.get("/api/export?player-tag=%23E0&enemy-selection=None")
+    assert response.status_code == 200
+    assert len(response.get_data(as_text=True).splitlines()) == 2
+
+def test_failed_export_response_is_aborted(client, failing_second_batch):
+    response = client.get("/api/export?player-tag=%23E0")
+    with pytest.raises(RuntimeError):
+        response.get_data()
+
+def test_failed_ndjson_export_ends_with_error_record(export, failing_second_batch):
+    lines = export_lines(export.export_battles("ndjson", player_tag="#E0"))
+    assert len(lines) == 2
+    assert "id" in json.loads(lines[0])
+    assert "error" in json.loads(lines[1])
+
+def test_failed_csv_export_ends_with_error_row(export, failing_second_batch):
+    lines = export_lines(export.export_battles("csv", player_tag="#E0"))
+    assert len(lines) == 3
+    assert lines[0].startswith("id,time")
+    assert lines[2].startswith("error,")
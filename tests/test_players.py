@@ -0,0 +1,35 @@
+"""
+Tests of the player pages of run.py.
+"""
+
+import pytest
+
+@pytest.fixture
+def client(database):
+    import run
+    run.app.config["TESTING"] = True
+    with run.app.test_client() as client:
+        yield client
+
+def test_pages_of_a_member_without_battles(client, database):
+    database.insert_members([("#N0", "newcomer #N0")])
+    assert database.get_player_info("#N0")["1v1_battle_count"] == 0
+    response = client.get("/players")
+    assert response.status_code == 200
+    assert "newcomer #N0" in response.get_data(as_text=True)
+    assert client.get("/player/%23N0").status_code == 200
+
+def test_migration_of_the_player_counters(database):
+    database.migrate_player_counters()
+    assert all(player["1v1_battle_count"] is not None for player in database.get_players())
+
+def test_rebuild_matches_the_maintained_counters(database):
+    from test_write_battles import make_battle
+    database.insert_members([("#R0", "rebuilt #R0"), ("#R1", "rebuilt #R1")])
+    ids = database.get_player_ids()
+    database.write_battles([make_battle(database, "2023-06-01 10:00:00", ids["rebuilt #R0"], ids["rebuilt #R1"], (3, 0)),
+                            make_battle(database, "2023-06-02 10:00:00", ids["rebuilt #R0"], ids["rebuilt #R1"], (0, 1))])
+    maintained = database.get_players()
+    database.update_player_infos()
+    assert database.get_players() == maintained
+    assert database.get_player_info("#R0")["1v1_three_crowns_win_count"] == 1
@@ -0,0 +1,95 @@
+"""
+Checks the SQLite query plans of every filter combination of db.build_battles_query: no table is scanned completely.
+Without a player filter the battles are read from the new indexes in (time, id) order and nothing is sorted.
+With a player filter the join order is left to the planner: it looks the player's scores up by their player id
+and starts from them unless a game mode or time range narrows the battles down first.
+"""
+
+import random
+import itertools
+from datetime import datetime, timedelta
+
+import pytest
+
+PLAYER_COUNT = 20
+BATTLE_COUNT = 3000
+
+@pytest.fixture(scope="module")
+def battles_database(database):
+    db = database
+    tags = [f"#QP{i}" for i in range(PLAYER_COUNT)]
+    db.insert_members([(tag, f"plan {tag}") for tag in tags])
+    player_ids = db.get_player_ids()
+    ids = [player_ids[f"plan {tag}"] for tag in tags]
+    rng = random.Random(0)
+    time = datetime(2022, 1, 1)
+    battles = []
+    for _ in range(BATTLE_COUNT):
+        player1, player2 = rng.sample(range(PLAYER_COUNT), 2)
+        time += timedelta(seconds=rng.randint(1, 300))
+        battles.append({"key": db.battle_key(str(time), ids[player1], ids[player2]),
+                        "info": (str(time), db.ALLOWED_BATTLE_TYPE, rng.choice(db.ALLOWED_BATTLE_MODES)),
+                        "player1_id": ids[player1], "player1_data": (f"plan {tags[player1]}", 1, 1.0, 1000, [1000]),
+                        "player1_deck": ["Knight", "Archers"],
+                        "player2_id": ids[player2], "player2_data": (f"plan {tags[player2]}", 0, 2.0, 0, None),
+                        "player2_deck": ["Giant", "Minions"]})
+    db.write_battles(battles)
+    db.analyze_tables() # the planner only prefers the (time, id) indexes with statistics
+    return db
+
+FILTERS = list(itertools.product(
+    ("ALL", "PickMode"),
+    ((None, None), ("#QP1", None), ("#QP1", "#QP2")),
+    (None, ("2200-01-01 00:00:00", 0)), # first page, keyset cursor
+    ((None, None), ("2022-02-01", "2022-03-01")), # since, until
+))
+
+def query_plan(db, query, params):
+    with db.create_connection() as cnx:
+        with cnx.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+            return [row[3] for row in cursor.fetchall()]
+
+@pytest.mark.parametrize("game_mode, players, before, time_range", FILTERS)
+def test_battles_query_plan(battles_database, game_mode, players, before, time_range):
+    db = battles_database
+    player_tag, enemy_tag = players
+    since, until = time_range
+    query, params = db.build_battles_query(game_mode, player_tag, enemy_tag, before=before,
+                                           page_size=db.PAGE_SIZE, since=since, until=until)
+    plan = query_plan(db, query, params)
+
+    # subqueries are scanned as co-routines, tables only through an index
+    full_scans = [step for step in plan if step.startswith("SCAN ")
+                  and not step.startswith("SCAN (subquery") and "USING" not in step]
+    assert not full_scans, plan
+    if player_tag is None:
+        assert not any("TEMP B-TREE" in step for step in plan), plan
+        battles_index = "game_mode_time_id" if game_mode != "ALL" else "time_id"
+        assert any(step.startswith("S") and " b USING " in step and f"INDEX {battles_index}" in step for step in plan), plan
+    else:
+        assert "CROSS JOIN" not in db.storage.translate_to_sqlite(query)
+        assert "SEARCH p1 USING INDEX tag (tag=?)" in plan, plan
+        assert any(step.startswith("SEARCH s1 USING INDEX player_battle (player_id=?") for step in plan), plan
+        if game_mode == "ALL" and since is None:
+            # the players first, then only their battles by primary key
+            assert plan[0] == "SEARCH p1 USING INDEX tag (tag=?)", plan
+            assert "SEARCH b USING INTEGER PRIMARY KEY (rowid=?)" in plan, plan
+    if enemy_tag is not None:
+        assert any(" s2 USING INDEX player_battle (player_id=? AND battle_id=?)" in step for step in plan), plan
+
+def test_keyset_pages_cover_all_battles(battles_database):
+    db = battles_database
+    seen = []
+    before = None
+    while True:
+        query, params = db.build_battles_query("ALL", "#QP1", before=before, page_size=7)
+        with db.create_connection() as cnx:
+            rows = db.select_with_error_handling(cnx, query, params, "test_keyset_pages")
+        if not rows:
+            break
+        seen.extend(row[-1] for row in rows)
+        before = (rows[-1][0], rows[-1][-1])
+    query, params = db.build_battles_query("ALL", "#QP1")
+    with db.create_connection() as cnx:
+        assert seen == [row[-1] for row in db.select_with_error_handling(cnx, query, params, "test_keyset_pages")]
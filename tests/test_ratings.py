@@ -0,0 +1,77 @@
+"""
+Tests of the incremental rating updates of db.py.
+"""
+
+import pytest
+
+from test_write_battles import make_battle
+
+@pytest.fixture
+def player_ids(database):
+    tags = [f"#R{i}" for i in range(3)]
+    database.insert_members([(tag, f"rater {tag}") for tag in tags])
+    ids = database.get_player_ids()
+    return [ids[f"rater {tag}"] for tag in tags]
+
+def load_ratings(db):
+    with db.create_connection() as cnx:
+        rows = db.select_with_error_handling(cnx, "SELECT game_mode, player_id, rating, battle_count FROM player_ratings", None, "load_ratings")
+    return {(game_mode, player_id): (round(rating, 6), battle_count) for game_mode, player_id, rating, battle_count in rows}
+
+def test_late_battle_is_rated_in_time_order(database, player_ids):
+    db = database
+    alice, bob, carl = player_ids
+    db.write_battles([make_battle(db, "2021-03-01 10:00:00", alice, bob, (1, 0)),
+                      make_battle(db, "2021-03-01 12:00:00", bob, carl, (2, 0))])
+    db.update_ratings()
+    # fetched late: older than the rated battles, but inserted after them
+    db.write_battles([make_battle(db, "2021-03-01 11:00:00", carl, alice, (3, 0))])
+    db.update_ratings()
+    db.write_battles([make_battle(db, "2021-03-01 13:00:00", alice, carl, (0, 1))])
+    db.update_ratings()
+    incremental = load_ratings(db)
+
+    db.rebuild_ratings()
+    assert load_ratings(db) == incremental
+    assert incremental[("ALL", alice)][1] == 3
+
+def test_late_battle_only_replays_the_battles_since(database, player_ids, monkeypatch):
+    db = database
+    alice, bob, carl = player_ids
+    db.write_battles([make_battle(db, "2020-05-01 10:00:00", alice, bob, (2, 1)),
+                      make_battle(db, "2020-05-01 12:00:00", bob, carl, (2, 0))])
+    db.update_ratings()
+    rated = []
+    apply_battle = db.ratings.apply_battle
+    monkeypatch.setattr(db.ratings, "apply_battle", lambda state, *battle: rated.append(battle) or apply_battle(state, *battle))
+    db.write_battles([make_battle(db, "2020-05-01 11:00:00", carl, alice, (3, 0))])
+    db.update_ratings()
+    with db.create_connection() as cnx:
+        since = db.select_with_error_handling(cnx, "SELECT COUNT(*) FROM battles WHERE time >= %s",
+                                              ("2020-05-01 11:00:00",), "count_battles")[0][0]
+    # the late battle and the newer ones, but not the battle before it
+    assert len(rated) == since
+    assert ("PickMode", alice, 2, bob, 1) not in rated
+    incremental = load_ratings(db)
+
+    monkeypatch.undo()
+    db.rebuild_ratings()
+    assert load_ratings(db) == incremental
+
+def test_late_battle_without_rating_history_replays_everything(database, player_ids):
+    db = database
+    alice, bob, carl = player_ids
+    db.write_battles([make_battle(db, "2019-07-01 12:00:00", alice, carl, (1, 1))])
+    db.update_ratings()
+    # rated before the rating history existed
+    with db.create_connection() as cnx:
+        cnx.start_transaction()
+        with cnx.cursor() as cursor:
+            cursor.execute("DELETE FROM rating_history")
+        cnx.commit()
+    db.write_battles([make_battle(db, "2019-07-01 11:00:00", bob, carl, (0, 2))])
+    db.update_ratings()
+    incremental = load_ratings(db)
+
+    db.rebuild_ratings()
+    assert load_ratings(db) == incremental
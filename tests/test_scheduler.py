@@ -0,0 +1,73 @@
+"""
+Tests of the poll schedule and the stages of the ingest scheduler.
+"""
+
+import time
+import threading
+from datetime import datetime, timezone
+
+import pytest
+
+import scheduler
+
+@pytest.fixture
+def schedule(monkeypatch):
+    # first polls at the end of their interval
+    monkeypatch.setattr(scheduler.random, "uniform", lambda low, high: high)
+    schedule = scheduler.PollSchedule(min_interval=0.05, max_interval=3600)
+    schedule.set_players(["#S0"], {}, time.monotonic(), datetime.now(timezone.utc).replace(tzinfo=None))
+    return schedule
+
+def test_wake_interrupts_the_wait_of_the_fetch_stage(schedule):
+    ingest = scheduler.IngestScheduler(schedule, max_in_flight=1)
+    fetched = threading.Event()
+    def fetch(player_tag, battle_time):
+        fetched.set()
+        ingest.stop()
+    ingest.fetch = fetch
+    fetch_stage = threading.Thread(target=ingest.fetch_stage, daemon=True)
+    fetch_stage.start()
+    time.sleep(0.1) # the fetch stage waits for the poll in an hour now
+    schedule.wake("#S0", time.monotonic())
+    assert fetched.wait(timeout=2)
+    fetch_stage.join(timeout=2)
+    assert not fetch_stage.is_alive()
+
+def test_stop_interrupts_the_wait_of_the_fetch_stage(schedule):
+    ingest = scheduler.IngestScheduler(schedule, max_in_flight=1)
+    fetch_stage = threading.Thread(target=ingest.fetch_stage, daemon=True)
+    fetch_stage.start()
+    time.sleep(0.1)
+    ingest.stop()
+    fetch_stage.join(timeout=2)
+    assert not fetch_stage.is_alive()
+
+def run_write_stage(ingest, monkeypatch, write_battles):
+    monkeypatch.setattr(scheduler.db, "collect_new_battles", lambda battle_logs, player_ids: ["battle"])
+    monkeypatch.setattr(scheduler.db, "remove_duplicate_battles", lambda battles: battles)
+    monkeypatch.setattr(scheduler.db, "write_battles", write_battles)
+    ingest._battle_logs.put(("#S0", ["battle"], "20230801T100000.000Z"))
+    ingest._battle_logs.put(None)
+    ingest.write_stage()
+
+def test_battle_time_is_stored_after_the_battles_were_written(schedule, monkeypatch):
+    ingest = scheduler.IngestScheduler(schedule)
+    run_write_stage(ingest, monkeypatch, lambda battles, failed: len(battles))
+    assert schedule.pop_due(float("inf")) == [("#S0", "20230801T100000.000Z")]
+
+@pytest.mark.parametrize("write_battles", [lambda battles, failed: failed.extend(battles) or 0,
+                                           lambda battles, failed: 1 / 0], ids=["rolled back", "exception"])
+def test_battle_log_is_fetched_again_after_a_failed_write(schedule, monkeypatch, write_battles):
+    ingest = scheduler.IngestScheduler(schedule)
+    run_write_stage(ingest, monkeypatch, write_battles)
+    assert schedule.pop_due(float("inf")) == [("#S0", None)]
+
+def test_new_members_are_listed_before_their_first_battle(database, schedule, monkeypatch):
+    import run
+    monkeypatch.setattr(scheduler.api, "fetch_clan_members", lambda: [("#S1", "scheduled #S1")])
+    scheduler.IngestScheduler(schedule).update_members()
+    run.app.config["TESTING"] = True
+    with run.app.test_client() as client:
+        response = client.get("/players")
+    assert response.status_code == 200
+    assert "scheduled #S1" in response.get_data(as_text=True)
@@ -0,0 +1,38 @@
+"""
+Tests of the SQLite connection handling of the storage layer.
+"""
+
+def count_cards(db, name):
+    with db.create_connection() as cnx, cnx.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM cards WHERE name = %s", (name,))
+        return cursor.fetchone()[0]
+
+def test_nested_connection_keeps_outer_transaction(database):
+    db = database
+    with db.create_connection() as cnx:
+        cnx.start_transaction()
+        with cnx.cursor() as cursor:
+            cursor.execute("INSERT INTO cards (name) VALUES (%s)", ("Nested Test Card",))
+        with db.create_connection() as nested, nested.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM cards")
+            cursor.fetchone()
+        cnx.commit()
+    assert count_cards(db, "Nested Test Card") == 1
+
+def test_nested_connection_is_not_the_outer_one(database):
+    db = database
+    with db.create_connection() as cnx:
+        cnx.start_transaction()
+        with cnx.cursor() as cursor:
+            cursor.execute("INSERT INTO cards (name) VALUES (%s)", ("Rolled Back Test Card",))
+        with db.create_connection() as nested:
+            nested.commit()
+        cnx.rollback()
+    assert count_cards(db, "Rolled Back Test Card") == 0
+
+def test_closed_connections_are_reused(database):
+    db = database
+    with db.create_connection() as cnx:
+        first = cnx._connection
+    with db.create_connection() as cnx:
+        assert cnx._connection is first
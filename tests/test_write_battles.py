@@ -0,0 +1,52 @@
+"""
+Tests of the battle ingest of db.py.
+"""
+
+import pytest
+
+def make_battle(db, time, player1_id, player2_id, crowns=(1, 0)):
+    player_data = (("p1", crowns[0], 1.0, 4000, [2000]), ("p2", crowns[1], 2.0, 3000, None))
+    return {"key": db.battle_key(time, player1_id, player2_id),
+            "info": (time, db.ALLOWED_BATTLE_TYPE, "PickMode"),
+            "player1_id": player1_id, "player1_data": player_data[0], "player1_deck": ["Knight", "Archers"],
+            "player2_id": player2_id, "player2_data": player_data[1], "player2_deck": ["Giant", "Minions"]}
+
+@pytest.fixture
+def player_ids(database):
+    tags = [f"#W{i}" for i in range(4)]
+    database.insert_members([(tag, f"writer {tag}") for tag in tags])
+    ids = database.get_player_ids()
+    return [ids[f"writer {tag}"] for tag in tags]
+
+def count_battles(db, time):
+    with db.create_connection() as cnx:
+        return db.select_with_error_handling(cnx, "SELECT COUNT(*) FROM battles WHERE time = %s", (time,), "count_battles")[0][0]
+
+def test_battles_of_different_players_in_the_same_second(database, player_ids):
+    time = "2023-05-01 10:00:00"
+    battles = [make_battle(database, time, player_ids[0], player_ids[1]),
+               make_battle(database, time, player_ids[2], player_ids[3])]
+    assert database.write_battles(database.remove_duplicate_battles(battles)) == 2
+    assert count_battles(database, time) == 2
+
+def test_duplicate_battle_only_skips_itself(database, player_ids):
+    time = "2023-05-02 10:00:00"
+    assert database.write_battles([make_battle(database, time, player_ids[0], player_ids[1])]) == 1
+    # the duplicate got past remove_duplicate_battles, e.g. written by a concurrent ingest in the meantime
+    battles = [make_battle(database, "2023-05-02 09:00:00", player_ids[0], player_ids[2]),
+               make_battle(database, time, player_ids[1], player_ids[0]),
+               make_battle(database, "2023-05-02 11:00:00", player_ids[2], player_ids[3])]
+    assert database.write_battles(battles) == 2
+    assert count_battles(database, time) == 1
+    assert count_battles(database, "2023-05-02 09:00:00") == count_battles(database, "2023-05-02 11:00:00") == 1
+
+def test_failed_batch_is_reported(database, player_ids, monkeypatch):
+    import sqlite3
+    def fail(*args):
+        raise sqlite3.OperationalError("disk I/O error")
+    monkeypatch.setattr(database, "update_head_to_head", fail)
+    battles = [make_battle(database, "2023-05-03 10:00:00", player_ids[0], player_ids[1])]
+    failed = []
+    assert database.write_battles(battles, failed=failed) == 0
+    assert failed == battles
+    assert count_battles(database, "2023-05-03 10:00:00") == 0
@@ -0,0 +1,68 @@
+"""
+Win rate and meta trends for the charts on /player/<tag> and /cards.
+Both are read from the daily and weekly buckets of the rollup tables, so no chart scans the battle history.
+"""
+
+from datetime import timedelta
+
+import db
+
+PLAYER_TREND_DAYS = 90 # days shown in the win rate chart of a player
+ROLLING_DAYS = 7 # days covered by every win rate of the chart
+META_TREND_WEEKS = 12 # weeks shown in the meta charts of /cards
+META_TREND_CARDS = 5 # most played cards shown in the meta charts
+
+def percentage(count, total):
+    return round(count / total * 100, 2) if total else None
+
+def player_win_rate_trend(player_tag, today, game_mode="ALL", days=PLAYER_TREND_DAYS, window=ROLLING_DAYS):
+    """
+    Returns the rolling win rate of a player for the last days up to and including today as
+    {"labels": [...], "win_rates": [...], "battle_counts": [...]}.
+    Every win rate covers the window days up to the day, it is None if the player had no battles in that time.
+    """
+    since = today - timedelta(days=days + window - 2)
+    series = db.get_player_series(player_tag, "day", since, today + timedelta(days=1), game_mode)
+    days_range = [since + timedelta(days=i) for i in range(days + window - 1)]
+    counts = [series.get(day, (0, 0, 0)) for day in days_range]
+
+    trend = {"labels": [], "win_rates": [], "battle_counts": []}
+    battle_count = win_count = 0
+    for i, (day, (day_battle_count, day_win_count, _)) in enumerate(zip(days_range, counts)):
+        battle_count += day_battle_count
+        win_count += day_win_count
+        if i >= window:
+            battle_count -= counts[i - window][0]
+            win_count -= counts[i - window][1]
+        if i >= window - 1:
+            trend["labels"].append(day.isoformat())
+            trend["win_rates"].append(percentage(win_count, battle_count))
+            trend["battle_counts"].append(battle_count)
+    return trend
+
+def card_meta_trend(today, game_mode="ALL", weeks=META_TREND_WEEKS, card_count=META_TREND_CARDS):
+    """
+    Returns the weekly share of decks containing each of the card_count most played cards of the last weeks
+    (including the current one) and their weekly win rates, as chart series
+    {"labels": [...], "usage_rates": [{"label": card_name, "data": [...]}], "win_rates": [{"label": card_name, "data": [...]}]}.
+    """
+    current_monday = today - timedelta(days=today.weekday())
+    mondays = [current_monday - timedelta(weeks=weeks - 1 - i) for i in range(weeks)]
+    card_series = db.get_card_series("week", mondays[0], current_monday + timedelta(weeks=1), game_mode)
+    deck_series = db.get_deck_series("week", mondays[0], current_monday + timedelta(weeks=1), game_mode)
+
+    battle_counts = {}
+    for cards in card_series.values():
+        for card_name, (battle_count, _) in cards.items():
+            battle_counts[card_name] = battle_counts.get(card_name, 0) + battle_count
+    top_cards = sorted(battle_counts, key=lambda card_name: (-battle_counts[card_name], card_name))[:card_count]
+
+    trend = {"labels": [monday.isoformat() for monday in mondays], "usage_rates": [], "win_rates": []}
+    for card_name in top_cards:
+        counts = [card_series.get(monday, {}).get(card_name, (0, 0)) for monday in mondays]
+        trend["usage_rates"].append({"label": card_name,
+                                     "data": [percentage(battle_count, deck_series.get(monday, 0))
+                                              for monday, (battle_count, _) in zip(mondays, counts)]})
+        trend["win_rates"].append({"label": card_name,
+                                   "data": [percentage(win_count, battle_count) for battle_count, win_count in counts]})
+    return trend
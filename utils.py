@@ -3,8 +3,13 @@ This module contains some utility functions.
 """
 
 from datetime import datetime
-import ast
 import os
+import gzip
+
+try:
+    import brotli # optional, enables "Content-Encoding: br"
+except ImportError:
+    brotli = None
 
 def iso8601_to_datetime(iso8601_date, datetime_format):
     """
@@ -12,15 +17,6 @@ def iso8601_to_datetime(iso8601_date, datetime_format):
     """
     return str(datetime.strptime(iso8601_date, datetime_format))
 
-def replace_card_names_by_img_path(deck_string):
-    """
-    Given a deck string containing a list of card names, this function replaces each card name
-    with a corresponding image path while applying lowercase, space-to-underscore, and character removal transformations.
-    """
-    deck_list = ast.literal_eval(deck_string)
-    deck_list = ["/static/images/cards/" + card.lower().replace(" ", "_").replace("'", "").replace("[", "").replace("]", "") + ".webp" for card in deck_list]
-    return deck_list
-
 def initialize_cards_data(card_files):
     """
     Initializes a list of card data dictionaries based on a list of card files and returns it.
@@ -31,35 +27,65 @@ def initialize_cards_data(card_files):
         cards_data.append({"image": card_file, "name": card_name, "battle_count": 0, "win_count": 0})
     return cards_data
 
+def apply_card_stats(card_stats, cards_data):
+    """
+    Sets the battle and win counts in cards_data from the card_stats dictionary returned by db.get_card_stats.
+    """
+    for card_data in cards_data:
+        card_data["battle_count"], card_data["win_count"] = card_stats.get(card_data["name"], (0, 0))
+
 def update_cards_data_stats(battles_data, cards_data):
     """
     Updates the battle and win counts in the cards_data based on battles_data.
+    battles_data may be any iterable of battles, e.g. the db.stream_battles generator.
     """
+    cards_by_name = {card_data["name"]: card_data for card_data in cards_data}
     for battle in battles_data:
-        player1_deck_list = ast.literal_eval(battle["player1_deck_string"])
-        player2_deck_list = ast.literal_eval(battle["player2_deck_string"])
+        player1_deck_list = battle["player1_deck"]
+        player2_deck_list = battle["player2_deck"]
 
-        update_battle_count(player1_deck_list + player2_deck_list, cards_data)
+        update_battle_count(player1_deck_list + player2_deck_list, cards_by_name)
 
         if battle["player1_crowns"] > battle["player2_crowns"]:
-            update_win_count(player1_deck_list, cards_data)
+            update_win_count(player1_deck_list, cards_by_name)
         elif battle["player2_crowns"] > battle["player1_crowns"]:
-            update_win_count(player2_deck_list, cards_data)
+            update_win_count(player2_deck_list, cards_by_name)
 
-def update_battle_count(deck_list, cards_data):
+def update_battle_count(deck_list, cards_by_name):
     """
-    Update the battle count in cards_data based on the given deck_list.
+    Update the battle count in cards_by_name (card name -> card data) based on the given deck_list.
     """
     for card_name in deck_list:
-        for card_data in cards_data:
-            if card_data["name"] == card_name:
-                card_data["battle_count"] += 1
+        card_data = cards_by_name.get(card_name)
+        if card_data is not None:
+            card_data["battle_count"] += 1
 
-def update_win_count(winning_deck_list, cards_data):
+def update_win_count(winning_deck_list, cards_by_name):
     """
-    Update the win count in cards_data based on the given winning_deck_list.
+    Update the win count in cards_by_name (card name -> card data) based on the given winning_deck_list.
     """
     for card_name in winning_deck_list:
-        for card_data in cards_data:
-            if card_data["name"] == card_name:
-                card_data["win_count"] += 1
+        card_data = cards_by_name.get(card_name)
+        if card_data is not None:
+            card_data["win_count"] += 1
+
+def negotiate_encoding(accept_encoding):
+    """
+    Returns the best supported content encoding ("br", "gzip" or None) for an Accept-Encoding header.
+    """
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",") if not part.strip().endswith("q=0")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def compress_body(body, encoding):
+    """
+    Compresses a response body (bytes) with the given content encoding.
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    return body